@@ -0,0 +1,857 @@
+"""Process-level cache of the Supabase question bank.
+
+Tutti i picker (/api/simulazioni/start, /api/sim/start, /api/bot/questions/pick)
+e la lista admin leggono da qui invece di scaricare l'intera tabella
+`questions` ad ogni richiesta.
+
+- TTL configurabile con QUESTION_BANK_TTL_S (default 300s, 0 = sempre fresco).
+- Le scritture admin (routes/domande.py) aggiornano la cache in write-through.
+- A TTL scaduto si scaricano solo le righe cambiate (updated_at > watermark)
+  e le cancellazioni (tombstone o diff periodico degli id), poi si fa il merge
+  in banca e indice: il costo segue le modifiche, non la dimensione della banca.
+- QUESTION_BANK_PROFILE sceglie le colonne scaricate (supabase_db.QUESTION_PROFILES).
+- `bank_stats()` espone hit/miss e latenza dei refresh.
+- `get_question(qid)`: lookup per id read-through (banca in cache, poi una
+  piccola LRU dei fetch singoli, poi Supabase), invalidato dalle stesse
+  scritture/delta della banca.
+- `resolve(qids, revs)`: domande di una sessione compatta (solo id + updated_at).
+  Le versioni sostituite o cancellate restano per QUESTION_RETIRED_S secondi
+  in `_RETIRED`, così una domanda modificata a metà esame si corregge con la
+  versione che lo studente ha visto.
+
+Sopra la banca viene costruito (una volta per versione) un indice
+(materia, tipo, difficolta) -> domande, con posting list per tag: `pick()`
+estrae N domande in ~O(N + tag trovati) invece di scansionare la banca.
+Con QUESTION_PICK_MODE=db il campionamento avviene invece in Postgres
+(sql/pick_questions.sql) e la banca non viene scaricata per i picker.
+
+Le righe restituite sono condivise: i chiamanti NON devono modificarle.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import supabase_db
+from supabase_db import fetch_all_questions
+
+logger = logging.getLogger("dinomed.question_bank")
+
+
+def _bank_profile() -> str:
+    # "grading" basta a picker, correzione, review e lista admin (created_at incluso)
+    return os.getenv("QUESTION_BANK_PROFILE") or "grading"
+
+
+def _env_s(name: str, default: float) -> float:
+    try:
+        return max(0.0, float(os.getenv(name, str(default))))
+    except Exception:
+        return default
+
+
+def _ttl_s() -> float:
+    return _env_s("QUESTION_BANK_TTL_S", 300.0)
+
+
+def _delta_enabled() -> bool:
+    # "delta" (default): a TTL scaduto scarica solo le righe cambiate | "full": tutta la tabella
+    return norm_key(os.getenv("QUESTION_BANK_SYNC") or "delta") == "delta"
+
+
+_LOCK = threading.Lock()          # protegge _STATE / _STATS
+_REFRESH_LOCK = threading.Lock()  # un solo refresh alla volta (niente stampede)
+
+_STATE: Dict[str, Any] = {
+    "loaded": False,
+    "rows": None,           # List[dict] materializzata da by_id (None = da ricostruire)
+    "by_id": {},            # {id: dict}, fonte di verità della cache
+    "version": 0,           # cresce ad ogni cambio (refresh, delta o write-through)
+    "loaded_at": 0.0,       # time.monotonic() dell'ultimo sync (full o delta)
+    "full_at": 0.0,         # time.monotonic() dell'ultimo refresh completo
+    "id_diff_at": 0.0,      # time.monotonic() dell'ultimo diff degli id
+    "watermark": None,      # max(updated_at) visto: base del prossimo delta
+    "tomb_watermark": None, # max(deleted_at) visto in question_tombstones
+    "tombstones": True,     # False se la tabella tombstone non esiste
+}
+
+_STATS: Dict[str, Any] = {
+    "hits": 0,
+    "misses": 0,
+    "refreshes": 0,
+    "refresh_errors": 0,
+    "delta_syncs": 0,
+    "delta_errors": 0,
+    "delta_upserts": 0,
+    "delta_deletes": 0,
+    "id_diffs": 0,
+    "invalidations": 0,
+    "write_through": 0,
+    "last_refresh_ms": None,
+    "last_delta_ms": None,
+    "total_refresh_ms": 0.0,
+    "by_id_hits": 0,
+    "by_id_misses": 0,
+    "resolved": 0,
+    "resolved_retired": 0,
+    "resolved_changed": 0,
+    "resolved_missing": 0,
+}
+
+# domande lette singolarmente (fuori dalla banca in cache): qid -> (monotonic, row | None)
+_BY_ID: "OrderedDict[str, Tuple[float, Optional[Dict[str, Any]]]]" = OrderedDict()
+
+# versioni superate (modificate/cancellate): (qid, updated_at) -> (monotonic, row)
+_RETIRED: "OrderedDict[Tuple[str, str], Tuple[float, Dict[str, Any]]]" = OrderedDict()
+
+
+def _count(key: str, n: int = 1) -> None:
+    with _LOCK:
+        _STATS[key] = _STATS.get(key, 0) + n
+
+
+def _is_fresh(now: float) -> bool:
+    return _STATE["loaded"] and (now - _STATE["loaded_at"]) < _ttl_s()
+
+
+def _rows() -> List[Dict[str, Any]]:
+    rows = _STATE["rows"]
+    if rows is not None:
+        return rows
+    with _LOCK:
+        if _STATE["rows"] is None:
+            _STATE["rows"] = list(_STATE["by_id"].values())
+        return _STATE["rows"]
+
+
+def _install(rows: List[Dict[str, Any]], loaded_at: float) -> None:
+    by_id = {str(q.get("id")): q for q in rows if q.get("id") is not None}
+    with _LOCK:
+        for qid, old in _STATE["by_id"].items():
+            new = by_id.get(qid)
+            if new is None or question_rev(new) != question_rev(old):
+                _retire(old)
+        _STATE["loaded"] = True
+        _STATE["rows"] = list(by_id.values())
+        _STATE["by_id"] = by_id
+        _STATE["version"] += 1
+        _STATE["loaded_at"] = loaded_at
+        _STATE["full_at"] = loaded_at
+        _STATE["id_diff_at"] = loaded_at
+        _BY_ID.clear()
+
+
+def _apply_changes(upserts: List[Dict[str, Any]], deleted_ids: Iterable[str]) -> int:
+    """Merge changed/deleted rows into the bank and derive the index from the previous one.
+
+    Costo proporzionale alle modifiche (più la lista `rows`, ricostruita pigramente).
+    """
+    global _INDEX
+    with _LOCK:
+        if not _STATE["loaded"]:
+            return 0
+        by_id = _STATE["by_id"]
+        removed: List[Dict[str, Any]] = []
+        added: List[Dict[str, Any]] = []
+        for qid in deleted_ids:
+            _BY_ID.pop(str(qid), None)
+            old = by_id.pop(str(qid), None)
+            if old is not None:
+                removed.append(old)
+                _retire(old)
+        for row in upserts:
+            if row.get("id") is None:
+                continue
+            qid = str(row.get("id"))
+            _BY_ID.pop(qid, None)
+            old = by_id.get(qid)
+            if old is not None:
+                removed.append(old)
+                if question_rev(old) != question_rev(row):
+                    _retire(old)
+            by_id[qid] = row
+            added.append(row)
+        if not removed and not added:
+            return 0
+        prev_version = _STATE["version"]
+        _STATE["version"] = prev_version + 1
+        _STATE["rows"] = None
+        idx = _INDEX
+        if idx is not None and idx.version == prev_version:
+            _INDEX = idx.derive(removed, added, prev_version + 1)
+        return len(removed) + len(added)
+
+
+# =========================
+# Refresh completo
+# =========================
+def _watermarks() -> Tuple[Optional[str], Optional[str]]:
+    # letti PRIMA dello scan completo: quello che cambia durante lo scan
+    # rientra nel delta successivo (il merge è idempotente)
+    if not _delta_enabled():
+        return None, None
+    try:
+        wm = supabase_db.fetch_questions_watermark()
+    except Exception as e:
+        logger.info("delta sync unavailable (questions.updated_at): %s", e)
+        return None, None
+    tomb = None
+    if _STATE["tombstones"]:
+        try:
+            tomb = supabase_db.fetch_tombstones_watermark()
+        except Exception as e:
+            logger.info("question_tombstones unavailable, using periodic id diff: %s", e)
+            with _LOCK:
+                _STATE["tombstones"] = False
+    return wm, tomb
+
+
+def _set_watermarks(wm: Optional[str], tomb: Optional[str]) -> None:
+    with _LOCK:
+        _STATE["watermark"] = wm
+        _STATE["tomb_watermark"] = tomb
+
+
+def _refresh() -> List[Dict[str, Any]]:
+    t0 = time.perf_counter()
+    try:
+        wm, tomb = _watermarks()
+        rows = fetch_all_questions(profile=_bank_profile())
+    except Exception:
+        _count("refresh_errors")
+        raise
+    _set_watermarks(wm, tomb)
+    return _refreshed(rows, t0)
+
+
+async def _arefresh() -> List[Dict[str, Any]]:
+    import supabase_db_async
+
+    t0 = time.perf_counter()
+    try:
+        # i watermark sono due query da una riga: ok nel threadpool
+        wm, tomb = await asyncio.to_thread(_watermarks)
+        rows = await supabase_db_async.fetch_all_questions(profile=_bank_profile())
+    except Exception:
+        _count("refresh_errors")
+        raise
+    _set_watermarks(wm, tomb)
+    return _refreshed(rows, t0)
+
+
+def _refreshed(rows: List[Dict[str, Any]], t0: float) -> List[Dict[str, Any]]:
+    ms = (time.perf_counter() - t0) * 1000.0
+    _install(rows, loaded_at=time.monotonic())
+    with _LOCK:
+        _STATS["refreshes"] += 1
+        _STATS["last_refresh_ms"] = round(ms, 1)
+        _STATS["total_refresh_ms"] += ms
+    logger.info("question bank refreshed: %d rows in %.1f ms", len(rows), ms)
+    return _rows()
+
+
+# =========================
+# Delta sync (sql/questions_sync.sql)
+# =========================
+#   QUESTION_BANK_SYNC            "delta" (default) | "full"
+#   QUESTION_BANK_FULL_REFRESH_S  refresh completo di sicurezza (default 21600 = 6h)
+#   QUESTION_BANK_ID_DIFF_S       senza tabella tombstone: ogni quanto confrontare
+#                                 gli id per trovare le cancellazioni (default 3600)
+def _can_delta(now: float) -> bool:
+    return (
+        _delta_enabled()
+        and _STATE["loaded"]
+        and _STATE["watermark"] is not None
+        and (now - _STATE["full_at"]) < _env_s("QUESTION_BANK_FULL_REFRESH_S", 21600.0)
+    )
+
+
+def _sync_delta() -> List[Dict[str, Any]]:
+    t0 = time.perf_counter()
+    now = time.monotonic()
+    since = _STATE["watermark"]
+    new_wm = supabase_db.fetch_questions_watermark() or since
+    changed: List[Dict[str, Any]] = []
+    if new_wm != since:
+        changed = supabase_db.fetch_questions_changed_since(since, profile=_bank_profile())
+
+    deleted: List[str] = []
+    tomb = _STATE["tomb_watermark"]
+    id_diff = False
+    if _STATE["tombstones"]:
+        new_tomb = supabase_db.fetch_tombstones_watermark() or tomb
+        if new_tomb and new_tomb != tomb:
+            deleted = supabase_db.fetch_question_tombstones_since(tomb)
+        tomb = new_tomb
+    elif (now - _STATE["id_diff_at"]) >= _env_s("QUESTION_BANK_ID_DIFF_S", 3600.0):
+        live = set(supabase_db.fetch_question_ids())
+        deleted = [qid for qid in list(_STATE["by_id"].keys()) if qid not in live]
+        id_diff = True
+
+    # una riga ricreata dopo il tombstone vince sulla cancellazione
+    changed_ids = {str(r.get("id")) for r in changed}
+    deleted = [qid for qid in deleted if str(qid) not in changed_ids]
+    _apply_changes(changed, deleted)
+
+    ms = (time.perf_counter() - t0) * 1000.0
+    with _LOCK:
+        _STATE["watermark"] = new_wm
+        _STATE["tomb_watermark"] = tomb
+        _STATE["loaded_at"] = now
+        if id_diff:
+            _STATE["id_diff_at"] = now
+            _STATS["id_diffs"] += 1
+        _STATS["delta_syncs"] += 1
+        _STATS["delta_upserts"] += len(changed)
+        _STATS["delta_deletes"] += len(deleted)
+        _STATS["last_delta_ms"] = round(ms, 1)
+    logger.debug("question bank delta: %d changed, %d deleted in %.1f ms", len(changed), len(deleted), ms)
+    return _rows()
+
+
+def _delta_or_none() -> Optional[List[Dict[str, Any]]]:
+    if not _can_delta(time.monotonic()):
+        return None
+    try:
+        return _sync_delta()
+    except Exception as e:
+        _count("delta_errors")
+        logger.warning("question bank delta sync failed, doing a full refresh: %s", e)
+        return None
+
+
+def get_bank(force_refresh: bool = False) -> List[Dict[str, Any]]:
+    """Return the cached question bank, syncing it when the TTL expired."""
+    if not force_refresh and _is_fresh(time.monotonic()):
+        _count("hits")
+        return _rows()
+
+    with _REFRESH_LOCK:
+        # un'altra richiesta potrebbe aver appena ricaricato la banca
+        if not force_refresh and _is_fresh(time.monotonic()):
+            _count("hits")
+            return _rows()
+        _count("misses")
+        if not force_refresh:
+            rows = _delta_or_none()
+            if rows is not None:
+                return rows
+        try:
+            return _refresh()
+        except Exception as e:
+            if _STATE["loaded"]:
+                # meglio una banca un po' vecchia che un /start in errore
+                logger.warning("question bank refresh failed, serving stale copy: %s", e)
+                return _rows()
+            raise
+
+
+_AREFRESH_LOCK: Optional[asyncio.Lock] = None
+
+
+async def aget_bank(force_refresh: bool = False) -> List[Dict[str, Any]]:
+    """Async `get_bank()`: the refresh awaits the async client instead of blocking a thread."""
+    global _AREFRESH_LOCK
+    if not force_refresh and _is_fresh(time.monotonic()):
+        _count("hits")
+        return _rows()
+
+    if _AREFRESH_LOCK is None:
+        _AREFRESH_LOCK = asyncio.Lock()
+    async with _AREFRESH_LOCK:
+        if not force_refresh and _is_fresh(time.monotonic()):
+            _count("hits")
+            return _rows()
+        _count("misses")
+        if not force_refresh:
+            # il delta tocca poche righe: qualche ms nel threadpool
+            rows = await asyncio.to_thread(_delta_or_none)
+            if rows is not None:
+                return rows
+        try:
+            return await _arefresh()
+        except Exception as e:
+            if _STATE["loaded"]:
+                logger.warning("question bank refresh failed, serving stale copy: %s", e)
+                return _rows()
+            raise
+
+
+def bank_version() -> int:
+    return int(_STATE["version"])
+
+
+def get_cached_question(qid: str) -> Optional[Dict[str, Any]]:
+    """Lookup by id in the cached bank (no network call)."""
+    return _STATE["by_id"].get(str(qid))
+
+
+def _by_id_max() -> int:
+    try:
+        return max(0, int(os.getenv("QUESTION_BY_ID_CACHE_MAX") or 2000))
+    except Exception:
+        return 2000
+
+
+def get_question(qid: str) -> Optional[Dict[str, Any]]:
+    """Read-through lookup by id: cached bank, then the by-id LRU, then Supabase.
+
+    Anche i "non trovata" restano in cache per il TTL della banca.
+    """
+    key = str(qid)
+    q = _STATE["by_id"].get(key)
+    if q is not None:
+        _count("by_id_hits")
+        return q
+    now = time.monotonic()
+    with _LOCK:
+        ent = _BY_ID.get(key)
+        if ent is not None and (now - ent[0]) < _ttl_s():
+            _BY_ID.move_to_end(key)
+            _STATS["by_id_hits"] += 1
+            return ent[1]
+        _STATS["by_id_misses"] += 1
+    row = supabase_db.fetch_question_by_id(key, profile="grading")
+    with _LOCK:
+        _BY_ID[key] = (now, row)
+        _BY_ID.move_to_end(key)
+        while len(_BY_ID) > _by_id_max():
+            _BY_ID.popitem(last=False)
+    return row
+
+
+# =========================
+# Sessioni compatte: id + versione -> domanda
+# =========================
+def _retired_s() -> float:
+    return _env_s("QUESTION_RETIRED_S", 6 * 3600.0)
+
+
+def _retired_max() -> int:
+    try:
+        return max(0, int(os.getenv("QUESTION_RETIRED_MAX") or 5000))
+    except Exception:
+        return 5000
+
+
+def question_rev(q: Optional[Dict[str, Any]]) -> Optional[str]:
+    """Version of a row (its updated_at), None if the profile does not carry it."""
+    rev = (q or {}).get("updated_at")
+    return str(rev) if rev else None
+
+
+def _retire(old: Dict[str, Any]) -> None:
+    # chiamata con _LOCK già preso
+    rev = question_rev(old)
+    if rev is None or old.get("id") is None:
+        return
+    now = time.monotonic()
+    _RETIRED[(str(old.get("id")), rev)] = (now, old)
+    _RETIRED.move_to_end((str(old.get("id")), rev))
+    while _RETIRED and (len(_RETIRED) > _retired_max() or now - next(iter(_RETIRED.values()))[0] > _retired_s()):
+        _RETIRED.popitem(last=False)
+
+
+def question_refs(rows: List[Dict[str, Any]]) -> Tuple[List[str], Optional[List[Optional[str]]]]:
+    """(ids, revs) to store in a session instead of the question bodies (revs None if unknown)."""
+    qids = [str(q.get("id")) for q in rows]
+    revs = [question_rev(q) for q in rows]
+    return qids, (revs if any(revs) else None)
+
+
+def _unavailable(qid: str) -> Dict[str, Any]:
+    return {"id": qid, "tipo": None, "testo": "Domanda non più disponibile.", "unavailable": True}
+
+
+def resolve(qids: List[str], revs: Optional[List[Optional[str]]] = None) -> List[Dict[str, Any]]:
+    """Question rows (with solutions) for a compact session, in session order.
+
+    Per ogni id: la versione della banca se coincide con quella vista dallo
+    studente, altrimenti la versione superata se ancora in `_RETIRED`,
+    altrimenti la versione corrente (domanda modificata) o, se cancellata, un
+    segnaposto con `unavailable: True` che la correzione non conta.
+    """
+    if not server_side_pick():
+        try:
+            get_bank()
+        except Exception as e:
+            logger.warning("question bank unavailable while resolving a session: %s", e)
+    by_id = _STATE["by_id"]
+    now = time.monotonic()
+    found: Dict[str, Optional[Dict[str, Any]]] = {}
+    missing: List[str] = []
+    with _LOCK:
+        for qid in qids:
+            q = by_id.get(qid)
+            if q is None:
+                ent = _BY_ID.get(qid)
+                if ent is None or (now - ent[0]) >= _ttl_s():
+                    if qid not in found:
+                        found[qid] = None
+                        missing.append(qid)
+                    continue
+                q = ent[1]
+            found[qid] = q
+    if missing:
+        # una sola richiesta per i non in cache (QUESTION_PICK_MODE=db o banca non caricata)
+        try:
+            rows = {str(r.get("id")): r for r in supabase_db.fetch_questions_by_ids(missing, profile="grading")}
+        except Exception as e:
+            logger.warning("fetch of %d session questions failed: %s", len(missing), e)
+            rows = None
+        with _LOCK:
+            for qid in missing:
+                row = rows.get(qid) if rows is not None else None
+                found[qid] = row
+                if rows is not None:
+                    _BY_ID[qid] = (now, row)
+                    _BY_ID.move_to_end(qid)
+            while len(_BY_ID) > _by_id_max():
+                _BY_ID.popitem(last=False)
+
+    out: List[Dict[str, Any]] = []
+    counts = {"resolved": 0, "resolved_retired": 0, "resolved_changed": 0, "resolved_missing": 0}
+    with _LOCK:
+        for i, qid in enumerate(qids):
+            rev = revs[i] if revs and i < len(revs) else None
+            q = found.get(qid)
+            if rev is not None and question_rev(q) != rev:
+                old = _RETIRED.get((qid, rev))
+                if old is not None:
+                    q = old[1]
+                    counts["resolved_retired"] += 1
+                elif q is not None:
+                    counts["resolved_changed"] += 1
+            if q is None:
+                counts["resolved_missing"] += 1
+                q = _unavailable(qid)
+            counts["resolved"] += 1
+            out.append(q)
+        for k, v in counts.items():
+            _STATS[k] += v
+    return out
+
+
+def _forget(qid: str) -> None:
+    with _LOCK:
+        _BY_ID.pop(str(qid), None)
+
+
+def invalidate() -> None:
+    """Force the next `get_bank()` to reload from Supabase."""
+    with _LOCK:
+        _STATE["loaded_at"] = 0.0
+        _STATS["invalidations"] += 1
+
+
+def apply_upsert(row: Optional[Dict[str, Any]]) -> None:
+    """Write-through after insert/update: replace (or add) the row in the cache."""
+    if (row or {}).get("id") is None:
+        invalidate()
+        return
+    _forget(row["id"])
+    if _apply_changes([row], []):
+        _count("write_through")
+
+
+def apply_delete(qid: str) -> None:
+    """Write-through after delete: drop the row from the cache."""
+    _forget(qid)
+    if _apply_changes([], [str(qid)]):
+        _count("write_through")
+
+
+def bank_stats() -> Dict[str, Any]:
+    with _LOCK:
+        out = dict(_STATS)
+        loaded = _STATE["loaded"]
+        out["rows"] = len(_STATE["by_id"]) if loaded else 0
+        out["version"] = _STATE["version"]
+        out["age_s"] = round(time.monotonic() - _STATE["loaded_at"], 1) if loaded else None
+        out["full_age_s"] = round(time.monotonic() - _STATE["full_at"], 1) if loaded else None
+        out["watermark"] = _STATE["watermark"]
+        out["tombstones"] = _STATE["tombstones"]
+        out["by_id_cached"] = len(_BY_ID)
+        out["retired"] = len(_RETIRED)
+    out["ttl_s"] = _ttl_s()
+    out["sync"] = "delta" if _delta_enabled() else "full"
+    refreshes = out["refreshes"] or 0
+    out["avg_refresh_ms"] = round(out["total_refresh_ms"] / refreshes, 1) if refreshes else None
+    out["total_refresh_ms"] = round(out["total_refresh_ms"], 1)
+    return out
+
+
+# =========================
+# Normalizzazione (una volta per domanda, al build dell'indice)
+# =========================
+_TIPO_ALIASES = {
+    "scelta": "scelta", "multiple": "scelta", "multipla": "scelta",
+    "scelta multipla": "scelta", "mcq": "scelta", "quiz": "scelta",
+    "completamento": "completamento", "aperta": "completamento", "open": "completamento",
+    "testo": "completamento", "risposta": "completamento", "libera": "completamento",
+}
+
+
+def norm_key(s: Any) -> str:
+    return str(s or "").strip().lower()
+
+
+def canonical_tipo(q: Dict[str, Any]) -> str:
+    """'scelta' | 'completamento' | '' (sconosciuto). Accetta alias e campi legacy."""
+    t = norm_key(q.get("tipo") or q.get("type") or q.get("question_type"))
+    if t in _TIPO_ALIASES:
+        return _TIPO_ALIASES[t]
+    if "comp" in t or "fill" in t:
+        return "completamento"
+    # tipo mancante: inferisci dai campi
+    opzioni = q.get("opzioni")
+    if isinstance(opzioni, list) and opzioni:
+        return "scelta"
+    if q.get("risposte") or q.get("risposta"):
+        return "completamento"
+    return ""
+
+
+def question_tags(q: Dict[str, Any]) -> List[str]:
+    """Tag normalizzati: supporta sia "tag" che "tags", lista o stringa separata da virgole."""
+    out: List[str] = []
+    for field in ("tag", "tags"):
+        raw = q.get(field)
+        if isinstance(raw, str):
+            raw = raw.split(",")
+        if not isinstance(raw, list):
+            continue
+        for x in raw:
+            t = norm_key(x)
+            if t and t not in out:
+                out.append(t)
+    return out
+
+
+# =========================
+# Indice multi-chiave
+# =========================
+_Key = Tuple[str, str, str]  # (materia, tipo, difficolta) normalizzati
+
+
+def _bucket_key(q: Dict[str, Any]) -> _Key:
+    return (norm_key(q.get("materia")), canonical_tipo(q), norm_key(q.get("difficolta")))
+
+
+class BankIndex:
+    """Read-only index over one version of the bank."""
+
+    def __init__(self, rows: Iterable[Dict[str, Any]], version: int = 0):
+        self.version = version
+        self._buckets: Dict[_Key, List[Dict[str, Any]]] = {}
+        self._postings: Dict[_Key, Dict[str, List[Dict[str, Any]]]] = {}
+        self._difficolta: Dict[Tuple[str, str], List[str]] = {}
+        for q in rows:
+            self._add(q)
+
+    def _add(self, q: Dict[str, Any]) -> None:
+        key = _bucket_key(q)
+        materia, tipo, dif = key
+        self._buckets.setdefault(key, []).append(q)
+        postings = self._postings.setdefault(key, {})
+        for t in question_tags(q):
+            postings.setdefault(t, []).append(q)
+        difs = self._difficolta.setdefault((materia, tipo), [])
+        if dif not in difs:
+            difs.append(dif)
+
+    def derive(self, removed: List[Dict[str, Any]], added: List[Dict[str, Any]], version: int) -> "BankIndex":
+        """New index with `removed` dropped and `added` inserted.
+
+        Copia solo i bucket toccati: chi sta già usando l'indice corrente non vede cambi.
+        """
+        new = BankIndex((), version)
+        new._buckets = dict(self._buckets)
+        new._postings = dict(self._postings)
+        new._difficolta = {k: list(v) for k, v in self._difficolta.items()}
+        copied = set()
+
+        def _own(key: _Key) -> None:
+            if key in copied:
+                return
+            copied.add(key)
+            new._buckets[key] = list(new._buckets.get(key, ()))
+            new._postings[key] = {t: list(v) for t, v in (new._postings.get(key) or {}).items()}
+
+        drop = {id(q) for q in removed}
+        for q in removed:
+            _own(_bucket_key(q))
+        for key in list(copied):
+            new._buckets[key] = [q for q in new._buckets[key] if id(q) not in drop]
+            new._postings[key] = {t: [q for q in v if id(q) not in drop] for t, v in new._postings[key].items()}
+        for q in added:
+            _own(_bucket_key(q))
+            new._add(q)
+        return new
+
+    def _keys(self, materia: str, tipo: str, difficolta: Optional[str]) -> List[_Key]:
+        m, t = norm_key(materia), norm_key(tipo)
+        t = _TIPO_ALIASES.get(t, t)
+        if difficolta is None or not norm_key(difficolta):
+            return [(m, t, d) for d in self._difficolta.get((m, t), [])]
+        # le domande senza difficoltà valgono per qualsiasi difficoltà richiesta
+        d = norm_key(difficolta)
+        return [(m, t, d)] + ([(m, t, "")] if d else [])
+
+    def _tagged(self, keys: List[_Key], tags: List[str]) -> List[Dict[str, Any]]:
+        seen = set()
+        out: List[Dict[str, Any]] = []
+        for key in keys:
+            postings = self._postings.get(key) or {}
+            for t in tags:
+                for q in postings.get(t, ()):
+                    if id(q) in seen:
+                        continue
+                    seen.add(id(q))
+                    out.append(q)
+        return out
+
+    def count(self, materia: str, tipo: str,
+              tags: Optional[List[str]] = None,
+              difficolta: Optional[str] = None) -> int:
+        keys = self._keys(materia, tipo, difficolta)
+        wanted = [norm_key(t) for t in (tags or []) if norm_key(t)]
+        if wanted:
+            return len(self._tagged(keys, wanted))
+        return sum(len(self._buckets.get(k, ())) for k in keys)
+
+    def pick(self, materia: str, tipo: str, n: int,
+             tags: Optional[List[str]] = None,
+             difficolta: Optional[str] = None,
+             rng: Optional[random.Random] = None) -> List[Dict[str, Any]]:
+        """Random sample (no duplicates) of up to n matching questions."""
+        if n <= 0:
+            return []
+        rng = rng or random
+        keys = self._keys(materia, tipo, difficolta)
+        wanted = [norm_key(t) for t in (tags or []) if norm_key(t)]
+        if wanted:
+            pool = self._tagged(keys, wanted)
+            return rng.sample(pool, min(n, len(pool)))
+
+        # senza tag: campiona indici sui bucket senza concatenarli
+        buckets = [self._buckets[k] for k in keys if self._buckets.get(k)]
+        total = sum(len(b) for b in buckets)
+        out: List[Dict[str, Any]] = []
+        for i in rng.sample(range(total), min(n, total)):
+            for b in buckets:
+                if i < len(b):
+                    out.append(b[i])
+                    break
+                i -= len(b)
+        return out
+
+
+_INDEX: Optional[BankIndex] = None
+_INDEX_LOCK = threading.Lock()
+
+
+def get_index() -> BankIndex:
+    """Index for the current bank version (rebuilt only when the bank changes)."""
+    get_bank()
+    return _current_index()
+
+
+async def aget_index() -> BankIndex:
+    await aget_bank()
+    return _current_index()
+
+
+def _current_index() -> BankIndex:
+    global _INDEX
+    with _LOCK:
+        version = _STATE["version"]
+        rows = _STATE["rows"]
+        if rows is None:
+            rows = _STATE["rows"] = list(_STATE["by_id"].values())
+    idx = _INDEX
+    if idx is not None and idx.version == version:
+        return idx
+    with _INDEX_LOCK:
+        if _INDEX is None or _INDEX.version != version:
+            t0 = time.perf_counter()
+            _INDEX = BankIndex(rows, version)
+            logger.debug("bank index v%d built in %.1f ms", version, (time.perf_counter() - t0) * 1000.0)
+        return _INDEX
+
+
+def _pick_mode() -> str:
+    # "index" (default): indice in memoria | "db": RPC pick_questions su Supabase
+    return norm_key(os.getenv("QUESTION_PICK_MODE") or "index")
+
+
+def server_side_pick() -> bool:
+    return _pick_mode() == "db"
+
+
+def pick(materia: str, tipo: str, n: int,
+         tags: Optional[List[str]] = None,
+         difficolta: Optional[str] = None,
+         rng: Optional[random.Random] = None,
+         profile: str = "grading") -> List[Dict[str, Any]]:
+    # profile: colonne del picker lato server (l'indice restituisce le righe della banca)
+    if server_side_pick():
+        canon = _TIPO_ALIASES.get(norm_key(tipo), norm_key(tipo))
+        try:
+            return supabase_db.pick_questions(materia, canon, n, tags=tags, difficolta=difficolta, profile=profile)
+        except Exception as e:
+            # funzione SQL non installata / errore rete: ripiega sull'indice locale
+            logger.warning("server-side pick failed, falling back to bank index: %s", e)
+    return get_index().pick(materia, tipo, n, tags=tags, difficolta=difficolta, rng=rng)
+
+
+def count(materia: str, tipo: str,
+          tags: Optional[List[str]] = None,
+          difficolta: Optional[str] = None) -> int:
+    if server_side_pick():
+        canon = _TIPO_ALIASES.get(norm_key(tipo), norm_key(tipo))
+        try:
+            return supabase_db.count_questions(materia, canon, tags=tags, difficolta=difficolta)
+        except Exception as e:
+            logger.warning("server-side count failed, falling back to bank index: %s", e)
+    return get_index().count(materia, tipo, tags=tags, difficolta=difficolta)
+
+
+async def apick(materia: str, tipo: str, n: int,
+                tags: Optional[List[str]] = None,
+                difficolta: Optional[str] = None,
+                rng: Optional[random.Random] = None,
+                profile: str = "grading") -> List[Dict[str, Any]]:
+    if server_side_pick():
+        import supabase_db_async
+
+        canon = _TIPO_ALIASES.get(norm_key(tipo), norm_key(tipo))
+        try:
+            return await supabase_db_async.pick_questions(materia, canon, n, tags=tags, difficolta=difficolta,
+                                                          profile=profile)
+        except Exception as e:
+            logger.warning("server-side pick failed, falling back to bank index: %s", e)
+    idx = await aget_index()
+    return idx.pick(materia, tipo, n, tags=tags, difficolta=difficolta, rng=rng)
+
+
+async def acount(materia: str, tipo: str,
+                 tags: Optional[List[str]] = None,
+                 difficolta: Optional[str] = None) -> int:
+    if server_side_pick():
+        import supabase_db_async
+
+        canon = _TIPO_ALIASES.get(norm_key(tipo), norm_key(tipo))
+        try:
+            return await supabase_db_async.count_questions(materia, canon, tags=tags, difficolta=difficolta)
+        except Exception as e:
+            logger.warning("server-side count failed, falling back to bank index: %s", e)
+    idx = await aget_index()
+    return idx.count(materia, tipo, tags=tags, difficolta=difficolta)
@@ -0,0 +1,538 @@
+"""Segnalazioni domande: log append-only + vista materializzata in memoria.
+
+File in data/:
+- reports.json        snapshot (lista, dalla più recente; stesso formato di prima)
+- reports.log.jsonl   eventi successivi allo snapshot, uno per riga:
+                      {"op": "create", "rec": {...}} | {"op": "update", "id": ..., "fields": {...}}
+
+Ogni scrittura appende una riga al log e aggiorna la vista: O(1), qualunque sia
+il numero di segnalazioni. La vista si ricostruisce al primo accesso (snapshot +
+replay del log). La compattazione (thread `reports-compactor`, ogni
+REPORTS_COMPACT_S secondi o appena il log supera REPORTS_COMPACT_EVERY eventi)
+ruota il log, riscrive lo snapshot e cancella il log ruotato. Il replay è
+idempotente, quindi un crash a metà compattazione non perde né duplica nulla.
+
+Più worker: append e compattazione passano da storage.file_lock (reports.lock).
+Prima di ogni lettura/scrittura _sync() confronta snapshot e log con quanto già
+applicato: rigioca solo la coda del log scritta dagli altri processi e ricarica
+tutto se un altro processo ha compattato.
+
+Indici secondari della vista: per ogni chiave ("all", "status:<s>",
+"materia:<m>", "qid:<id>", "email:<e>") una lista ordinata di
+(created_at, id). query() parte dall'indice più selettivo, salta al cursore
+con bisect e scorre dal più recente: una pagina costa O(log n + pagina).
+
+Aggregato per domanda (by_question), aggiornato in _apply: segnalazioni aperte
+e totali, prima/ultima segnalazione, segnalatori distinti e snapshot più
+recente. triage_queue() ne estrae le domande con più segnalazioni aperte.
+"""
+
+from __future__ import annotations
+
+import bisect
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from storage import DATA_DIR, file_lock
+
+logger = logging.getLogger("dinomed.reports")
+
+SNAPSHOT_FILE = DATA_DIR / "reports.json"
+LOG_FILE = DATA_DIR / "reports.log.jsonl"
+ROTATED_LOG_FILE = DATA_DIR / "reports.log.jsonl.compacting"
+LOCK_FILE = DATA_DIR / "reports.lock"
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name) or default)
+    except Exception:
+        return default
+
+
+_LOCK = threading.RLock()
+_COMPACT_LOCK = threading.Lock()
+_WAKE = threading.Event()
+
+_STATE: Dict[str, Any] = {
+    "loaded": False,
+    "by_id": {},          # id -> record, ordine di creazione (dal più vecchio)
+    "index": {},          # chiave indice -> [(created_at, id), ...] ordinata
+    "by_question": {},    # question id -> aggregato (vedi _agg_add)
+    "log_events": 0,      # eventi nel log corrente (non ancora nello snapshot)
+    "snap_stamp": None,   # (mtime_ns, size) dello snapshot caricato
+    "log_ino": None,      # inode del log corrente già letto
+    "log_pos": 0,         # byte del log corrente già applicati
+}
+
+_STATS: Dict[str, Any] = {
+    "appends": 0,
+    "compactions": 0,
+    "compaction_errors": 0,
+    "last_compaction_ms": 0.0,
+    "last_compaction_at": None,
+    "load_ms": 0.0,
+    "tail_replays": 0,
+}
+
+
+# =========================
+# Vista in memoria
+# =========================
+def _norm(s: Any) -> str:
+    return str(s or "").strip().lower()
+
+
+def _index_keys(rec: Dict[str, Any]) -> List[str]:
+    q = rec.get("question") or {}
+    keys = ["all", f"status:{rec.get('status') or ''}", f"email:{str(rec.get('email') or '').strip()}"]
+    if _norm(q.get("materia")):
+        keys.append(f"materia:{_norm(q.get('materia'))}")
+    if q.get("id") is not None:
+        keys.append(f"qid:{q.get('id')}")
+    return keys
+
+
+def _sort_key(rec: Dict[str, Any]) -> Tuple[str, str]:
+    return (str(rec.get("created_at") or ""), str(rec["id"]))
+
+
+def _index_add(rec: Dict[str, Any]) -> None:
+    k = _sort_key(rec)
+    index = _STATE["index"]
+    for name in _index_keys(rec):
+        lst = index.setdefault(name, [])
+        if not lst or lst[-1] < k:
+            lst.append(k)   # caso tipico: la segnalazione più recente
+        else:
+            bisect.insort(lst, k)
+
+
+def _index_remove(rec: Dict[str, Any]) -> None:
+    k = _sort_key(rec)
+    index = _STATE["index"]
+    for name in _index_keys(rec):
+        lst = index.get(name)
+        if not lst:
+            continue
+        i = bisect.bisect_left(lst, k)
+        if i < len(lst) and lst[i] == k:
+            del lst[i]
+        if not lst:
+            index.pop(name, None)
+
+
+OPEN_STATUSES = ("open", "in_review")
+
+
+def _qid(rec: Dict[str, Any]) -> Optional[str]:
+    q = rec.get("question") or {}
+    return str(q.get("id")) if q.get("id") is not None else None
+
+
+def _agg_add(rec: Dict[str, Any], sign: int) -> None:
+    qid = _qid(rec)
+    if qid is None:
+        return
+    by_q = _STATE["by_question"]
+    agg = by_q.get(qid)
+    if agg is None:
+        if sign < 0:
+            return
+        agg = by_q[qid] = {
+            "question_id": qid,
+            "open": 0,
+            "total": 0,
+            "first_seen": None,
+            "last_seen": None,
+            "reporters": {},   # email -> n segnalazioni
+            "question": None,
+        }
+    is_open = (rec.get("status") or "open") in OPEN_STATUSES
+    agg["open"] += sign if is_open else 0
+    agg["total"] += sign
+    email = str(rec.get("email") or "").strip()
+    if email:
+        n = agg["reporters"].get(email, 0) + sign
+        if n > 0:
+            agg["reporters"][email] = n
+        else:
+            agg["reporters"].pop(email, None)
+    if sign > 0:
+        ts = str(rec.get("created_at") or "")
+        if agg["first_seen"] is None or ts < agg["first_seen"]:
+            agg["first_seen"] = ts
+        if agg["last_seen"] is None or ts >= agg["last_seen"]:
+            agg["last_seen"] = ts
+            agg["question"] = rec.get("question")
+    if agg["total"] <= 0:
+        by_q.pop(qid, None)
+
+
+def _apply(ev: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    by_id = _STATE["by_id"]
+    op = ev.get("op")
+    if op == "create":
+        rec = dict(ev.get("rec") or {})
+        if not rec.get("id"):
+            return None
+        old = by_id.get(str(rec["id"]))
+        if old is not None:
+            _index_remove(old)
+            _agg_add(old, -1)
+        by_id[str(rec["id"])] = rec
+        _index_add(rec)
+        _agg_add(rec, +1)
+        return rec
+    if op == "update":
+        rec = by_id.get(str(ev.get("id")))
+        if rec is None:
+            return None
+        _index_remove(rec)
+        _agg_add(rec, -1)
+        rec.update(ev.get("fields") or {})
+        _index_add(rec)
+        _agg_add(rec, +1)
+        return rec
+    return None
+
+
+def _replay(path) -> int:
+    if not path.exists():
+        return 0
+    n = 0
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                ev = json.loads(line)
+            except Exception:
+                # riga troncata (crash durante l'append): si salta
+                logger.warning("reports: riga di log non valida in %s", path)
+                continue
+            _apply(ev)
+            n += 1
+    return n
+
+
+def _snap_stamp() -> Optional[Tuple[int, int]]:
+    try:
+        st = SNAPSHOT_FILE.stat()
+        return (st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        return None
+
+
+def _log_stat() -> Optional[Tuple[int, int]]:
+    try:
+        st = LOG_FILE.stat()
+        return (st.st_ino, st.st_size)
+    except FileNotFoundError:
+        return None
+
+
+def _replay_tail() -> int:
+    """Apply the log lines after log_pos (complete lines only)."""
+    try:
+        with open(LOG_FILE, "rb") as f:
+            f.seek(_STATE["log_pos"])
+            chunk = f.read()
+    except FileNotFoundError:
+        return 0
+    # un append in corso in un altro worker si legge al giro dopo
+    end = chunk.rfind(b"\n") + 1
+    n = 0
+    for line in chunk[:end].splitlines():
+        if not line.strip():
+            continue
+        try:
+            ev = json.loads(line)
+        except Exception:
+            logger.warning("reports: riga di log non valida in %s", LOG_FILE)
+            continue
+        _apply(ev)
+        n += 1
+    _STATE["log_pos"] += end
+    return n
+
+
+def _load_all(snap: Optional[Tuple[int, int]], log: Optional[Tuple[int, int]]) -> None:
+    t0 = time.perf_counter()
+    _STATE["by_id"] = {}
+    _STATE["index"] = {}
+    _STATE["by_question"] = {}
+    if SNAPSHOT_FILE.exists():
+        try:
+            data = json.loads(SNAPSHOT_FILE.read_text(encoding="utf-8") or "[]")
+        except Exception as e:
+            logger.error("reports: snapshot illeggibile (%s)", e)
+            data = []
+        # snapshot dalla più recente: si inserisce dalla più vecchia
+        for rec in reversed(data if isinstance(data, list) else []):
+            if isinstance(rec, dict):
+                _apply({"op": "create", "rec": rec})
+    _replay(ROTATED_LOG_FILE)
+    _STATE["snap_stamp"] = snap
+    _STATE["log_ino"] = log[0] if log else None
+    _STATE["log_pos"] = 0
+    _STATE["log_events"] = _replay_tail() if log else 0
+    _STATE["loaded"] = True
+    _STATS["load_ms"] = round((time.perf_counter() - t0) * 1000.0, 1)
+
+
+def _sync() -> None:
+    """Bring the view up to date with snapshot + log (other workers write them too)."""
+    with _LOCK:
+        snap = _snap_stamp()
+        log = _log_stat()
+        if _STATE["loaded"] and snap == _STATE["snap_stamp"]:
+            if log is None and _STATE["log_ino"] is None:
+                return
+            if log is not None and _STATE["log_ino"] is None and _STATE["log_pos"] == 0:
+                _STATE["log_ino"] = log[0]  # log creato da un altro worker
+            if log is not None and log[0] == _STATE["log_ino"] and log[1] >= _STATE["log_pos"]:
+                if log[1] > _STATE["log_pos"]:
+                    _STATE["log_events"] += _replay_tail()
+                    _STATS["tail_replays"] += 1
+                return
+        # primo accesso o compattazione di un altro worker: ricarica completa
+        _load_all(snap, log)
+
+
+def _append(ev: Dict[str, Any]) -> None:
+    """Append one event (caller holds _LOCK + file_lock and has just run _sync)."""
+    DATA_DIR.mkdir(parents=True, exist_ok=True)
+    line = (json.dumps(ev, ensure_ascii=False) + "\n").encode("utf-8")
+    with open(LOG_FILE, "ab") as f:
+        f.write(line)
+        f.flush()
+        st = os.fstat(f.fileno())
+    _STATE["log_ino"], _STATE["log_pos"] = st.st_ino, st.st_size
+    _STATE["log_events"] += 1
+    _STATS["appends"] += 1
+    if _STATE["log_events"] >= _env_int("REPORTS_COMPACT_EVERY", 1000):
+        _WAKE.set()
+
+
+# =========================
+# API
+# =========================
+def create(rec: Dict[str, Any]) -> Dict[str, Any]:
+    with _LOCK, file_lock(LOCK_FILE):
+        _sync()
+        _append({"op": "create", "rec": rec})
+        return dict(_apply({"op": "create", "rec": rec}) or rec)
+
+
+def update(report_id: str, fields: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Apply `fields` to a report; None if it does not exist."""
+    with _LOCK, file_lock(LOCK_FILE):
+        _sync()
+        if str(report_id) not in _STATE["by_id"]:
+            return None
+        ev = {"op": "update", "id": str(report_id), "fields": fields}
+        _append(ev)
+        rec = _apply(ev)
+        return dict(rec) if rec is not None else None
+
+
+def get(report_id: str) -> Optional[Dict[str, Any]]:
+    _sync()
+    with _LOCK:
+        rec = _STATE["by_id"].get(str(report_id))
+        return dict(rec) if rec is not None else None
+
+
+def list_by_email(email: str) -> List[Dict[str, Any]]:
+    """Reports of one user, newest first."""
+    _sync()
+    with _LOCK:
+        keys = _STATE["index"].get(f"email:{str(email or '').strip()}", [])
+        return [dict(_STATE["by_id"][rid]) for _, rid in reversed(keys)]
+
+
+def query(status: Optional[str] = None,
+          materia: Optional[str] = None,
+          question_id: Optional[str] = None,
+          date_from: Optional[str] = None,
+          date_to: Optional[str] = None,
+          limit: int = 50,
+          cursor: Optional[Tuple[str, str]] = None) -> Tuple[List[Dict[str, Any]], Optional[Tuple[str, str]]]:
+    """Newest-first page of reports matching every filter.
+
+    `cursor` is the (created_at, id) of the last item of the previous page.
+    Returns (items, next_cursor); next_cursor is None on the last page.
+    """
+    _sync()
+    wanted = []
+    if status:
+        wanted.append(f"status:{status}")
+    if materia and _norm(materia):
+        wanted.append(f"materia:{_norm(materia)}")
+    if question_id:
+        wanted.append(f"qid:{question_id}")
+    limit = max(1, int(limit))
+
+    with _LOCK:
+        index = _STATE["index"]
+        if any(name not in index for name in wanted):
+            return [], None
+        lists = [index[name] for name in wanted] or [index.get("all", [])]
+        base = min(lists, key=len)
+        by_id = _STATE["by_id"]
+
+        # posizione di partenza: prima del cursore e non oltre date_to (lex ISO)
+        hi = len(base)
+        if cursor is not None:
+            hi = bisect.bisect_left(base, (str(cursor[0]), str(cursor[1])))
+        if date_to:
+            hi = min(hi, bisect.bisect_right(base, (date_to.strip(), "\uffff")))
+        df = date_from.strip() if date_from else None
+
+        out: List[Dict[str, Any]] = []
+        i = hi - 1
+        while i >= 0 and len(out) <= limit:
+            k = base[i]
+            if df is not None and k[0] < df:
+                break
+            # gli altri filtri si verificano sul record (niente intersezioni di liste)
+            if len(wanted) < 2 or all(name in _index_keys(by_id[k[1]]) for name in wanted):
+                out.append(k)
+            i -= 1
+
+        next_cursor = None
+        if len(out) > limit:
+            out = out[:limit]
+            next_cursor = out[-1]
+        return [dict(by_id[rid]) for _, rid in out], next_cursor
+
+
+def status_counts() -> Dict[str, int]:
+    _sync()
+    with _LOCK:
+        return {name.split(":", 1)[1]: len(lst) for name, lst in _STATE["index"].items()
+                if name.startswith("status:")}
+
+
+def _agg_out(agg: Dict[str, Any]) -> Dict[str, Any]:
+    out = {k: v for k, v in agg.items() if k != "reporters"}
+    out["reporters"] = len(agg["reporters"])
+    return out
+
+
+def triage_queue(limit: int = 50,
+                 materia: Optional[str] = None,
+                 include_closed: bool = False) -> List[Dict[str, Any]]:
+    """Questions ordered by open reports, then distinct reporters, then most recent."""
+    _sync()
+    m = _norm(materia) if materia else ""
+    with _LOCK:
+        aggs = [
+            a for a in _STATE["by_question"].values()
+            if (include_closed or a["open"] > 0)
+            and (not m or _norm((a.get("question") or {}).get("materia")) == m)
+        ]
+        top = heapq.nlargest(
+            max(1, int(limit)), aggs,
+            key=lambda a: (a["open"], len(a["reporters"]), a["last_seen"] or ""),
+        )
+        return [_agg_out(a) for a in top]
+
+
+def question_summary(question_id: str) -> Optional[Dict[str, Any]]:
+    _sync()
+    with _LOCK:
+        agg = _STATE["by_question"].get(str(question_id))
+        return _agg_out(agg) if agg is not None else None
+
+
+def all_reports() -> List[Dict[str, Any]]:
+    _sync()
+    with _LOCK:
+        return [dict(r) for r in _STATE["by_id"].values()]
+
+
+# =========================
+# Compattazione
+# =========================
+def compact() -> Dict[str, Any]:
+    """Write a fresh snapshot and drop the log events it covers."""
+    with _COMPACT_LOCK, _LOCK, file_lock(LOCK_FILE):
+        # prima gli eventi degli altri worker: lo snapshot deve contenerli tutti
+        _sync()
+        _WAKE.clear()
+        if not LOG_FILE.exists() and not ROTATED_LOG_FILE.exists():
+            # già compattato (anche da un altro worker)
+            _STATE["log_events"] = 0
+            return {"reports": len(_STATE["by_id"]), "events": 0, "ms": 0.0}
+        t0 = time.perf_counter()
+        if LOG_FILE.exists():
+            if ROTATED_LOG_FILE.exists():
+                # compattazione precedente fallita: accoda al log ruotato
+                with open(ROTATED_LOG_FILE, "a", encoding="utf-8") as dst:
+                    dst.write(LOG_FILE.read_text(encoding="utf-8"))
+                LOG_FILE.unlink()
+            else:
+                os.replace(LOG_FILE, ROTATED_LOG_FILE)
+        items = [dict(r) for r in _STATE["by_id"].values()]
+        events = _STATE["log_events"]
+
+        items.reverse()  # snapshot dalla più recente, come reports.json
+        tmp = SNAPSHOT_FILE.with_suffix(".json.tmp")
+        tmp.write_text(json.dumps(items, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, SNAPSHOT_FILE)
+        if ROTATED_LOG_FILE.exists():
+            ROTATED_LOG_FILE.unlink()
+        # la vista coincide con il nuovo snapshot: niente ricarica al prossimo _sync
+        _STATE["snap_stamp"] = _snap_stamp()
+        _STATE["log_ino"], _STATE["log_pos"], _STATE["log_events"] = None, 0, 0
+
+        ms = (time.perf_counter() - t0) * 1000.0
+        _STATS["compactions"] += 1
+        _STATS["last_compaction_ms"] = round(ms, 1)
+        _STATS["last_compaction_at"] = time.time()
+        logger.info("reports: snapshot di %d segnalazioni (%d eventi compattati, %.1f ms)", len(items), events, ms)
+        return {"reports": len(items), "events": events, "ms": round(ms, 1)}
+
+
+def _compactor_loop() -> None:
+    while True:
+        _WAKE.wait(timeout=max(5, _env_int("REPORTS_COMPACT_S", 600)))
+        try:
+            _sync()  # conta anche gli eventi appesi dagli altri worker
+            if _STATE["log_events"] > 0 or ROTATED_LOG_FILE.exists():
+                compact()
+        except Exception as e:
+            _STATS["compaction_errors"] += 1
+            logger.error("reports: compattazione fallita: %s", e)
+            time.sleep(5)
+
+
+_COMPACTOR: Optional[threading.Thread] = None
+
+
+def start_compactor() -> threading.Thread:
+    """Load the view and start the periodic compaction thread (once per process)."""
+    global _COMPACTOR
+    _sync()
+    if _COMPACTOR is None or not _COMPACTOR.is_alive():
+        _COMPACTOR = threading.Thread(target=_compactor_loop, name="reports-compactor", daemon=True)
+        _COMPACTOR.start()
+    return _COMPACTOR
+
+
+def reports_stats() -> Dict[str, Any]:
+    with _LOCK:
+        out = dict(_STATS)
+        out["reports"] = len(_STATE["by_id"])
+        out["questions"] = len(_STATE["by_question"])
+        out["log_events"] = _STATE["log_events"]
+        out["loaded"] = _STATE["loaded"]
+    return out
@@ -1,12 +1,13 @@
 from __future__ import annotations
 
 import os
-import json
 import random
 import time
 from pathlib import Path
 
-from supabase_db import fetch_all_questions
+import question_bank
+import runs_store
+import storage
 from typing import Any, Dict, List, Optional
 
 from fastapi import APIRouter, HTTPException, Request, Depends
@@ -17,11 +18,9 @@ router = APIRouter(prefix="/api/bot", tags=["bot-api"])
 
 BASE_DIR = Path(__file__).resolve().parents[1]  # backend/
 DATA_DIR = BASE_DIR / "data"
-DISPENSE_FILE = DATA_DIR / "dispense.json"
 DOMANDE_FILE = DATA_DIR / "domande.json"
-RUNS_FILE = DATA_DIR / "user_runs.json"
-INVITES_FILE = DATA_DIR / "bot_invites.json"  # {token: {email, expires_at, used, used_by}}
-LINKS_FILE = DATA_DIR / "bot_links.json"      # {telegram_id: {email, linked_at}}
+# storage.bot_invites(): {token: {email, expires_at, used, used_by}}
+# storage.bot_links():   {telegram_id: {email, linked_at}}
 
 
 
@@ -48,16 +47,6 @@ def bot_key_required(request: Request):
     return True
 
 
-def _read_json_list(path: Path) -> List[Dict[str, Any]]:
-    try:
-        if not path.exists():
-            return []
-        data = json.loads(path.read_text(encoding="utf-8") or "[]")
-        return data if isinstance(data, list) else []
-    except Exception:
-        return []
-
-
 def _abs_url(request: Request, maybe_path: Optional[str]) -> Optional[str]:
     if not maybe_path:
         return None
@@ -89,9 +78,8 @@ def bot_list_materials(
     limit: int = 10,
     _=Depends(bot_key_required),
 ):
-    items = _read_json_list(DISPENSE_FILE)
     # only published
-    published = [x for x in items if x.get("pubblicata") is True]
+    published = storage.dispense().query({"pubblicata": True})
     # newest first if created_at exists
     published.sort(key=lambda x: str(x.get("created_at") or ""), reverse=True)
 
@@ -122,20 +110,19 @@ def bot_get_material(
     material_id: str,
     _=Depends(bot_key_required),
 ):
-    items = _read_json_list(DISPENSE_FILE)
-    for x in items:
-        if str(x.get("id")) == str(material_id) and x.get("pubblicata") is True:
-            return {
-                "id": x.get("id"),
-                "title": x.get("titolo") or x.get("title") or "Dispensa",
-                "description": x.get("descrizione") or "",
-                "pdf_url": _abs_url(request, x.get("link") or x.get("file_url") or x.get("pdf_url")),
-                "meta": {
-                    "materia": x.get("materia") or "",
-                    "pagine": x.get("pagine"),
-                    "tag": x.get("tag") or [],
-                }
+    x = storage.dispense().get(str(material_id))
+    if x is not None and x.get("pubblicata") is True:
+        return {
+            "id": x.get("id"),
+            "title": x.get("titolo") or x.get("title") or "Dispensa",
+            "description": x.get("descrizione") or "",
+            "pdf_url": _abs_url(request, x.get("link") or x.get("file_url") or x.get("pdf_url")),
+            "meta": {
+                "materia": x.get("materia") or "",
+                "pagine": x.get("pagine"),
+                "tag": x.get("tag") or [],
             }
+        }
     raise HTTPException(status_code=404, detail="Material not found")
 
 
@@ -172,22 +159,12 @@ def _norm_type(q: dict) -> str:
         return "completamento"
     return "scelta"
 
-def _matches_tags(q: dict, tags: List[str]) -> bool:
-    if not tags:
-        return True
-    qt = [str(x).strip().lower() for x in (q.get("tag") or []) if str(x).strip()]
-    want = set([str(x).strip().lower() for x in tags if str(x).strip()])
-    return any(t in want for t in qt)
-
 @router.post("/questions/pick")
 def bot_pick_questions(body: PickBody, _=Depends(bot_key_required)):
-    if body.seed is not None:
-        random.seed(int(body.seed))
+    # seed locale: non tocca il generatore globale condiviso dalle altre richieste
+    rng = random.Random(int(body.seed)) if body.seed is not None else None
 
-    # Banca domande da Supabase (fonte unica)
-    bank = fetch_all_questions()
-
-    # organize by subject and type
+    # organize by subject and type (indice sulla banca Supabase in cache)
     out: List[Dict[str, Any]] = []
 
     order = body.order or [sec.materia for sec in body.sections]
@@ -202,15 +179,11 @@ def bot_pick_questions(body: PickBody, _=Depends(bot_key_required)):
 
             # pick scelta
             if sec.scelta:
-                pool = [q for q in bank if _norm_subject(q.get("materia") or "") == subj and _norm_type(q) == "scelta" and _matches_tags(q, sec.tag)]
-                random.shuffle(pool)
-                out.extend(pool[: int(sec.scelta)])
+                out.extend(question_bank.pick(subj, "scelta", int(sec.scelta), sec.tag, rng=rng))
 
             # pick completamento
             if sec.completamento:
-                pool = [q for q in bank if _norm_subject(q.get("materia") or "") == subj and _norm_type(q) == "completamento" and _matches_tags(q, sec.tag)]
-                random.shuffle(pool)
-                out.extend(pool[: int(sec.completamento)])
+                out.extend(question_bank.pick(subj, "completamento", int(sec.completamento), sec.tag, rng=rng))
 
     # sanitize for bot: ensure fields exist
     normalized: List[Dict[str, Any]] = []
@@ -281,25 +254,6 @@ class InviteRedeemBody(BaseModel):
     token: str = Field(..., min_length=4)
     telegram_id: int = Field(..., ge=1)
 
-def _read_json_obj(path: Path) -> Dict[str, Any]:
-    try:
-        if not path.exists():
-            return {}
-        data = json.loads(path.read_text(encoding="utf-8") or "{}")
-        return data if isinstance(data, dict) else {}
-    except Exception:
-        return {}
-
-def _write_json_obj(path: Path, data: Dict[str, Any]) -> None:
-    try:
-        path.parent.mkdir(parents=True, exist_ok=True)
-        tmp = path.with_suffix(path.suffix + ".tmp")
-        tmp.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
-        tmp.replace(path)
-    except Exception:
-        # if write fails, raise to make issue visible
-        raise
-
 def _clean_email(s: str) -> str:
     return str(s or "").strip().lower()
 
@@ -318,22 +272,22 @@ def bot_invite_create(body: InviteCreateBody, _=Depends(bot_key_required)):
     ttl = int(body.ttl_minutes or 20)
     expires_at = _now_ts() + ttl * 60
 
-    invites = _read_json_obj(INVITES_FILE)
+    invites = storage.bot_invites()
     # generate unique token
     token = _gen_token()
     tries = 0
-    while token in invites and tries < 20:
+    while invites.get(token) is not None and tries < 20:
         token = _gen_token()
         tries += 1
 
-    invites[token] = {
+    invites.put({
+        "token": token,
         "email": email,
         "expires_at": expires_at,
         "created_at": _now_ts(),
         "used": False,
         "used_by": None,
-    }
-    _write_json_obj(INVITES_FILE, invites)
+    })
     return {"token": token, "expires_at": expires_at, "email": email}
 
 @router.post("/invite/redeem")
@@ -341,7 +295,7 @@ def bot_invite_redeem(body: InviteRedeemBody, _=Depends(bot_key_required)):
     token = str(body.token or "").strip()
     telegram_id = int(body.telegram_id)
 
-    invites = _read_json_obj(INVITES_FILE)
+    invites = storage.bot_invites()
     inv = invites.get(token)
     if not inv:
         raise HTTPException(status_code=404, detail="token not found")
@@ -358,37 +312,27 @@ def bot_invite_redeem(body: InviteRedeemBody, _=Depends(bot_key_required)):
     inv["used"] = True
     inv["used_by"] = telegram_id
     inv["used_at"] = _now_ts()
-    invites[token] = inv
-    _write_json_obj(INVITES_FILE, invites)
+    invites.put(inv)
 
     # link telegram_id -> email
-    links = _read_json_obj(LINKS_FILE)
-    links[str(telegram_id)] = {"email": email, "linked_at": _now_ts()}
-    _write_json_obj(LINKS_FILE, links)
+    storage.bot_links().put({"telegram_id": str(telegram_id), "email": email, "linked_at": _now_ts()})
 
     return {"ok": True, "telegram_id": telegram_id, "email": email}
 
 @router.get("/access/check")
 def bot_access_check(telegram_id: int, _=Depends(bot_key_required)):
-    links = _read_json_obj(LINKS_FILE)
-    info = links.get(str(int(telegram_id))) or {}
+    info = storage.bot_links().get(str(int(telegram_id))) or {}
     email = _clean_email(info.get("email") or "")
     return {"allowed": bool(email), "email": email or None}
 
 @router.post("/access/revoke")
 def bot_access_revoke(telegram_id: int, _=Depends(bot_key_required)):
-    links = _read_json_obj(LINKS_FILE)
-    tid = str(int(telegram_id))
-    existed = tid in links
-    if existed:
-        links.pop(tid, None)
-        _write_json_obj(LINKS_FILE, links)
+    existed = storage.bot_links().delete(str(int(telegram_id)))
     return {"ok": True, "revoked": existed}
 
 @router.get("/user/profile_by_tg")
 def bot_user_profile_by_tg(telegram_id: int, _=Depends(bot_key_required)):
-    links = _read_json_obj(LINKS_FILE)
-    info = links.get(str(int(telegram_id))) or {}
+    info = storage.bot_links().get(str(int(telegram_id))) or {}
     email = _clean_email(info.get("email") or "")
     if not email:
         raise HTTPException(status_code=404, detail="not linked")
@@ -434,41 +378,15 @@ def _role_for(total_runs: int) -> Dict[str, Any]:
         "next_min": next_min,
     }
 
-def _compute_accuracy(runs: List[Dict[str, Any]]) -> float:
-    # try to use overallPct if present; else compute from correct/total if present
-    vals = []
-    for r in runs:
-        if r.get("overallPct") is not None:
-            try:
-                vals.append(float(r["overallPct"]))
-            except Exception:
-                pass
-        elif r.get("accuracy_pct") is not None:
-            try:
-                vals.append(float(r["accuracy_pct"]))
-            except Exception:
-                pass
-        elif r.get("correct") is not None and r.get("total") is not None:
-            try:
-                c = float(r["correct"]); t = float(r["total"])
-                if t > 0:
-                    vals.append((c/t)*100.0)
-            except Exception:
-                pass
-    if not vals:
-        return 0.0
-    return round(sum(vals)/len(vals), 1)
-
 @router.get("/user/profile")
 def bot_user_profile(email: str, _=Depends(bot_key_required)):
     e = (email or "").strip().lower()
     if not e:
         raise HTTPException(status_code=422, detail="email required")
-    runs = _read_json_list(RUNS_FILE)
-    mine = [x for x in runs if str(x.get("email") or "").strip().lower() == e]
-    mine.sort(key=lambda x: str(x.get("created_at") or ""), reverse=True)
-    total = len(mine)
-    acc = _compute_accuracy(mine)
+    # aggregato per utente (runs_store.user_stats), aggiornato a ogni /finish
+    stats = runs_store.get_user_stats(e)
+    total = int(stats.get("runs") or 0)
+    acc = stats.get("accuracy_pct", 0.0)
     role = _role_for(total)
     return {
         "email": e,
@@ -3,49 +3,16 @@ from pydantic import BaseModel, Field
 from typing import List, Optional
 from datetime import datetime
 import uuid
-import os
-import json
+
+import storage
 
 router = APIRouter(prefix="/api/dispense", tags=["dispense"])
 
 from auth import admin_required
 
 # =========================
-# JSON storage
+# Storage: storage.dispense() (JSON o SQLite, vedi storage.py)
 # =========================
-BASE_DIR = os.path.dirname(os.path.dirname(__file__))  # backend/
-DATA_DIR = os.path.join(BASE_DIR, "data")
-DATA_FILE = os.path.join(DATA_DIR, "dispense.json")
-
-
-def _ensure_data_file():
-    os.makedirs(DATA_DIR, exist_ok=True)
-    if not os.path.exists(DATA_FILE):
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            f.write("[]")
-
-
-def _read_all() -> List[dict]:
-    _ensure_data_file()
-    try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            content = f.read().strip()
-            if not content:
-                return []
-            data = json.loads(content)
-            return data if isinstance(data, list) else []
-    except Exception:
-        # se è corrotto, reset
-        _write_all([])
-        return []
-
-
-def _write_all(items: List[dict]):
-    _ensure_data_file()
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(items, f, ensure_ascii=False, indent=2)
-
-
 def _normalize(x: dict) -> dict:
     """
     Compatibilità: se in vecchie versioni c'è file_url ma non link,
@@ -128,12 +95,11 @@ async def list_dispense(request: Request, include_unpublished: bool = False):
         data = await db.dispense.find(query, {"_id": 0}).to_list(2000)
         return data
 
-    items = [_normalize(x) for x in _read_all()]
     if include_unpublished:
         # include_unpublished è pensato per la UI Admin
         _ = admin_required(request)
-        return items
-    return [x for x in items if x.get("pubblicata") is True]
+        return [_normalize(x) for x in storage.dispense().all()]
+    return [_normalize(x) for x in storage.dispense().query({"pubblicata": True})]
 
 
 @router.post("")
@@ -164,10 +130,8 @@ async def create_dispensa(request: Request, payload: DispensaCreate, _payload=De
         await db.dispense.insert_one(new_item)
         return new_item
 
-    # JSON
-    items = _read_all()
-    items.insert(0, new_item)
-    _write_all(items)
+    # JSON / SQLite
+    storage.dispense().put(new_item)
     return new_item
 
 
@@ -199,13 +163,10 @@ async def update_dispensa(request: Request, dispensa_id: str, payload: DispensaC
         await db.dispense.update_one({"id": dispensa_id}, {"$set": updated_fields})
         return {**existing, **updated_fields, "id": dispensa_id}
 
-    # JSON
-    items = _read_all()
-    for i, x in enumerate(items):
-        if x.get("id") == dispensa_id:
-            items[i] = {**x, **updated_fields}
-            _write_all(items)
-            return _normalize(items[i])
+    # JSON / SQLite
+    updated = storage.dispense().update(dispensa_id, updated_fields)
+    if updated is not None:
+        return _normalize(updated)
 
     raise HTTPException(status_code=404, detail="Dispensa non trovata")
 
@@ -223,13 +184,13 @@ async def toggle_dispensa(request: Request, dispensa_id: str, _payload=Depends(a
         await db.dispense.update_one({"id": dispensa_id}, {"$set": {"pubblicata": new_status}})
         return {"success": True, "pubblicata": new_status}
 
-    # JSON
-    items = _read_all()
-    for x in items:
-        if x.get("id") == dispensa_id:
-            x["pubblicata"] = not bool(x.get("pubblicata", True))
-            _write_all(items)
-            return {"success": True, "pubblicata": x["pubblicata"]}
+    # JSON / SQLite
+    col = storage.dispense()
+    x = col.get(dispensa_id)
+    if x is not None:
+        x["pubblicata"] = not bool(x.get("pubblicata", True))
+        col.put(x)
+        return {"success": True, "pubblicata": x["pubblicata"]}
 
     raise HTTPException(status_code=404, detail="Dispensa non trovata")
 
@@ -245,10 +206,7 @@ async def delete_dispensa(request: Request, dispensa_id: str, _payload=Depends(a
             raise HTTPException(status_code=404, detail="Dispensa non trovata")
         return {"success": True}
 
-    # JSON
-    items = _read_all()
-    new_items = [x for x in items if x.get("id") != dispensa_id]
-    if len(new_items) == len(items):
+    # JSON / SQLite
+    if not storage.dispense().delete(dispensa_id):
         raise HTTPException(status_code=404, detail="Dispensa non trovata")
-    _write_all(new_items)
     return {"success": True}
\ No newline at end of file
@@ -7,7 +7,8 @@ from fastapi import APIRouter, HTTPException, Depends
 from pydantic import BaseModel, Field
 
 from auth import admin_required
-from supabase_db import fetch_all_questions, insert_question, update_question, delete_question
+from supabase_db import insert_question, update_question, delete_question
+import question_bank
 
 router = APIRouter(prefix="/api/admin/domande", tags=["admin-domande"])
 
@@ -136,9 +137,10 @@ class QuestionOut(BaseModel):
 
 # ----------------- endpoints (Supabase) -----------------
 @router.get("", dependencies=[Depends(admin_required)])
-def list_questions() -> list[dict]:
+async def list_questions() -> list[dict]:
     # Keep consistent response ordering (newest first if created_at exists)
-    items = fetch_all_questions()
+    # copia: la lista della cache è condivisa
+    items = list(await question_bank.aget_bank())
     # Sort by created_at desc, fallback stable by id
     def _key(x):
         return (x.get("created_at") or "", x.get("id") or "")
@@ -156,6 +158,7 @@ def create_question(payload: QuestionIn):
 
     validate_question(q)
     created = insert_question(q)
+    question_bank.apply_upsert(created)
     return created
 
 
@@ -169,6 +172,7 @@ def update_question_endpoint(qid: str, payload: QuestionIn):
     updated = update_question(qid, q)
     if not updated:
         raise HTTPException(status_code=404, detail="domanda non trovata")
+    question_bank.apply_upsert(updated)
     return updated
 
 
@@ -177,4 +181,5 @@ def delete_question_endpoint(qid: str):
     ok = delete_question(qid)
     if not ok:
         raise HTTPException(status_code=404, detail="domanda non trovata")
+    question_bank.apply_delete(qid)
     return {"ok": True}
@@ -1,12 +1,18 @@
 from __future__ import annotations
 
+import base64
 import json
+import threading
 import uuid
+from collections import OrderedDict
 from datetime import datetime
 from pathlib import Path
 
-from supabase_db import fetch_question_by_id
-from typing import Any, Dict, List, Literal, Optional
+import question_bank
+import reports_store
+from routes import sessioni as sessioni_routes
+from routes import simulazioni as simulazioni_routes
+from typing import Any, Dict, Literal, Optional
 
 from fastapi import APIRouter, Depends, HTTPException, Query
 from pydantic import BaseModel, Field
@@ -18,29 +24,11 @@ router = APIRouter(tags=["reports"])
 
 BASE_DIR = Path(__file__).resolve().parents[1]
 DATA_DIR = BASE_DIR / "data"
-REPORTS_FILE = DATA_DIR / "reports.json"
 
 Status = Literal["open", "in_review", "resolved", "dismissed"]
 
-
-def _ensure_db():
-    DATA_DIR.mkdir(parents=True, exist_ok=True)
-    if not REPORTS_FILE.exists():
-        REPORTS_FILE.write_text("[]", encoding="utf-8")
-
-
-def _read_all() -> List[Dict[str, Any]]:
-    _ensure_db()
-    try:
-        data = json.loads(REPORTS_FILE.read_text(encoding="utf-8") or "[]")
-        return data if isinstance(data, list) else []
-    except Exception:
-        return []
-
-
-def _write_all(items: List[Dict[str, Any]]):
-    _ensure_db()
-    REPORTS_FILE.write_text(json.dumps(items, ensure_ascii=False, indent=2), encoding="utf-8")
+REPORTS_PAGE_DEFAULT = 50
+REPORTS_PAGE_MAX = 200
 
 
 def _norm(s: Optional[str]) -> str:
@@ -51,131 +39,98 @@ def _iso_now() -> str:
     return datetime.utcnow().isoformat()
 
 
-def _snapshot_from_bank_session(session_id: str, qid: str) -> Optional[Dict[str, Any]]:
-    # sessioni.py (banca domande) salva questions_full con soluzioni
-    try:
-        from routes.sessioni import SESSIONS as BANK_SESSIONS  # type: ignore
-    except Exception:
-        BANK_SESSIONS = {}
-
-    s = None
-    try:
-        s = BANK_SESSIONS.get(session_id)
-    except Exception:
-        s = None
-    if not s:
-        return None
-
-    for q in (s.get("questions_full") or []):
-        if str(q.get("id")) != str(qid):
-            continue
-        tipo = str(q.get("tipo") or "").strip().lower() or "scelta"
-        snap: Dict[str, Any] = {
-            "id": str(q.get("id")),
-            "materia": q.get("materia"),
-            "tipo": tipo,
-            "testo": q.get("testo"),
-            "tag": q.get("tag") if isinstance(q.get("tag"), list) else (q.get("tags") if isinstance(q.get("tags"), list) else []),
-            "spiegazione": q.get("spiegazione"),
-        }
-        if tipo == "scelta":
-            snap["opzioni"] = q.get("opzioni") or []
-            # corretta: manteniamo sia lettera che index (se presenti)
-            snap["corretta"] = q.get("corretta")
-            snap["corretta_index"] = q.get("corretta_index")
-        else:
-            # completamento: supporta risposte (lista) oppure corretta string
-            if isinstance(q.get("risposte"), list) and q.get("risposte"):
-                snap["risposte"] = q.get("risposte")
-            else:
-                snap["corretta"] = q.get("corretta")
-        return snap
-    return None
-
-
-def _snapshot_from_mock_session(session_id: str, qid: str) -> Optional[Dict[str, Any]]:
-    # simulazioni.py mock: salva questions in sessione con _correct_* e _spiegazione
-    try:
-        from routes.simulazioni import SESSIONS as MOCK_SESSIONS  # type: ignore
-    except Exception:
-        MOCK_SESSIONS = {}
-
-    s = None
-    try:
-        s = MOCK_SESSIONS.get(session_id)
-    except Exception:
-        s = None
-    if not s:
+# indice {qid: updated_at} per sessione compatta: qids/qrev non cambiano dopo lo
+# start, quindi si costruisce una volta e serve tutte le segnalazioni della sessione
+_SESSION_INDEX: "OrderedDict[str, Dict[str, Optional[str]]]" = OrderedDict()
+_SESSION_INDEX_MAX = 512
+_SESSION_INDEX_LOCK = threading.Lock()
+
+
+def _session_index(session_id: str, sess: Dict[str, Any]) -> Dict[str, Optional[str]]:
+    with _SESSION_INDEX_LOCK:
+        idx = _SESSION_INDEX.get(session_id)
+        if idx is not None:
+            _SESSION_INDEX.move_to_end(session_id)
+            return idx
+    qids = sess.get("qids") or []
+    revs = sess.get("qrev") or []
+    idx = {str(q): (revs[i] if i < len(revs) else None) for i, q in enumerate(qids)}
+    with _SESSION_INDEX_LOCK:
+        _SESSION_INDEX[session_id] = idx
+        while len(_SESSION_INDEX) > _SESSION_INDEX_MAX:
+            _SESSION_INDEX.popitem(last=False)
+    return idx
+
+
+def _session_question(session_id: str, sess: Optional[Dict[str, Any]], qid: str) -> Optional[Dict[str, Any]]:
+    """Question `qid` as served in a session (same version the student saw)."""
+    if not sess:
         return None
-
-    for q in (s.get("questions") or []):
-        if str(q.get("id")) != str(qid):
-            continue
-        tipo = str(q.get("tipo") or "").strip().lower() or "scelta"
-        snap: Dict[str, Any] = {
-            "id": str(q.get("id")),
-            "materia": q.get("materia"),
-            "tipo": tipo,
-            "testo": q.get("testo"),
-            "tag": q.get("tag") if isinstance(q.get("tag"), list) else [],
-            "spiegazione": q.get("_spiegazione") or q.get("spiegazione"),
-        }
-        if tipo == "scelta":
-            snap["opzioni"] = q.get("opzioni") or []
-            ci = q.get("_correct_index")
-            snap["corretta_index"] = ci
+    if isinstance(sess.get("qids"), list):
+        # sessione compatta: si risolve solo la domanda segnalata
+        idx = _session_index(session_id, sess)
+        key = str(qid)
+        if key not in idx:
+            return None
+        rev = idx[key]
+        q = question_bank.resolve([key], [rev] if rev is not None else None)[0]
+        return None if q.get("unavailable") else q
+    # sessioni create prima delle sessioni compatte
+    qs = sessioni_routes._session_questions(sess)
+    return next((q for q in qs if isinstance(q, dict) and str(q.get("id")) == str(qid)), None)
+
+
+def _snapshot(q: Dict[str, Any]) -> Dict[str, Any]:
+    """Report snapshot of a question (bank row or session copy, with solutions)."""
+    tipo = str(q.get("tipo") or "").strip().lower() or "scelta"
+    tag = q.get("tag") if isinstance(q.get("tag"), list) else q.get("tags")
+    snap: Dict[str, Any] = {
+        "id": str(q.get("id")),
+        "materia": q.get("materia"),
+        "tipo": tipo,
+        "testo": q.get("testo"),
+        "tag": tag if isinstance(tag, list) else [],
+        "spiegazione": q.get("spiegazione") or q.get("_spiegazione"),
+    }
+    if tipo == "scelta":
+        snap["opzioni"] = q.get("opzioni") or []
+        # corretta: manteniamo sia lettera che index (se presenti)
+        ci = q.get("corretta_index", q.get("_correct_index"))
+        snap["corretta_index"] = ci
+        corretta = q.get("corretta")
+        if corretta is None and ci is not None:
             try:
-                snap["corretta"] = chr(65 + int(ci))
+                corretta = chr(65 + int(ci))
             except Exception:
-                snap["corretta"] = None
+                corretta = None
+        snap["corretta"] = corretta
+    else:
+        # completamento: supporta risposte (lista) oppure corretta string
+        if isinstance(q.get("risposte"), list) and q.get("risposte"):
+            snap["risposte"] = q.get("risposte")
         else:
-            snap["corretta"] = q.get("_correct_text")
-        return snap
-    return None
+            snap["corretta"] = q.get("corretta") or q.get("_correct_text")
+    return snap
 
 
-def _snapshot_from_domande_db(qid: str) -> Optional[Dict[str, Any]]:
-    try:
-        q = fetch_question_by_id(str(qid))
-        if not q:
-            return None
-            tipo = str(q.get("tipo") or "").strip().lower() or "scelta"
-            snap: Dict[str, Any] = {
-                "id": str(q.get("id")),
-                "materia": q.get("materia"),
-                "tipo": tipo,
-                "testo": q.get("testo"),
-                "tag": q.get("tag") if isinstance(q.get("tag"), list) else [],
-                "spiegazione": q.get("spiegazione"),
-            }
-            if tipo == "scelta":
-                snap["opzioni"] = q.get("opzioni") or []
-                snap["corretta"] = q.get("corretta")
-                snap["corretta_index"] = q.get("corretta_index")
-            else:
-                if isinstance(q.get("risposte"), list) and q.get("risposte"):
-                    snap["risposte"] = q.get("risposte")
-                else:
-                    snap["corretta"] = q.get("corretta")
-            return snap
-    except FileNotFoundError:
-        return None
-    except Exception:
-        return None
-    return None
+def _question_from_session(session_id: str, qid: str) -> Optional[Dict[str, Any]]:
+    # /api/sim (sessioni.py), poi /api/simulazioni (simulazioni.py)
+    q = _session_question(session_id, sessioni_routes._get_session(session_id), qid)
+    if q is not None:
+        return q
+    return _session_question(session_id, simulazioni_routes._session_store_get(session_id), qid)
 
 
 def _build_question_snapshot(session_id: Optional[str], qid: str) -> Dict[str, Any]:
-    if session_id:
-        snap = _snapshot_from_bank_session(session_id, qid)
-        if snap:
-            return snap
-        snap = _snapshot_from_mock_session(session_id, qid)
-        if snap:
-            return snap
-    snap = _snapshot_from_domande_db(qid)
-    if snap:
-        return snap
+    q = _question_from_session(session_id, qid) if session_id else None
+    if q is None:
+        # banca in cache / cache per id; Supabase solo se la domanda non è già caricata
+        try:
+            q = question_bank.get_question(qid)
+        except Exception:
+            q = None
+    if q:
+        return _snapshot(q)
     raise HTTPException(status_code=404, detail="Domanda non trovata per segnalazione")
 
 
@@ -213,9 +168,7 @@ def create_report(payload: ReportIn, user=Depends(user_required)):
         "question": snap,
     }
 
-    items = _read_all()
-    items.insert(0, rec)
-    _write_all(items)
+    reports_store.create(rec)
 
     return {"ok": True, "id": rec["id"]}
 
@@ -223,42 +176,69 @@ def create_report(payload: ReportIn, user=Depends(user_required)):
 @router.get("/api/user/reports")
 def list_user_reports(user=Depends(user_required)):
     email = str(user.get("email") or "").strip()
-    items = [x for x in _read_all() if str(x.get("email") or "").strip() == email]
-    items.sort(key=lambda x: str(x.get("created_at") or ""), reverse=True)
+    items = reports_store.list_by_email(email)
     # non serve rimandare email al client
     out = []
     for x in items:
-        y = dict(x)
-        y.pop("email", None)
-        out.append(y)
+        x.pop("email", None)
+        out.append(x)
     return {"items": out}
 
 
+def _encode_cursor(key) -> str:
+    raw = json.dumps([str(key[0]), str(key[1])])
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor: str):
+    try:
+        pad = "=" * (-len(cursor) % 4)
+        created_at, rid = json.loads(base64.urlsafe_b64decode(cursor + pad).decode("utf-8"))
+        return str(created_at), str(rid)
+    except Exception:
+        raise HTTPException(status_code=422, detail="cursor non valido")
+
+
 @router.get("/api/admin/reports")
 def admin_list_reports(
     status: Optional[Status] = None,
     materia: Optional[str] = None,
+    question_id: Optional[str] = None,
     date_from: Optional[str] = Query(default=None, description="ISO date/time inclusive"),
     date_to: Optional[str] = Query(default=None, description="ISO date/time inclusive"),
+    limit: int = Query(default=REPORTS_PAGE_DEFAULT, ge=1, le=REPORTS_PAGE_MAX),
+    cursor: Optional[str] = None,
     _=Depends(admin_required),
 ):
-    items = _read_all()
-
-    if status:
-        items = [x for x in items if str(x.get("status") or "") == str(status)]
-    if materia:
-        m = materia.strip().lower()
-        items = [x for x in items if str((x.get("question") or {}).get("materia") or "").strip().lower() == m]
-
-    # filtri data (lex compare ISO ok)
-    if date_from:
-        df = date_from.strip()
-        items = [x for x in items if str(x.get("created_at") or "") >= df]
-    if date_to:
-        dt = date_to.strip()
-        items = [x for x in items if str(x.get("created_at") or "") <= dt]
-
-    items.sort(key=lambda x: str(x.get("created_at") or ""), reverse=True)
+    """Newest-first page of reports (keyset on created_at, id) + counts per status."""
+    items, nxt = reports_store.query(
+        status=str(status) if status else None,
+        materia=materia,
+        question_id=_norm(question_id) or None,
+        date_from=date_from,
+        date_to=date_to,
+        limit=limit,
+        cursor=_decode_cursor(cursor) if cursor else None,
+    )
+    return {
+        "items": items,
+        "next_cursor": _encode_cursor(nxt) if nxt else None,
+        "counts": reports_store.status_counts(),
+    }
+
+
+@router.get("/api/admin/reports/queue")
+def admin_reports_queue(
+    limit: int = Query(default=REPORTS_PAGE_DEFAULT, ge=1, le=REPORTS_PAGE_MAX),
+    materia: Optional[str] = None,
+    include_closed: bool = False,
+    _=Depends(admin_required),
+):
+    """Triage: one row per question, most open reports first.
+
+    Le singole segnalazioni di una domanda: /api/admin/reports?question_id=...
+    """
+    items = reports_store.triage_queue(limit=limit, materia=materia, include_closed=include_closed)
     return {"items": items}
 
 
@@ -273,22 +253,13 @@ def admin_update_report(report_id: str, payload: ReportUpdate, _=Depends(admin_r
     if not rid:
         raise HTTPException(status_code=422, detail="id mancante")
 
-    items = _read_all()
-    found = None
-    for i, x in enumerate(items):
-        if str(x.get("id")) != rid:
-            continue
-        if payload.status:
-            x["status"] = payload.status
-        if payload.admin_note is not None:
-            x["admin_note"] = _norm(payload.admin_note) or None
-        x["updated_at"] = _iso_now()
-        items[i] = x
-        found = x
-        break
+    fields: Dict[str, Any] = {"updated_at": _iso_now()}
+    if payload.status:
+        fields["status"] = payload.status
+    if payload.admin_note is not None:
+        fields["admin_note"] = _norm(payload.admin_note) or None
 
+    found = reports_store.update(rid, fields)
     if not found:
         raise HTTPException(status_code=404, detail="Segnalazione non trovata")
-
-    _write_all(items)
     return {"ok": True, "item": found}
@@ -1,59 +1,64 @@
 from fastapi import APIRouter, HTTPException, Request
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field
 from typing import List, Optional, Literal, Dict, Any
 from uuid import uuid4
 from datetime import datetime
 
-from supabase_db import get_supabase_client
 from auth import try_get_user
 from pathlib import Path
 
-from supabase_db import fetch_question_by_id
-import json
+import question_bank
+import runs_store
+import session_store
+import session_tokens
+import logging
+import os
 import random
-
-from auth import try_get_user
+import time
 
 router = APIRouter(prefix="/api/sim", tags=["sim"])
 
-# =========================
-# STORE SESSIONI (GLOBAL!)
-# =========================
-SESSIONS: Dict[str, Dict[str, Any]] = {}
+logger = logging.getLogger("dinomed.sim")
 
 # =========================
-# QUESTION BANK (JSON)
+# STORE SESSIONI (TTL + LRU, vedi session_store.py)
 # =========================
-DATA_DIR = Path(__file__).resolve().parent.parent / "data"
-BANK_FILE = DATA_DIR / "domande.json"
+SESSIONS = session_store.get_store("sim")
+# sessioni di /api/simulazioni/start (soluzioni in "questions"): corrette da finish()
+SIM_SESSIONS = session_store.get_store("simulazioni", persistent=True)
+# checkpoint delle risposte per le sessioni da token (SIM_STATELESS)
+TOKEN_ANSWERS = session_store.get_store("sim_token_answers", persistent=True)
 
-USER_RUNS_FILE = DATA_DIR / "user_runs.json"
+ANSWERS_PATCH_MAX = 500
 
-def _runs_read():
-    try:
-        raw = USER_RUNS_FILE.read_text(encoding="utf-8")
-        data = json.loads(raw or "[]")
-        return data if isinstance(data, list) else []
-    except FileNotFoundError:
-        return []
-    except Exception:
-        return []
 
-def _runs_write(items):
-    DATA_DIR.mkdir(parents=True, exist_ok=True)
-    USER_RUNS_FILE.write_text(json.dumps(items, ensure_ascii=False, indent=2), encoding="utf-8")
+def _get_session(session_id: str) -> Optional[Dict[str, Any]]:
+    """Session of /api/sim: from its signed token (SIM_STATELESS) or from the store."""
+    if session_tokens.is_token(session_id):
+        return session_tokens.verify(session_id)
+    return SESSIONS.get(session_id)
 
-def _load_bank() -> List[Dict[str, Any]]:
-    try:
-        raw = BANK_FILE.read_text(encoding="utf-8")
-        data = json.loads(raw)
-        if isinstance(data, list):
-            return data
-        return []
-    except FileNotFoundError:
-        return []
-    except Exception:
-        return []
+
+def _finish_session(session_id: str):
+    """(store, session) for finish(): /api/sim first, then /api/simulazioni.
+
+    Per le sessioni da token lo store è None: non c'è niente da aggiornare.
+    """
+    if session_tokens.is_token(session_id):
+        return None, session_tokens.verify(session_id)
+    s = SESSIONS.get(session_id)
+    if s is not None:
+        return SESSIONS, s
+    s = SIM_SESSIONS.get(session_id)
+    if s is not None:
+        return SIM_SESSIONS, s
+    return None, None
+
+# =========================
+# QUESTION BANK (Supabase, cache di processo in question_bank)
+# =========================
+DATA_DIR = Path(__file__).resolve().parent.parent / "data"
 
 def _norm(s: str) -> str:
     return (s or "").strip().lower()
@@ -70,36 +75,25 @@ def _q_tags(q: Dict[str, Any]) -> List[str]:
         return [tag.strip()]
     return []
 
-def _matches_tags(q: Dict[str, Any], requested: List[str]) -> bool:
-    if not requested:
-        return True
-    qt = {_norm(x) for x in _q_tags(q)}
-    rq = {_norm(x) for x in requested if str(x).strip()}
-    if not rq:
-        return True
-    return len(qt.intersection(rq)) > 0
-
 def pick_questions_from_bank(materia: str,
                             tipo: Literal["scelta", "completamento"],
                             n: int,
-                            tags: Optional[List[str]] = None) -> List[Dict[str, Any]]:
-    bank = _load_bank()
-    if not bank:
-        return []
-
-    filtered = []
-    for q in bank:
-        if _norm(q.get("materia")) != _norm(materia):
-            continue
-        if _norm(q.get("tipo")) != _norm(tipo):
-            continue
-        if not _matches_tags(q, tags or []):
-            continue
-        filtered.append(q)
-
-    # non duplicare, ma randomizza
-    random.shuffle(filtered)
-    return filtered[:max(0, n)]
+                            tags: Optional[List[str]] = None,
+                            rng: Optional[random.Random] = None) -> List[Dict[str, Any]]:
+    # indice della banca (question_bank): niente scansione lineare, già randomizzato.
+    # "public": la sessione salva solo id + versione, allo studente vanno le colonne pubbliche
+    return question_bank.pick(materia, tipo, n, tags or [], rng=rng, profile="public")
+
+def _session_questions(s: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Questions of a session, with solutions, in session order.
+
+    Le sessioni salvano solo id + versione (`qids`/`qrev`): i testi si
+    risolvono dalla banca in cache (question_bank.resolve). Le sessioni
+    create prima hanno ancora le domande complete.
+    """
+    if isinstance(s.get("qids"), list):
+        return question_bank.resolve(s["qids"], s.get("qrev"))
+    return s.get("questions_full") or s.get("questions") or []
 
 # =========================
 # API MODELS
@@ -135,7 +129,7 @@ def _public_question(q: Dict[str, Any]) -> Dict[str, Any]:
     return base
 
 @router.post("/start")
-def start(req: StartRequest):
+def start(req: StartRequest, request: Request):
     if not req.sections:
         raise HTTPException(status_code=400, detail="Seleziona almeno 1 materia.")
 
@@ -165,7 +159,11 @@ def start(req: StartRequest):
 
     # REQUISITO: ordine per materia fisso (req.order), domande casuali all'interno della materia.
     picked_full: List[Dict[str, Any]] = []
+    bounds: List[tuple] = []  # (materia, fine del blocco in picked_full)
     diagnostics: List[str] = []
+    # seme della sessione: estrazione e ordine delle domande sono riproducibili
+    seed = random.getrandbits(32)
+    rng = random.Random(seed)
 
     for materia in order:
         sec = next((s for s in req.sections if s.materia == materia), None)
@@ -177,9 +175,9 @@ def start(req: StartRequest):
         # scelta multipla
         need_sc = int(sec.scelta or 0)
         if need_sc > 0:
-            sc = pick_questions_from_bank(materia, "scelta", need_sc, sec.tag or [])
+            sc = pick_questions_from_bank(materia, "scelta", need_sc, sec.tag or [], rng=rng)
             if len(sc) < need_sc:
-                avail = len(pick_questions_from_bank(materia, "scelta", 10_000, sec.tag or []))
+                avail = question_bank.count(materia, "scelta", sec.tag or [])
                 diagnostics.append(f"{materia} • crocette: richieste {need_sc}, disponibili {avail}")
                 raise HTTPException(
                     status_code=400,
@@ -191,9 +189,9 @@ def start(req: StartRequest):
         # completamento
         need_co = int(sec.completamento or 0)
         if need_co > 0:
-            co = pick_questions_from_bank(materia, "completamento", need_co, sec.tag or [])
+            co = pick_questions_from_bank(materia, "completamento", need_co, sec.tag or [], rng=rng)
             if len(co) < need_co:
-                avail = len(pick_questions_from_bank(materia, "completamento", 10_000, sec.tag or []))
+                avail = question_bank.count(materia, "completamento", sec.tag or [])
                 diagnostics.append(f"{materia} • completamento: richieste {need_co}, disponibili {avail}")
                 raise HTTPException(
                     status_code=400,
@@ -206,10 +204,26 @@ def start(req: StartRequest):
             raise HTTPException(status_code=400, detail=f"In {materia} metti almeno 1 domanda (crocette o completamento).")
 
         # shuffle SOLO dentro la materia
-        random.shuffle(picked_this)
+        rng.shuffle(picked_this)
         picked_full.extend(picked_this)
+        bounds.append((materia, len(picked_full)))
 
     session_id = str(uuid4())
+    qids, qrev = question_bank.question_refs(picked_full)
+
+    # scadenze salvate con la sessione (fatte rispettare da /finish e dallo scanner delle scadenze)
+    now = time.time()
+    deadline_at = (now + int(req.duration_min or 0) * 60) if int(req.duration_min or 0) > 0 else None
+    subject_deadlines = None
+    if timer_mode == "per_subject":
+        # le materie si svolgono in ordine: scadenza cumulativa per blocco
+        subject_deadlines = []
+        until = now
+        for materia, end in bounds:
+            until += int(durations_by_subject.get(materia, 0)) * 60
+            subject_deadlines.append([materia, round(until, 3), end])
+    user = try_get_user(request)
+    public_questions = [_public_question(q) for q in picked_full]
     # Importante: non usare `session.get(...)` dentro la definizione del dict,
     # perché `session` non esiste ancora (causa NameError/500) e le chiavi duplicate
     # vengono sovrascritte silenziosamente.
@@ -220,66 +234,58 @@ def start(req: StartRequest):
         "timer_mode": str(req.timer_mode or "single"),
         "durations_by_subject": (durations_by_subject or None),
         "order": order,
-        "questions_full": picked_full,  # con soluzioni (per correzione)
-        "questions": [_public_question(q) for q in picked_full],  # senza soluzioni
+        "sections": [sec.model_dump() for sec in req.sections],
+        "seed": seed,
+        # solo id + versione: le domande (con soluzioni) si risolvono dalla banca
+        "qids": qids,
+        "qrev": qrev,
+        "deadline_at": deadline_at,
+        "subject_deadlines": subject_deadlines,
+        "email": (user or {}).get("email"),
         "answers": {},
         "finished": False,
     }
-    SESSIONS[session_id] = session
-
-# =========================
-# Persistenza su DB (Supabase) - tabella "sessions"
-# =========================
-try:
-    p = try_get_user(request)
-    user_id = (p or {}).get("user_id")
-    if user_id:
-        sb = get_supabase_client()
-        record = {
-            "session_id": session_id,
-            "user_id": user_id,
-            "finished": True,
-            "finished_at": datetime.utcnow().isoformat(),
-            "total": total,
-            "correct": correct,
-            "wrong": wrong,
-            "blank": blank,
-            "score": round(score, 3),
-            "percent": percent,
-            "per_subject": per_subject_out,
-            "answers": amap,
-        }
-        # upsert su session_id (se la tabella non ha vincolo, sarà un insert)
-        try:
-            sb.table("sessions").upsert(record, on_conflict="session_id").execute()
-        except Exception:
-            sb.table("sessions").insert(record).execute()
-except Exception:
-    # Non bloccare la consegna se il DB fallisce
-    pass
+    if session_tokens.enabled():
+        # stateless: la sessione viaggia nel token firmato, nessuna scrittura
+        public_id = session_tokens.issue(session)
+        if deadline_at and session.get("email"):
+            # unica scrittura: la scadenza (e il token) per la correzione automatica
+            TOKEN_ANSWERS.put(
+                session_id,
+                {"id": session_id, "deadline_at": deadline_at, "token": public_id},
+                ttl_s=session_store.session_ttl_s(session),
+            )
+    else:
+        # deadline_at nello store: la trova lo scanner delle scadenze di qualunque worker
+        SESSIONS.put(session_id, session)
+        public_id = session_id
 
     return {
-        "session_id": session_id,
+        "session_id": public_id,
         "duration_min": session["duration_min"],
-        "questions": session["questions"],
+        "questions": public_questions,
         "order": order,
         "timer_mode": session.get("timer_mode", "single"),
         "durations_by_subject": session.get("durations_by_subject"),
+        "deadline_at": deadline_at,
+        "subject_deadlines": subject_deadlines,
     }
 
 @router.get("/{session_id}")
 
 def get_session(session_id: str):
-    s = SESSIONS.get(session_id)
+    s = _get_session(session_id)
     if not s:
         raise HTTPException(status_code=404, detail="Sessione non trovata")
     return {
         "session_id": session_id,
         "duration_min": s.get("duration_min", 0),
-        "questions": s.get("questions", []),
+        "questions": [_public_question(q) for q in _session_questions(s)],
         "order": s.get("order", []),
         "timer_mode": s.get("timer_mode", "single"),
         "durations_by_subject": s.get("durations_by_subject"),
+        "deadline_at": s.get("deadline_at"),
+        "subject_deadlines": s.get("subject_deadlines"),
     }
 
 
@@ -288,19 +294,139 @@ def get_session(session_id: str):
 def get_session_alias(session_id: str):
     return get_session(session_id)
 
+def _answers_target(session_id: str, store, s: Dict[str, Any]):
+    """(store, key) where the answer checkpoints of a session live."""
+    if not s.get("stateless"):
+        return store, session_id
+    sid = str(s.get("id"))
+    if TOKEN_ANSWERS.get(sid) is None:
+        # record minimo: le risposte scadono insieme al token
+        TOKEN_ANSWERS.put(sid, {"id": sid}, ttl_s=max(1.0, float(s.get("expires_at") or 0) - time.time()))
+    return TOKEN_ANSWERS, sid
+
+
+def _saved_answers(session_id: str, store, s: Dict[str, Any]) -> Dict[str, Any]:
+    target, key = _answers_target(session_id, store, s)
+    return target.get_answers(key)
+
+
+# =========================
+# Scadenze lato server
+# =========================
+def _deadline_tolerance_s() -> float:
+    # margine per la latenza di rete dell'ultimo invio (auto-finish del frontend a tempo zero)
+    try:
+        return max(0.0, float(os.getenv("SESSION_DEADLINE_TOLERANCE_S") or 30))
+    except Exception:
+        return 30.0
+
+
+def _closed_qids(s: Dict[str, Any], now: float) -> set:
+    """Ids whose time is up: per-subject blocks past their deadline, or all after the session deadline."""
+    qids = s.get("qids")
+    if not isinstance(qids, list):
+        return set()
+    tol = _deadline_tolerance_s()
+    blocks = s.get("subject_deadlines")
+    if blocks:
+        # blocchi in ordine: [materia, scadenza cumulativa, fine blocco (esclusa)]
+        closed: set = set()
+        begin = 0
+        for _materia, until, end in blocks:
+            if now > float(until) + tol:
+                closed.update(qids[begin:end])
+            begin = end
+        return closed
+    dl = s.get("deadline_at")
+    if dl and now > float(dl) + tol:
+        return set(qids)
+    return set()
+
+
+def _auto_finish(store_name: str, session_id: str) -> None:
+    """Deadline handler: grade with the checkpointed answers and save the run."""
+    store = session_store.get_store(store_name)
+    if store is TOKEN_ANSWERS:
+        # sessione da token: il record dei checkpoint conserva il token
+        rec = store.get(session_id) or {}
+        s = session_tokens.verify(rec.get("token") or "") if rec.get("token") else None
+        owner = None
+    else:
+        s = store.get(session_id)
+        owner = store
+    if not s or s.get("finished"):
+        store.claim_finish(session_id)  # niente da correggere: esce dalle scadenze
+        return
+    # compare-and-set: una sola correzione anche con più worker o un /finish concorrente
+    if not store.claim_finish(session_id):
+        return
+    amap = _saved_answers(session_id, owner, s)
+    graded = _grade(s, amap)
+    s["answers"] = amap
+    s["finished"] = True
+    s["auto_finished"] = True
+    if owner is not None:
+        owner.put(session_id, s)
+    if s.get("email"):
+        _save_run(session_id, s, str(s.get("email")), graded)
+    logger.info("session %s auto-finished at deadline (store=%s, answers=%d)", session_id, store_name, len(amap))
+
+
+session_store.on_deadline(_auto_finish, delay_s=_deadline_tolerance_s())
+
+
+def _blank(v: Any) -> bool:
+    return v is None or (isinstance(v, str) and v.strip() == "")
+
+
+class AnswersPatch(BaseModel):
+    answers: Dict[str, Any] = Field(default_factory=dict)  # {questionId: userAnswer}, "" = risposta tolta
+
+
+@router.patch("/{session_id}/answers")
+def patch_answers(session_id: str, req: AnswersPatch):
+    """Checkpoint of the answers changed since the last call.
+
+    Il delta è già nello store condiviso quando si risponde ok: /finish lo
+    ritrova (su qualunque worker) anche se il body finale contiene solo le
+    risposte non ancora salvate.
+    """
+    if len(req.answers) > ANSWERS_PATCH_MAX:
+        raise HTTPException(status_code=413, detail=f"Massimo {ANSWERS_PATCH_MAX} risposte per checkpoint")
+    store, s = _finish_session(session_id)
+    if not s:
+        raise HTTPException(status_code=404, detail="Sessione non trovata")
+    if s.get("finished"):
+        raise HTTPException(status_code=409, detail="Sessione già consegnata")
+    closed = _closed_qids(s, time.time())
+    delta = {str(k): v for k, v in req.answers.items() if str(k) not in closed}
+    if req.answers and not delta:
+        raise HTTPException(status_code=409, detail="Tempo scaduto")
+    target, key = _answers_target(session_id, store, s)
+    if not session_store.checkpoint(target, key, delta):
+        raise HTTPException(status_code=404, detail="Sessione non trovata")
+    return {"ok": True, "saved": len(delta), "rejected_late": len(req.answers) - len(delta)}
+
+
 class SubmitRequest(BaseModel):
     answers: Dict[str, Any] = Field(default_factory=dict)  # {questionId: userAnswer}
 
 @router.post("/{session_id}/submit")
 def submit(session_id: str, req: SubmitRequest):
-    s = SESSIONS.get(session_id)
+    s = _get_session(session_id)
     if not s:
         raise HTTPException(status_code=404, detail="Sessione non trovata")
 
-    s["answers"] = req.answers or {}
+    # dopo la scadenza le risposte del body non valgono (vedi finish)
+    closed = _closed_qids(s, time.time())
+    answers = {k: v for k, v in (req.answers or {}).items() if str(k) not in closed}
+    s["answers"] = answers
     s["finished"] = True
+    if not s.get("stateless"):
+        SESSIONS.put(session_id, s)
 
-    questions_full = s.get("questions_full", [])
+    # domande cancellate a metà sessione: non si contano
+    questions_full = [q for q in _session_questions(s) if not q.get("unavailable")]
     total = len(questions_full)
     correct = 0
     wrong = 0
@@ -311,7 +437,7 @@ def submit(session_id: str, req: SubmitRequest):
     for q in questions_full:
         qid = str(q.get("id"))
         tipo = _norm(q.get("tipo"))
-        user = (req.answers or {}).get(qid, None)
+        user = answers.get(qid, None)
 
         if user is None or (isinstance(user, str) and user.strip() == ""):
             blank += 1
@@ -390,32 +516,15 @@ def _letter_to_index(v: Any) -> Optional[int]:
         return None
 
 
-@router.post("/finish")
-@router.post("/finish/")
-@router.post("/end")
-@router.post("/end/")
-def finish(req: FinishRequest, request: Request):
-    # accetta sia session_id nel body sia nell'url (frontend invia nel body)
-    session_id = req.session_id
-    s = SESSIONS.get(session_id)
-    if not s:
-        raise HTTPException(status_code=404, detail="Sessione non trovata")
-
-    # converte answers array -> dict stabile {qid: answer}
-    amap: Dict[str, Any] = {}
-    for a in req.answers or []:
-        amap[str(a.id)] = a.answer
-
-    # riusa la logica submit ma con parsing più elastico
-    s["answers"] = amap
-    s["finished"] = True
-
-    questions_full = s.get("questions_full", [])
+def _grade(s: Dict[str, Any], amap: Dict[str, Any], question_ids: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Grade a session against {qid: answer}; shared by finish() and the deadline scanner."""
+    # domande cancellate a metà sessione: non si contano
+    questions_full = [q for q in _session_questions(s) if not q.get("unavailable")]
 
     # se arrivano question_ids, correggi solo quelle (ordine preservato)
     qid_filter = None
-    if req.question_ids:
-        qid_filter = {str(x) for x in req.question_ids if str(x).strip()}
+    if question_ids:
+        qid_filter = {str(x) for x in question_ids if str(x).strip()}
     if qid_filter is not None:
         questions_full = [q for q in questions_full if str(q.get("id")) in qid_filter]
 
@@ -524,54 +633,7 @@ def finish(req: FinishRequest, request: Request):
         total_vote += vote30
         max_vote += 30.0
 
-
-    # =========================
-    # Persist user run (if logged in)
-    # =========================
-    user = try_get_user(request)
-    if user and user.get("email"):
-        email = str(user.get("email"))
-        runs = _runs_read()
-        # avoid duplicates: update if same session_id already saved for this user
-        existing_idx = next((i for i, r in enumerate(runs)
-                             if str(r.get("email")) == email and str(r.get("session_id")) == session_id), None)
-        run_id = runs[existing_idx].get("id") if existing_idx is not None else uuid4().hex
-
-        # build per_subject with stable keys for frontend profile
-        per_subject_profile = {}
-        for mat, st in per_subject_out.items():
-            per_subject_profile[mat] = {
-                **st,
-                "vote": float(st.get("vote30", 0.0)),
-                "max_vote": 30.0,
-            }
-
-        title_parts = [m for m in (s.get("order") or [])]
-        title = "Simulazione • " + " + ".join(title_parts) if title_parts else "Simulazione"
-
-        run_record = {
-            "id": run_id,
-            "session_id": session_id,
-            "email": email,
-            "title": title,
-            "created_at": datetime.utcnow().isoformat(),
-            "score_total": round(total_vote, 2),
-            "score_max": round(max_vote, 0),
-            "per_subject": per_subject_profile,
-            "details": details,
-            # keep also raw metrics (optional)
-            "correct": correct,
-            "wrong": wrong,
-            "blank": blank,
-        }
-
-        if existing_idx is not None:
-            runs[existing_idx] = run_record
-        else:
-            runs.insert(0, run_record)
-        _runs_write(runs)
     return {
-        "session_id": session_id,
         "total": total,
         "correct": correct,
         "wrong": wrong,
@@ -583,4 +645,96 @@ def finish(req: FinishRequest, request: Request):
         "max_vote": round(max_vote, 0),
         "details": details,
         "scoring": {"correct": 1, "wrong": -0.1, "blank": 0},
-    }
\ No newline at end of file
+    }
+
+
+def _save_run(session_id: str, s: Dict[str, Any], email: str, graded: Dict[str, Any]) -> None:
+    """Persist the graded session as a user run (upsert on email + session_id)."""
+    # build per_subject with stable keys for frontend profile
+    per_subject_profile = {}
+    for mat, st in graded["per_subject"].items():
+        per_subject_profile[mat] = {
+            **st,
+            "vote": float(st.get("vote30", 0.0)),
+            "max_vote": 30.0,
+        }
+
+    title_parts = [m for m in (s.get("order") or [])]
+    title = "Simulazione • " + " + ".join(title_parts) if title_parts else "Simulazione"
+
+    run_record = {
+        "id": uuid4().hex,
+        "session_id": session_id,
+        "email": email,
+        "title": title,
+        "created_at": datetime.utcnow().isoformat(),
+        "score_total": graded["total_vote"],
+        "score_max": graded["max_vote"],
+        "per_subject": per_subject_profile,
+        "details": graded["details"],
+        # keep also raw metrics (optional)
+        "correct": graded["correct"],
+        "wrong": graded["wrong"],
+        "blank": graded["blank"],
+    }
+    runs_store.upsert_run(run_record)
+
+
+@router.post("/finish")
+@router.post("/finish/")
+@router.post("/end")
+@router.post("/end/")
+async def finish(req: FinishRequest, request: Request):
+    # accetta sia session_id nel body sia nell'url (frontend invia nel body)
+    session_id = req.session_id
+    store, s = await run_in_threadpool(_finish_session, session_id)
+    if not s:
+        raise HTTPException(status_code=404, detail="Sessione non trovata")
+    if s.get("stateless"):
+        # run e risultato usano l'id breve contenuto nel token
+        session_id = str(s.get("id"))
+
+    # risposte dei checkpoint (PATCH /answers) + quelle del body, che prevalgono;
+    # una risposta vuota nel body non cancella quella già salvata.
+    # Dopo la scadenza (anche della singola materia) valgono solo i checkpoint.
+    amap: Dict[str, Any] = await run_in_threadpool(_saved_answers, req.session_id, store, s)
+    closed = _closed_qids(s, time.time())
+    late = 0
+    for a in req.answers or []:
+        qid = str(a.id)
+        if qid in closed:
+            late += 1
+            continue
+        if _blank(a.answer) and qid in amap:
+            continue
+        amap[qid] = a.answer
+
+    # compare-and-set condiviso con lo scanner delle scadenze: una sola consegna
+    # viene salvata; le altre (ripetute o dopo la correzione automatica)
+    # restituiscono il risultato senza riscriverlo
+    target, key = _answers_target(req.session_id, store, s)
+    first = await run_in_threadpool(target.claim_finish, key)
+    if not first and s.get("finished") and isinstance(s.get("answers"), dict):
+        amap = dict(s["answers"])
+
+    # riusa la logica submit ma con parsing più elastico
+    if first:
+        s["answers"] = amap
+        s["finished"] = True
+        if store is not None:
+            await run_in_threadpool(store.put, session_id, s)
+
+    graded = await run_in_threadpool(_grade, s, amap, req.question_ids)
+    if not first:
+        return {"session_id": session_id, **graded, "late_answers_ignored": late, "already_finished": True}
+
+    # =========================
+    # Persist user run (if logged in)
+    # =========================
+    user = try_get_user(request)
+    email = (user or {}).get("email") or s.get("email")  # email salvata allo start
+    if email:
+        # SQLite: fuori dall'event loop (upsert su email+session_id)
+        await run_in_threadpool(_save_run, session_id, s, str(email), graded)
+
+    return {"session_id": session_id, **graded, "late_answers_ignored": late}
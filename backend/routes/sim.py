@@ -3,7 +3,6 @@ from pydantic import BaseModel, Field
 from typing import List, Optional, Literal, Dict, Any
 from datetime import datetime
 import uuid
-import random
 
 router = APIRouter(prefix="/api/sim", tags=["sim"])
 
@@ -31,22 +30,16 @@ class SubmitAnswer(BaseModel):
 class SubmitBody(BaseModel):
     answers: List[SubmitAnswer]
 
-from supabase_db import fetch_all_questions
+import question_bank
+import session_store
 
-# banca domande rimossa: usa Supabase
+# banca domande rimossa: usa Supabase (cache di processo in question_bank)
 
-SESSIONS: Dict[str, Dict[str, Any]] = {}
+# sessioni con scadenza (duration_min + grace) e limite di memoria
+SESSIONS = session_store.get_store("sim_legacy")
 
 def _pick_questions(materia: str, tipo: str, count: int, tags: List[str]) -> List[Dict[str, Any]]:
-    pool = [q for q in fetch_all_questions() if q.get("materia") == materia and q.get("tipo") == tipo]
-    if tags:
-        tags_norm = set([t.strip().lower() for t in tags if t.strip()])
-        pool = [
-            q for q in pool
-            if any(str(t).strip().lower() in tags_norm for t in (q.get("tag") or []))
-        ]
-    random.shuffle(pool)
-    return pool[:count]
+    return question_bank.pick(materia, tipo, count, tags)
 
 @router.post("/start")
 async def start(body: StartBody):
@@ -70,11 +63,11 @@ async def start(body: StartBody):
         raise HTTPException(status_code=404, detail="Nessuna domanda trovata con questi filtri")
 
     session_id = str(uuid.uuid4())
-    SESSIONS[session_id] = {
+    SESSIONS.put(session_id, {
         "created_at": datetime.utcnow().isoformat(),
         "duration_min": body.duration_min,
         "questions": questions,
-    }
+    })
 
     # invia al frontend senza soluzioni
     safe_questions = []
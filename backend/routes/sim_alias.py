@@ -15,8 +15,8 @@ async def start(request: Request):
         payload = StartPayload.model_validate(body)
     except ValidationError as e:
         raise HTTPException(status_code=400, detail=f"Payload non valido: {e.errors()}")
-    # Call existing handler (sync)
-    return start_simulazioni(payload, request)
+    # Call existing handler (async)
+    return await start_simulazioni(payload, request)
 
 @router.post("/{session_id}/submit")
 async def submit(session_id: str, request: Request):
@@ -28,4 +28,4 @@ async def submit(session_id: str, request: Request):
         payload = SubmitPayload.model_validate(body)
     except ValidationError as e:
         raise HTTPException(status_code=400, detail=f"Payload non valido: {e.errors()}")
-    return submit_simulazioni(session_id, payload, request)
+    return submit_simulazioni(session_id, payload)
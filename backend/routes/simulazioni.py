@@ -1,25 +1,23 @@
 from fastapi import APIRouter, HTTPException, Request, Depends
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field
-from .sessioni import FinishRequest, finish as finish_session
+from .sessioni import FinishRequest, finish as finish_session, _session_questions, _closed_qids
 from typing import List, Optional, Literal, Dict, Any, Union
 from datetime import datetime
 import uuid
 import random
 import os
-import json
+import time
 from pathlib import Path
 
 from auth import admin_required, try_get_user
-from supabase_db import fetch_all_questions, insert_session
+import question_bank
+import session_store
+import storage
+from question_bank import get_bank
 
 router = APIRouter(prefix="/api/simulazioni", tags=["simulazioni"])
 
-# =========================
-# In-memory sessions (DEV)
-# =========================
-SESSIONS: Dict[str, Dict[str, Any]] = {}
-
-
 # =========================
 # Models
 # =========================
@@ -49,31 +47,11 @@ class SubmitPayload(BaseModel):
 
 
 # =========================
-# CRUD Simulazioni (JSON) — per Dashboard Admin
+# CRUD Simulazioni — per Dashboard Admin
 # =========================
 BASE_DIR = Path(__file__).resolve().parents[1]
 DATA_DIR = BASE_DIR / "data"
-SIM_FILE = DATA_DIR / "simulazioni.json"
-
-
-def _ensure_db():
-    DATA_DIR.mkdir(parents=True, exist_ok=True)
-    if not SIM_FILE.exists():
-        SIM_FILE.write_text("[]", encoding="utf-8")
-
-
-def _read_all() -> List[dict]:
-    _ensure_db()
-    try:
-        data = json.loads(SIM_FILE.read_text(encoding="utf-8") or "[]")
-        return data if isinstance(data, list) else []
-    except Exception:
-        return []
-
-
-def _write_all(items: List[dict]):
-    _ensure_db()
-    SIM_FILE.write_text(json.dumps(items, ensure_ascii=False, indent=2), encoding="utf-8")
+# record in storage.simulazioni() (JSON o SQLite, vedi storage.py)
 
 
 class SimDomanda(BaseModel):
@@ -100,68 +78,50 @@ class SimulazioneIn(BaseModel):
 @router.get("")
 @router.get("/")
 async def list_simulazioni(request: Request, include_unpublished: bool = False):
-    items = _read_all()
     if include_unpublished:
         admin_required(request)
-        return items
-    return [x for x in items if x.get("pubblicata") is True]
+        return storage.simulazioni().all()
+    return storage.simulazioni().query({"pubblicata": True})
 
 
 @router.post("")
 @router.post("/")
 async def create_simulazione(payload: SimulazioneIn, _=Depends(admin_required)):
-    items = _read_all()
     new_item = payload.model_dump()
     new_item["id"] = uuid.uuid4().hex
     new_item["created_at"] = datetime.utcnow().isoformat()
-    items.insert(0, new_item)
-    _write_all(items)
+    storage.simulazioni().put(new_item)
     return new_item
 
 
 @router.put("/{sim_id}")
 async def update_simulazione(sim_id: str, payload: SimulazioneIn, _=Depends(admin_required)):
-    items = _read_all()
-    idx = next((i for i, x in enumerate(items) if x.get("id") == sim_id), None)
-    if idx is None:
+    col = storage.simulazioni()
+    cur = col.get(sim_id)
+    if cur is None:
         raise HTTPException(status_code=404, detail="Simulazione non trovata")
-    cur = items[idx]
     upd = payload.model_dump()
     upd["id"] = sim_id
     upd["created_at"] = cur.get("created_at") or datetime.utcnow().isoformat()
-    items[idx] = upd
-    _write_all(items)
+    col.put(upd)
     return upd
 
 
 @router.patch("/{sim_id}/toggle")
 async def toggle_simulazione(sim_id: str, _=Depends(admin_required)):
-    items = _read_all()
-    for x in items:
-        if x.get("id") == sim_id:
-            x["pubblicata"] = not bool(x.get("pubblicata", True))
-            _write_all(items)
-            # salva sessione su Supabase (se user_id disponibile)
-    try:
-        uid = sess.get('user_id')
-        if uid:
-            # materia: se multi-sezione mettiamo 'Misto'
-            materia = sess.get('materia') or ('Misto' if len(set([q.get('materia') for q in questions])) > 1 else (questions[0].get('materia') if questions else ''))
-            insert_session(uid, materia or 'Misto', correct, len(questions))
-    except Exception as e:
-        print('Session save error:', e)
-
+    col = storage.simulazioni()
+    x = col.get(sim_id)
+    if x is None:
+        raise HTTPException(status_code=404, detail="Simulazione non trovata")
+    x["pubblicata"] = not bool(x.get("pubblicata", True))
+    col.put(x)
     return {"success": True, "pubblicata": x["pubblicata"]}
-    raise HTTPException(status_code=404, detail="Simulazione non trovata")
 
 
 @router.delete("/{sim_id}")
 async def delete_simulazione(sim_id: str, _=Depends(admin_required)):
-    items = _read_all()
-    new_items = [x for x in items if x.get("id") != sim_id]
-    if len(new_items) == len(items):
+    if not storage.simulazioni().delete(sim_id):
         raise HTTPException(status_code=404, detail="Simulazione non trovata")
-    _write_all(new_items)
     return {"success": True}
 
 
@@ -205,58 +165,21 @@ def _clean_tags(tags) -> List[str]:
     s = str(tags).strip()
     return [s] if s else []
 
-def _materia_match(q_materia: str, materia: str) -> bool:
-    m = _norm(materia)
-    if not m:
-        return True
-    qm = _norm(q_materia)
-    return qm == m
-
-def _infer_tipo(q: Dict[str, Any]) -> str:
-    """Inferisce il tipo se il campo 'tipo' è mancante."""
-    try:
-        opzioni = q.get("opzioni")
-        if isinstance(opzioni, list) and len(opzioni) > 0:
-            return "scelta"
-    except Exception:
-        pass
-    # completamento se ha risposte
-    if q.get("risposte") or q.get("risposta"):
-        return "completamento"
-    return ""
-
 BASE_DIR = Path(__file__).resolve().parents[1]
 DATA_DIR = BASE_DIR / "data"
 DOMANDE_FILE = DATA_DIR / "domande.json"
 
-SESSIONS_FILE = DATA_DIR / "sim_sessions.json"  # persisted sessions (JSON)
-
-def _ensure_files():
-    DATA_DIR.mkdir(parents=True, exist_ok=True)
-    if not DOMANDE_FILE.exists():
-        DOMANDE_FILE.write_text("[]", encoding="utf-8")
-    if not SESSIONS_FILE.exists():
-        SESSIONS_FILE.write_text("{}", encoding="utf-8")
+# sessioni persistite una per record (session_store, chiave session_id), con
+# scadenza duration_min + grace al posto del vecchio limite di 500 sessioni
+SESSIONS = session_store.get_store("simulazioni", persistent=True)
 
 def _load_domande() -> List[Dict[str, Any]]:
     """Carica la banca domande da Supabase (fonte unica)."""
     try:
-        return fetch_all_questions()
+        return get_bank()
     except Exception:
         return []
 
-def _load_sessions() -> Dict[str, Any]:
-    _ensure_files()
-    try:
-        data = json.loads(SESSIONS_FILE.read_text(encoding="utf-8") or "{}")
-        return data if isinstance(data, dict) else {}
-    except Exception:
-        return {}
-
-def _save_sessions(db: Dict[str, Any]) -> None:
-    _ensure_files()
-    SESSIONS_FILE.write_text(json.dumps(db, ensure_ascii=False, indent=2), encoding="utf-8")
-
 def _public_question(q: Dict[str, Any]) -> Dict[str, Any]:
     # public payload (no solutions)
     out = dict(q)
@@ -265,65 +188,20 @@ def _public_question(q: Dict[str, Any]) -> Dict[str, Any]:
     out.pop("risposte", None)
     return out
 
-def _match_tags(q: Dict[str, Any], tags: List[str]) -> bool:
-    if not tags:
-        return True
-    qtags = q.get("tag") or []
-    if not isinstance(qtags, list):
-        return False
-    qtags_norm = {_norm(x) for x in qtags}
-    return any(_norm(t) in qtags_norm for t in tags)
-
-def _pick_questions(bank, materia: str, tipo: str, tags, difficolta, n: int):
-    req_tipo = _norm_tipo(tipo)
-    tags_norm = _clean_tags(tags)
-    dif_norm = _norm(difficolta) if difficolta else ""
-
-    filtered = []
-    for q in bank:
-        if not _materia_match(q.get("materia", ""), materia):
-            continue
-
-        qtipo = _norm_tipo(q.get("tipo")) or _infer_tipo(q)
-        if req_tipo and qtipo != req_tipo:
-            continue
-
-        if tags_norm and not _match_tags(q, tags_norm):
-            continue
-
-        if dif_norm:
-            qdif = _norm(q.get("difficolta"))
-            if qdif and qdif != dif_norm:
-                continue
-
-        filtered.append(q)
-
+async def _pick_questions(materia: str, tipo: str, tags, difficolta, n: int, rng: Optional[random.Random] = None):
     if n <= 0:
         return []
-    random.shuffle(filtered)
-    return filtered[:n]
-    if len(filtered) <= n:
-        # not enough: return all we have (shuffle)
-        random.shuffle(filtered)
-        return filtered
-    return random.sample(filtered, n)
+    # indice della banca (question_bank): le domande senza difficoltà valgono per tutte.
+    # "public": in sessione solo id + versione, la correzione risolve le domande dalla banca
+    return await question_bank.apick(materia, _norm_tipo(tipo), n, tags=_clean_tags(tags), difficolta=difficolta or None,
+                                     rng=rng, profile="public")
 
 def _session_store_put(session_id: str, payload: Dict[str, Any]) -> None:
-    db = _load_sessions()
-    db[session_id] = payload
-    # keep DB bounded (optional): drop very old sessions
-    # Here: keep max 500 sessions
-    if len(db) > 500:
-        # remove oldest by started_at timestamp if present
-        items = list(db.items())
-        items.sort(key=lambda kv: kv[1].get("started_at", ""))
-        db = dict(items[-500:])
-    _save_sessions(db)
+    SESSIONS.put(session_id, {**payload, "session_id": session_id})
 
 def _session_store_get(session_id: str) -> Optional[Dict[str, Any]]:
-    db = _load_sessions()
-    v = db.get(session_id)
-    return v if isinstance(v, dict) else None
+    return SESSIONS.get(session_id)
+
 # =========================
 # Routes
 # =========================
@@ -337,9 +215,7 @@ def get_session(session_id: str):
     sess = _session_store_get(session_id)
     if not sess:
         raise HTTPException(status_code=404, detail="Sessione non trovata.")
-    questions = sess.get("questions") or []
-    if not isinstance(questions, list):
-        questions = []
+    questions = _session_questions(sess)
     return {
         "session_id": session_id,
         "started_at": sess.get("started_at"),
@@ -358,9 +234,7 @@ def get_simulazione_or_session(sim_or_session_id: str, request: Request):
     """
     sess = _session_store_get(sim_or_session_id)
     if sess:
-        questions = sess.get("questions") or []
-        if not isinstance(questions, list):
-            questions = []
+        questions = _session_questions(sess)
         return {
             "session_id": sim_or_session_id,
             "started_at": sess.get("started_at"),
@@ -369,8 +243,7 @@ def get_simulazione_or_session(sim_or_session_id: str, request: Request):
             "questions": [_public_question(q) for q in questions],
         }
 
-    items = _read_all()
-    item = next((x for x in items if x.get("id") == sim_or_session_id), None)
+    item = storage.simulazioni().get(sim_or_session_id)
     if not item:
         raise HTTPException(status_code=404, detail="Simulazione non trovata")
 
@@ -382,7 +255,8 @@ def get_simulazione_or_session(sim_or_session_id: str, request: Request):
 
 
 @router.post("/start")
-def start(payload: StartPayload, request: Request):
+@router.post("/start/")
+async def start(payload: StartPayload, request: Request):
     if not payload.sections:
         raise HTTPException(status_code=422, detail="Nessuna sezione selezionata.")
 
@@ -390,32 +264,45 @@ def start(payload: StartPayload, request: Request):
     if isinstance(order, str):
         order = [order]
 
-    bank = fetch_all_questions()
-    if not bank:
-        raise HTTPException(status_code=500, detail="Supabase ha restituito 0 domande. Controlla RLS/policies o SUPABASE_KEY su Render.")
-    if not bank:
-        raise HTTPException(status_code=500, detail="Nessuna domanda trovata su Supabase (tabella questions vuota o env mancanti).")
+    # con il picker lato server (QUESTION_PICK_MODE=db) la banca non va scaricata
+    if not question_bank.server_side_pick():
+        bank = await question_bank.aget_bank()
+        if not bank:
+            raise HTTPException(status_code=500, detail="Supabase ha restituito 0 domande. Controlla RLS/policies o SUPABASE_KEY su Render.")
 
     session_id = str(uuid.uuid4())
     started_at = datetime.utcnow().isoformat()
 
-    # Build questions from the real bank
+    # Build questions from the real bank (seeded: the draw is reproducible)
+    seed = random.getrandbits(32)
+    rng = random.Random(seed)
     picked: List[Dict[str, Any]] = []
     for sec in payload.sections:
-        picked += _pick_questions(bank, sec.materia, "scelta", sec.tag, sec.difficolta, int(sec.scelta or 0))
-        picked += _pick_questions(bank, sec.materia, "completamento", sec.tag, sec.difficolta, int(sec.completamento or 0))
+        picked += await _pick_questions(sec.materia, "scelta", sec.tag, sec.difficolta, int(sec.scelta or 0), rng)
+        picked += await _pick_questions(sec.materia, "completamento", sec.tag, sec.difficolta, int(sec.completamento or 0), rng)
 
     # shuffle within selected set
-    random.shuffle(picked)
-
-    # Store full questions (with solutions) in persisted sessions, but return public version
-    _session_store_put(session_id, {
+    rng.shuffle(picked)
+    qids, qrev = question_bank.question_refs(picked)
+
+    # Persist only ids + versions (bodies are resolved from the bank), return public version
+    # (I/O su SQLite/Redis: fuori dall'event loop)
+    minutes = int(payload.duration_min or 0)
+    user = try_get_user(request)
+    sess = {
         "session_id": session_id,
         "started_at": started_at,
-        "duration_min": int(payload.duration_min or 0),
+        "duration_min": minutes,
         "order": payload.order or [],
-        "questions": picked,
-    })
+        "sections": [sec.model_dump() for sec in payload.sections],
+        "seed": seed,
+        "qids": qids,
+        "qrev": qrev,
+        "deadline_at": (time.time() + minutes * 60) if minutes > 0 else None,
+        "email": (user or {}).get("email"),
+    }
+    # deadline_at nello store: correzione automatica dallo scanner delle scadenze
+    await run_in_threadpool(_session_store_put, session_id, sess)
 
     return {
         "session_id": session_id,
@@ -423,6 +310,7 @@ def start(payload: StartPayload, request: Request):
         "order": payload.order or [],
         "questions": [_public_question(q) for q in picked],
         "created_at": started_at,
+        "deadline_at": sess["deadline_at"],
     }
 
 
@@ -432,15 +320,17 @@ def submit(session_id: str, payload: SubmitPayload):
     if not sess:
         raise HTTPException(status_code=404, detail="Sessione non trovata (server riavviato o sessione scaduta).")
 
-    questions = sess.get("questions") or []
-    if not isinstance(questions, list):
-        questions = []
+    questions = [q for q in _session_questions(sess) if not q.get("unavailable")]
 
     qmap = {q.get("id"): q for q in questions if isinstance(q, dict) and q.get("id")}
     correct = 0
     results = []
 
+    # dopo la scadenza le risposte non valgono
+    closed = _closed_qids(sess, time.time())
     for a in payload.answers:
+        if str(a.id) in closed:
+            continue
         q = qmap.get(a.id)
         if not q:
             results.append({
@@ -515,22 +405,9 @@ def submit(session_id: str, payload: SubmitPayload):
 @router.post("/finish/")
 @router.post("/end")
 @router.post("/end/")
-def finish(req: FinishRequest, request: Request):
+async def finish(req: FinishRequest, request: Request):
     """Alias per compatibilità col frontend: POST /api/simulazioni/finish.
 
     Reindirizza alla logica in routes/sessioni.py che calcola e salva il risultato.
     """
-    return finish_session(req, request)
-
-# ====== ALIAS START (fix 405 /api/simulazioni/start) ======
-# Questo alias inoltra la richiesta allo start reale: /api/sim/start
-
-from fastapi import Request
-from backend.routes.sim_alias import start as _real_start  # usa lo start già esistente
-
-@router.post("/start")
-@router.post("/start/")
-def start(payload: StartPayload, request: Request):
-async def start_alias_slash(payload: dict, request: Request):
-    return await _real_start(payload, request)
-
+    return await finish_session(req, request)
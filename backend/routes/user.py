@@ -1,54 +1,78 @@
-from fastapi import APIRouter, Depends, HTTPException
-from typing import Any, Dict, List
-from pathlib import Path
-from datetime import datetime
+from fastapi import APIRouter, Depends, HTTPException, Query
+from typing import Any, Dict, List, Optional
+import base64
 import json
+import logging
+import time
 
+import runs_store
 from auth import user_required
 
 router = APIRouter(prefix="/api/user", tags=["user"])
 
-BASE_DIR = Path(__file__).resolve().parents[1]
-DATA_DIR = BASE_DIR / "data"
-RUNS_FILE = DATA_DIR / "user_runs.json"
+logger = logging.getLogger("dinomed.user")
 
-def _ensure():
-    DATA_DIR.mkdir(parents=True, exist_ok=True)
-    if not RUNS_FILE.exists():
-        RUNS_FILE.write_text("[]", encoding="utf-8")
+RUNS_PAGE_MAX = 200
 
-def _read_all() -> List[Dict[str, Any]]:
-    _ensure()
+def _encode_cursor(run: Dict[str, Any]) -> str:
+    raw = json.dumps([str(run.get("created_at") or ""), str(run.get("id") or "")])
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+def _decode_cursor(cursor: str):
     try:
-        data = json.loads(RUNS_FILE.read_text(encoding="utf-8") or "[]")
-        return data if isinstance(data, list) else []
+        pad = "=" * (-len(cursor) % 4)
+        created_at, run_id = json.loads(base64.urlsafe_b64decode(cursor + pad).decode("utf-8"))
+        return str(created_at), str(run_id)
     except Exception:
-        return []
-
-def _write_all(items: List[Dict[str, Any]]):
-    _ensure()
-    RUNS_FILE.write_text(json.dumps(items, ensure_ascii=False, indent=2), encoding="utf-8")
+        raise HTTPException(status_code=422, detail="cursor non valido")
 
 @router.get("/runs")
-def list_runs(user=Depends(user_required)):
+def list_runs(
+    user=Depends(user_required),
+    limit: Optional[int] = Query(default=None, ge=1, le=RUNS_PAGE_MAX),
+    cursor: Optional[str] = None,
+    view: str = Query(default="summary", pattern="^(summary|full)$"),
+):
+    """Runs of the logged user, newest first.
+
+    Default: every run as a summary (title, date, per-subject votes, no
+    `details`), which is what the profile page aggregates. With `limit` the
+    list is paginated: pass `next_cursor` back to get the following page.
+    Details of a single run: /api/user/runs/{run_id}.
+    """
+    t0 = time.perf_counter()
     email = str(user.get("email") or "")
-    items = [x for x in _read_all() if str(x.get("email") or "") == email]
-    # ordina dal più recente
-    items.sort(key=lambda x: str(x.get("created_at") or ""), reverse=True)
+    after = _decode_cursor(cursor) if cursor else None
+    # una riga in più per sapere se esiste la pagina successiva
+    fetch = limit + 1 if limit is not None else None
+    read: Dict[str, Any] = {}
+    items = runs_store.list_runs(email, limit=fetch, cursor=after, full=(view == "full"), stats=read)
+
+    next_cursor = None
+    if limit is not None and len(items) > limit:
+        items = items[:limit]
+        next_cursor = _encode_cursor(items[-1])
+
     # non ritornare email dentro ogni riga (non serve al frontend)
-    sanitized = []
+    sanitized: List[Dict[str, Any]] = []
     for x in items:
-        y = dict(x)
-        y.pop("email", None)
-        sanitized.append(y)
-    return {"items": sanitized}
+        x.pop("email", None)
+        sanitized.append(x)
+    out = {"items": sanitized, "next_cursor": next_cursor}
+
+    # byte: lunghezza delle colonne lette da SQLite, niente seconda serializzazione
+    logger.info(
+        "list_runs items=%d view=%s has_more=%s bytes=%d ms=%.1f",
+        len(sanitized), view, next_cursor is not None, read.get("bytes", 0),
+        (time.perf_counter() - t0) * 1000.0,
+    )
+    return out
 
 @router.get("/runs/{run_id}")
 def get_run(run_id: str, user=Depends(user_required)):
     email = str(user.get("email") or "")
-    for x in _read_all():
-        if str(x.get("id")) == str(run_id) and str(x.get("email") or "") == email:
-            y = dict(x)
-            y.pop("email", None)
-            return y
-    raise HTTPException(status_code=404, detail="Run not found")
+    x = runs_store.get_run(str(run_id))
+    if x is None or str(x.get("email") or "") != email:
+        raise HTTPException(status_code=404, detail="Run not found")
+    x.pop("email", None)
+    return x
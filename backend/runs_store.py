@@ -0,0 +1,508 @@
+"""User simulation runs (storico profilo) on SQLite.
+
+Tabella `user_runs` nello stesso database WAL di storage.py, con colonne
+tipizzate per le chiavi di accesso, il record completo in `data` (JSON) e la
+proiezione per le liste in `summary` (senza `details`). Il `details` di ogni run
+(testo, opzioni e spiegazione ripetuti per ogni domanda: la gran parte dei byte)
+sta a parte in `details_gz`, JSON compresso gzip, decompresso solo quando si
+apre la singola run (get_run / list_runs(full=True)):
+
+- (email, created_at, id): storico di un utente, dal più recente (cursore keyset)
+- (email, session_id) UNIQUE: una sola run per sessione, /finish ripetuto aggiorna
+
+Accanto c'è `user_stats` (una riga per email, minuscola): aggregato del profilo
+(run, corrette/errate/bianche, somma voti per materia, accuratezza, ultima
+attività) aggiornato nella stessa transazione di upsert_run.
+
+Insert e lookup costano O(log n) sugli indici invece di rileggere e riscrivere
+tutto data/user_runs.json. Al primo avvio (tabella assente) il file JSON legacy
+viene importato; scripts/migrate_user_runs.py fa la stessa cosa a mano
+(le run già presenti non vengono sovrascritte, si può rilanciare).
+"""
+
+from __future__ import annotations
+
+import gzip
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from storage import DATA_DIR, sqlite_connection
+
+logger = logging.getLogger("dinomed.runs")
+
+LEGACY_FILE = DATA_DIR / "user_runs.json"
+
+_READY = False
+_READY_LOCK = threading.Lock()
+
+
+def _create(conn) -> None:
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='user_runs'"
+    ).fetchone()
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS user_runs ("
+        " id TEXT PRIMARY KEY,"
+        " email TEXT NOT NULL,"
+        " session_id TEXT,"
+        " created_at TEXT NOT NULL DEFAULT '',"
+        " data TEXT NOT NULL,"
+        " summary TEXT,"
+        " details_gz BLOB)"
+    )
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(user_runs)")}
+    if "summary" not in cols:
+        conn.execute("ALTER TABLE user_runs ADD COLUMN summary TEXT")
+        _backfill_summaries(conn)
+    if "details_gz" not in cols:
+        # le run già salvate restano con details in chiaro finché compact_runs() non passa
+        conn.execute("ALTER TABLE user_runs ADD COLUMN details_gz BLOB")
+    # (email, created_at, id): storico dal più recente + cursore keyset
+    conn.execute("DROP INDEX IF EXISTS user_runs_email_created")
+    conn.execute("CREATE INDEX IF NOT EXISTS user_runs_email_created_id ON user_runs (email, created_at, id)")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS user_runs_email_session ON user_runs (email, session_id)")
+    stats_exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='user_stats'"
+    ).fetchone()
+    conn.execute("CREATE TABLE IF NOT EXISTS user_stats (email TEXT PRIMARY KEY, data TEXT NOT NULL)")
+    if not exists and LEGACY_FILE.exists():
+        n = _import_json(conn, LEGACY_FILE)
+        logger.info("user_runs: importate %d run da %s", n, LEGACY_FILE)
+    elif exists and not stats_exists:
+        n = _rebuild_stats(conn)
+        logger.info("user_stats: aggregati ricostruiti per %d utenti", n)
+
+
+def _conn():
+    global _READY
+    conn = sqlite_connection()
+    if not _READY:
+        with _READY_LOCK:
+            if not _READY:
+                _create(conn)
+                _READY = True
+    return conn
+
+
+SUMMARY_FIELDS = (
+    "id", "session_id", "title", "created_at", "score_total", "score_max",
+    "per_subject", "correct", "wrong", "blank",
+)
+
+
+def run_summary(rec: Dict[str, Any]) -> Dict[str, Any]:
+    """List projection of a run: everything the profile page needs except `details`."""
+    return {k: rec[k] for k in SUMMARY_FIELDS if k in rec}
+
+
+DETAILS_GZ_LEVEL = 6
+
+
+def _pack_details(details: Any) -> Optional[bytes]:
+    if details is None:
+        return None
+    raw = json.dumps(details, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return gzip.compress(raw, compresslevel=DETAILS_GZ_LEVEL)
+
+
+def _unpack(data: str, details_gz: Optional[bytes]) -> Dict[str, Any]:
+    rec = json.loads(data)
+    if details_gz is not None:
+        rec["details"] = json.loads(gzip.decompress(details_gz).decode("utf-8"))
+    return rec
+
+
+def _row(rec: Dict[str, Any]):
+    sid = rec.get("session_id")
+    body = {k: v for k, v in rec.items() if k != "details"}
+    return (
+        str(rec["id"]),
+        str(rec.get("email") or ""),
+        str(sid) if sid not in (None, "") else None,
+        str(rec.get("created_at") or ""),
+        json.dumps(body, ensure_ascii=False),
+        json.dumps(run_summary(rec), ensure_ascii=False),
+        _pack_details(rec.get("details")),
+    )
+
+
+_UPSERT_SQL = (
+    "INSERT INTO user_runs (id, email, session_id, created_at, data, summary, details_gz) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?) "
+    "ON CONFLICT(id) DO UPDATE SET email=excluded.email, session_id=excluded.session_id, "
+    "created_at=excluded.created_at, data=excluded.data, summary=excluded.summary, "
+    "details_gz=excluded.details_gz"
+)
+
+
+def _backfill_summaries(conn) -> None:
+    rows = conn.execute("SELECT id, data FROM user_runs WHERE summary IS NULL").fetchall()
+    conn.executemany(
+        "UPDATE user_runs SET summary=? WHERE id=?",
+        [(json.dumps(run_summary(json.loads(d)), ensure_ascii=False), i) for i, d in rows],
+    )
+
+
+def _keys(rec: Dict[str, Any]):
+    sid = rec.get("session_id")
+    return str(rec["id"]), str(rec.get("email") or ""), (str(sid) if sid not in (None, "") else None)
+
+
+def _existing(conn, rec: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    # solo `data` (senza details): basta per aggiornare user_stats
+    rid, email, sid = _keys(rec)
+    found = None
+    if sid is not None:
+        found = conn.execute(
+            "SELECT data FROM user_runs WHERE email=? AND session_id=?", (email, sid)
+        ).fetchone()
+    if found is None:
+        found = conn.execute("SELECT data FROM user_runs WHERE id=?", (rid,)).fetchone()
+    return json.loads(found[0]) if found else None
+
+
+def _put(conn, rec: Dict[str, Any], overwrite: bool = True) -> bool:
+    rid, email, sid = _keys(rec)
+    cur = None
+    if sid is not None:
+        # stessa (email, session_id) con id diverso: tiene l'id già salvato
+        cur = conn.execute(
+            "SELECT id FROM user_runs WHERE email=? AND session_id=?", (email, sid)
+        ).fetchone()
+        if cur and cur[0] != rid:
+            rec["id"] = rid = cur[0]
+    if not overwrite:
+        if cur or conn.execute("SELECT 1 FROM user_runs WHERE id=?", (rid,)).fetchone():
+            return False
+    conn.execute(_UPSERT_SQL, _row(rec))
+    return True
+
+
+def _import_json(conn, path: Path) -> int:
+    try:
+        data = json.loads(path.read_text(encoding="utf-8") or "[]")
+    except Exception as e:
+        logger.error("user_runs: %s illeggibile (%s)", path, e)
+        return 0
+    if not isinstance(data, list):
+        return 0
+    n = 0
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # il file è dal più recente e non si sovrascrive: vince la run più nuova,
+        # e le run già presenti nello store restano com'erano
+        for rec in data:
+            if isinstance(rec, dict) and rec.get("id") and rec.get("email"):
+                rec = dict(rec)
+                if _put(conn, rec, overwrite=False):
+                    _stats_apply(conn, rec, +1)
+                    n += 1
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return n
+
+
+# =========================
+# User stats (aggregato incrementale)
+# =========================
+def _run_accuracy(r: Dict[str, Any]) -> Optional[float]:
+    # overallPct se presente, poi accuracy_pct, poi correct/total
+    for k in ("overallPct", "accuracy_pct"):
+        if r.get(k) is not None:
+            try:
+                return float(r[k])
+            except Exception:
+                return None
+    if r.get("correct") is not None and r.get("total") is not None:
+        try:
+            c = float(r["correct"]); t = float(r["total"])
+            return (c / t) * 100.0 if t > 0 else None
+        except Exception:
+            return None
+    return None
+
+
+def _num(v: Any) -> float:
+    try:
+        return float(v or 0)
+    except Exception:
+        return 0.0
+
+
+def _empty_stats(email: str) -> Dict[str, Any]:
+    return {
+        "email": email,
+        "runs": 0,
+        "correct": 0,
+        "wrong": 0,
+        "blank": 0,
+        "acc_sum": 0.0,
+        "acc_n": 0,
+        "per_subject": {},
+        "last_activity": None,
+    }
+
+
+def _stats_add(st: Dict[str, Any], run: Dict[str, Any], sign: int) -> None:
+    st["runs"] += sign
+    for k in ("correct", "wrong", "blank"):
+        st[k] += sign * int(_num(run.get(k)))
+    acc = _run_accuracy(run)
+    if acc is not None:
+        st["acc_sum"] += sign * acc
+        st["acc_n"] += sign
+    per = st["per_subject"]
+    for mat, ps in (run.get("per_subject") or {}).items():
+        if not isinstance(ps, dict):
+            continue
+        cur = per.setdefault(mat, {"runs": 0, "vote_sum": 0.0, "max_vote_sum": 0.0,
+                                   "correct": 0, "wrong": 0, "blank": 0})
+        cur["runs"] += sign
+        cur["vote_sum"] = round(cur["vote_sum"] + sign * _num(ps.get("vote", ps.get("vote30"))), 4)
+        cur["max_vote_sum"] = round(cur["max_vote_sum"] + sign * _num(ps.get("max_vote", 30.0)), 4)
+        for k in ("correct", "wrong", "blank"):
+            cur[k] += sign * int(_num(ps.get(k)))
+        if cur["runs"] <= 0:
+            per.pop(mat, None)
+    st["acc_sum"] = round(st["acc_sum"], 4)
+    if sign > 0:
+        ts = str(run.get("created_at") or "")
+        if ts and ts > str(st.get("last_activity") or ""):
+            st["last_activity"] = ts
+
+
+def _stats_apply(conn, run: Dict[str, Any], sign: int) -> None:
+    email = str(run.get("email") or "").strip().lower()
+    if not email:
+        return
+    row = conn.execute("SELECT data FROM user_stats WHERE email=?", (email,)).fetchone()
+    st = json.loads(row[0]) if row else _empty_stats(email)
+    _stats_add(st, run, sign)
+    conn.execute(
+        "INSERT INTO user_stats (email, data) VALUES (?, ?) "
+        "ON CONFLICT(email) DO UPDATE SET data=excluded.data",
+        (email, json.dumps(st, ensure_ascii=False)),
+    )
+
+
+def _rebuild_stats(conn) -> int:
+    acc: Dict[str, Dict[str, Any]] = {}
+    for r in conn.execute("SELECT data FROM user_runs ORDER BY created_at, id").fetchall():
+        run = json.loads(r[0])
+        email = str(run.get("email") or "").strip().lower()
+        if email:
+            _stats_add(acc.setdefault(email, _empty_stats(email)), run, +1)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM user_stats")
+        conn.executemany(
+            "INSERT INTO user_stats (email, data) VALUES (?, ?)",
+            [(e, json.dumps(st, ensure_ascii=False)) for e, st in acc.items()],
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return len(acc)
+
+
+# =========================
+# API
+# =========================
+def migrate_from_json(path: Optional[Path] = None) -> int:
+    """Import a user_runs.json file; runs already in the store are left alone."""
+    return _import_json(_conn(), Path(path or LEGACY_FILE))
+
+
+def upsert_run(record: Dict[str, Any]) -> Dict[str, Any]:
+    """Save a run; a second save for the same (email, session_id) keeps the first id."""
+    conn = _conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        old = _existing(conn, record)
+        _put(conn, record)
+        if old is not None:
+            _stats_apply(conn, old, -1)
+        _stats_apply(conn, record, +1)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return record
+
+
+def get_run(run_id: str) -> Optional[Dict[str, Any]]:
+    row = _conn().execute("SELECT data, details_gz FROM user_runs WHERE id=?", (str(run_id),)).fetchone()
+    return _unpack(row[0], row[1]) if row else None
+
+
+def get_run_by_session(email: str, session_id: str) -> Optional[Dict[str, Any]]:
+    row = _conn().execute(
+        "SELECT data, details_gz FROM user_runs WHERE email=? AND session_id=?", (str(email), str(session_id))
+    ).fetchone()
+    return _unpack(row[0], row[1]) if row else None
+
+
+def list_runs(email: str,
+              limit: Optional[int] = None,
+              cursor: Optional[Tuple[str, str]] = None,
+              full: bool = False,
+              stats: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """Runs of one user, newest first.
+
+    `cursor` is the (created_at, id) of the last run of the previous page;
+    `full=False` returns run_summary() projections (no `details`).
+    `stats`, se passato, riceve "bytes": lunghezza delle colonne lette
+    (summary, oppure data + details_gz compresso), senza riserializzare.
+    """
+    cols = "data, details_gz" if full else "summary, NULL"
+    sql = f"SELECT {cols} FROM user_runs WHERE email=?"
+    params: List[Any] = [str(email)]
+    if cursor is not None:
+        sql += " AND (created_at < ? OR (created_at = ? AND id < ?))"
+        params += [cursor[0], cursor[0], cursor[1]]
+    sql += " ORDER BY created_at DESC, id DESC"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(max(0, int(limit)))
+    out: List[Dict[str, Any]] = []
+    size = 0
+    for r in _conn().execute(sql, params):
+        size += len(r[0]) + (len(r[1]) if r[1] is not None else 0)
+        out.append(_unpack(r[0], r[1]))
+    if stats is not None:
+        stats["bytes"] = size
+    return out
+
+
+def count_runs(email: str) -> int:
+    row = _conn().execute("SELECT COUNT(*) FROM user_runs WHERE email=?", (str(email),)).fetchone()
+    return int(row[0]) if row else 0
+
+
+def iter_runs() -> Iterator[Dict[str, Any]]:
+    """Every run, oldest first (for rebuilds/migrations)."""
+    for r in _conn().execute("SELECT data, details_gz FROM user_runs ORDER BY created_at, id"):
+        yield _unpack(r[0], r[1])
+
+
+def get_user_stats(email: str) -> Dict[str, Any]:
+    """Profile aggregate for `email` (zeros if the user has no runs)."""
+    e = str(email or "").strip().lower()
+    row = _conn().execute("SELECT data FROM user_stats WHERE email=?", (e,)).fetchone()
+    st = json.loads(row[0]) if row else _empty_stats(e)
+    st["accuracy_pct"] = round(st["acc_sum"] / st["acc_n"], 1) if st.get("acc_n") else 0.0
+    return st
+
+
+def rebuild_user_stats() -> int:
+    """Recompute every user_stats row from the run history. Returns #users."""
+    return _rebuild_stats(_conn())
+
+
+# =========================
+# Compaction (details -> details_gz)
+# =========================
+_COMPACTION: Dict[str, Any] = {
+    "runs": 0,
+    "bytes_before": 0,
+    "bytes_after": 0,
+    "last_run_at": None,
+    "last_ms": 0.0,
+}
+_COMPACTION_LOCK = threading.Lock()
+
+
+def compact_runs(batch_size: int = 200) -> Dict[str, Any]:
+    """Move inline `details` of older runs into details_gz, in small transactions.
+
+    Returns what this pass did: runs converted and bytes before/after.
+    """
+    conn = _conn()
+    t0 = time.perf_counter()
+    done = {"runs": 0, "bytes_before": 0, "bytes_after": 0}
+    last_rowid = 0
+    while True:
+        rows = conn.execute(
+            "SELECT rowid, data FROM user_runs WHERE details_gz IS NULL AND rowid > ? "
+            "ORDER BY rowid LIMIT ?",
+            (last_rowid, max(1, batch_size)),
+        ).fetchall()
+        if not rows:
+            break
+        last_rowid = rows[-1][0]
+        updates = []
+        for rowid, data in rows:
+            rec = json.loads(data)
+            if "details" not in rec:
+                continue
+            packed = _pack_details(rec.pop("details"))
+            body = json.dumps(rec, ensure_ascii=False)
+            updates.append((body, packed, rowid, data))
+        if updates:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for body, packed, rowid, data in updates:
+                    # stesso predicato della SELECT (+ stesso data): se upsert_run ha
+                    # riscritto la run nel frattempo vince la scrittura concorrente
+                    cur = conn.execute(
+                        "UPDATE user_runs SET data=?, details_gz=? "
+                        "WHERE rowid=? AND details_gz IS NULL AND data=?",
+                        (body, packed, rowid, data),
+                    )
+                    if cur.rowcount:
+                        done["runs"] += 1
+                        done["bytes_before"] += len(data.encode("utf-8"))
+                        done["bytes_after"] += len(body.encode("utf-8")) + len(packed or b"")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+    ms = (time.perf_counter() - t0) * 1000.0
+    with _COMPACTION_LOCK:
+        for k in ("runs", "bytes_before", "bytes_after"):
+            _COMPACTION[k] += done[k]
+        _COMPACTION["last_run_at"] = time.time()
+        _COMPACTION["last_ms"] = round(ms, 1)
+    done["bytes_saved"] = done["bytes_before"] - done["bytes_after"]
+    done["ms"] = round(ms, 1)
+    if done["runs"]:
+        logger.info("compact_runs: %d run, %d -> %d byte", done["runs"], done["bytes_before"], done["bytes_after"])
+    return done
+
+
+def compact_runs_background() -> threading.Thread:
+    """Run compact_runs() once on a daemon thread (startup hook)."""
+    def _job():
+        try:
+            compact_runs()
+        except Exception as e:
+            logger.error("compact_runs fallito: %s", e)
+
+    th = threading.Thread(target=_job, name="runs-compaction", daemon=True)
+    th.start()
+    return th
+
+
+def storage_stats() -> Dict[str, Any]:
+    """Bytes used by the run table (inline JSON vs compressed details) + compaction totals."""
+    row = _conn().execute(
+        "SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0), COALESCE(SUM(LENGTH(details_gz)), 0), "
+        "COALESCE(SUM(details_gz IS NULL AND data LIKE '%\"details\"%'), 0) FROM user_runs"
+    ).fetchone()
+    with _COMPACTION_LOCK:
+        comp = dict(_COMPACTION)
+    comp["bytes_saved"] = comp["bytes_before"] - comp["bytes_after"]
+    return {
+        "runs": int(row[0]),
+        "data_bytes": int(row[1]),
+        "details_gz_bytes": int(row[2]),
+        "uncompacted_runs": int(row[3]),
+        "compaction": comp,
+    }
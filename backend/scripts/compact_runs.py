@@ -0,0 +1,48 @@
+"""Comprime il `details` delle run già salvate (runs_store.details_gz) e stampa i byte risparmiati.
+
+All'avvio il server lo fa già in background (RUNS_COMPACT_ON_START); lo script
+serve per farlo a mano o per vedere il report.
+
+Esempio:
+    python scripts/compact_runs.py --batch-size 500
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(BACKEND_DIR))
+load_dotenv(BACKEND_DIR / ".env")
+
+import runs_store  # noqa: E402
+
+
+def _kb(n: int) -> str:
+    return f"{n / 1024:.1f} KB"
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Compattazione details delle run")
+    ap.add_argument("--batch-size", type=int, default=200)
+    args = ap.parse_args(argv)
+
+    done = runs_store.compact_runs(batch_size=args.batch_size)
+    print(
+        f"Run compattate: {done['runs']}  "
+        f"{_kb(done['bytes_before'])} -> {_kb(done['bytes_after'])} "
+        f"(risparmiati {_kb(done['bytes_saved'])}, {done['ms']:.0f} ms)"
+    )
+    st = runs_store.storage_stats()
+    print(
+        f"Tabella: {st['runs']} run, JSON {_kb(st['data_bytes'])}, "
+        f"details compressi {_kb(st['details_gz_bytes'])}, "
+        f"ancora da compattare {st['uncompacted_runs']}"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
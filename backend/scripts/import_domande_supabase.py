@@ -1,42 +1,203 @@
+"""Import massivo di data/domande.json nella tabella `questions` di Supabase.
+
+- upsert a blocchi (--batch-size) con chiave `content_hash` (sql/questions_content_hash.sql):
+  rilanciare lo stesso import non crea duplicati
+- --workers blocchi in parallelo sul client Supabase condiviso, con retry/backoff
+- checkpoint append-only (--checkpoint): dopo un errore si riparte da dove ci si era fermati
+- --dry-run: valida tutto con validate_question (routes/domande.py) senza scrivere
+- riepilogo finale con righe/s
+
+Esempi:
+    python scripts/import_domande_supabase.py --dry-run
+    python scripts/import_domande_supabase.py --batch-size 500 --workers 4
+"""
+
+import argparse
+import hashlib
 import json
-import os
-from supabase import create_client
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from dotenv import load_dotenv
-load_dotenv()
-print("URL:", os.getenv("SUPABASE_URL"))
-print("KEY:", os.getenv("SUPABASE_KEY"))
 
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-
-assert SUPABASE_URL and SUPABASE_KEY, "Supabase env mancanti"
+from dotenv import load_dotenv
 
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(BACKEND_DIR))
+load_dotenv(BACKEND_DIR / ".env")
 
-DOMANDE_PATH = Path(__file__).resolve().parents[1] / "data" / "domande.json"
+from routes.domande import validate_question  # noqa: E402
+from supabase_db import upsert_questions  # noqa: E402
 
-with open(DOMANDE_PATH, "r", encoding="utf-8") as f:
-    domande = json.load(f)
+DOMANDE_PATH = BACKEND_DIR / "data" / "domande.json"
+CHECKPOINT_PATH = BACKEND_DIR / "data" / "import_domande.checkpoint"
 
-print(f"Domande trovate: {len(domande)}")
 
-for d in domande:
-    opzioni = [d.get(k) for k in ["A", "B", "C", "D", "E"] if d.get(k)]
+def build_payload(d: dict) -> dict:
+    opzioni = d.get("opzioni")
+    if not isinstance(opzioni, list):
+        opzioni = [d.get(k) for k in ["A", "B", "C", "D", "E"] if d.get(k)]
 
     payload = {
         "materia": d.get("materia"),
         "tipo": d.get("tipo"),
         "testo": d.get("domanda") or d.get("testo") or "",
         "opzioni": opzioni,
+        "corretta": d.get("corretta"),
         "corretta_index": d.get("corretta_index"),
         "risposte": d.get("risposte", []),
+        "risposta": d.get("risposta"),
         "spiegazione": d.get("spiegazione", ""),
         "tag": d.get("tag", []),
         "difficolta": d.get("difficolta"),
         "created_at": d.get("created_at"),
     }
+    # niente null espliciti: con upsert_questions (default_to_null=False) le
+    # chiavi assenti prendono il default all'insert e restano invariate all'update
+    return {k: v for k, v in payload.items() if v is not None}
+
+
+def content_hash(q: dict) -> str:
+    """sha256 of the normalised question content (same question -> same hash)."""
+    key = {
+        "materia": str(q.get("materia") or "").strip().lower(),
+        "tipo": str(q.get("tipo") or "").strip().lower(),
+        "testo": " ".join(str(q.get("testo") or "").split()).lower(),
+        "opzioni": [str(x).strip() for x in (q.get("opzioni") or [])],
+        "corretta_index": q.get("corretta_index"),
+        "risposte": sorted(str(x).strip().lower() for x in (q.get("risposte") or [])),
+    }
+    raw = json.dumps(key, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def prepare(domande: list):
+    """Validate + normalise every row. Returns (ok_rows, errors)."""
+    rows, errors = [], []
+    for i, d in enumerate(domande):
+        q = build_payload(d)
+        try:
+            validate_question(q)
+        except Exception as e:
+            errors.append((i, getattr(e, "detail", None) or str(e)))
+            continue
+        q["content_hash"] = content_hash(q)
+        rows.append(q)
+    return rows, errors
+
+
+def read_checkpoint(path: Path) -> set:
+    if not path.exists():
+        return set()
+    return {line.strip() for line in path.read_text(encoding="utf-8").splitlines() if line.strip()}
+
+
+class Checkpoint:
+    """Append-only list of imported content hashes (one per line)."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def mark(self, hashes):
+        with self.lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("".join(h + "\n" for h in hashes))
+
+
+def send_batch(batch: list, retries: int, stats: dict, lock: threading.Lock) -> int:
+    delay = 1.0
+    for attempt in range(1, retries + 1):
+        try:
+            return upsert_questions(batch, on_conflict="content_hash")
+        except Exception as e:
+            if attempt == retries:
+                raise
+            with lock:
+                stats["retries"] += 1
+            print(f"  retry {attempt}/{retries - 1} ({len(batch)} righe): {e}")
+            time.sleep(delay)
+            delay *= 2
+    return 0
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Import massivo domande -> Supabase")
+    ap.add_argument("--file", type=Path, default=DOMANDE_PATH)
+    ap.add_argument("--batch-size", type=int, default=500)
+    ap.add_argument("--workers", type=int, default=4)
+    ap.add_argument("--retries", type=int, default=4)
+    ap.add_argument("--checkpoint", type=Path, default=CHECKPOINT_PATH)
+    ap.add_argument("--reset", action="store_true", help="ignora e cancella il checkpoint esistente")
+    ap.add_argument("--dry-run", action="store_true", help="valida soltanto, non scrive nulla")
+    args = ap.parse_args(argv)
+
+    with open(args.file, "r", encoding="utf-8") as f:
+        domande = json.load(f)
+    print(f"Domande trovate: {len(domande)}")
+
+    rows, errors = prepare(domande)
+    for i, detail in errors[:20]:
+        print(f"  riga {i}: {detail}")
+    if len(errors) > 20:
+        print(f"  ... altri {len(errors) - 20} errori")
+    print(f"Valide: {len(rows)}  Scartate: {len(errors)}")
+
+    # stesso contenuto ripetuto nel file: un solo upsert
+    unique = {}
+    for q in rows:
+        unique.setdefault(q["content_hash"], q)
+    rows = list(unique.values())
+
+    if args.dry_run:
+        print("Dry run: nessuna scrittura.")
+        return 1 if errors else 0
+
+    if args.reset and args.checkpoint.exists():
+        args.checkpoint.unlink()
+    done = read_checkpoint(args.checkpoint)
+    todo = [q for q in rows if q["content_hash"] not in done]
+    if done:
+        print(f"Checkpoint: {len(rows) - len(todo)} già importate, ne restano {len(todo)}")
+
+    size = max(1, args.batch_size)
+    batches = [todo[i:i + size] for i in range(0, len(todo), size)]
+    checkpoint = Checkpoint(args.checkpoint)
+    stats = {"sent": 0, "retries": 0, "failed_batches": 0}
+    lock = threading.Lock()
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        futures = {pool.submit(send_batch, b, max(1, args.retries), stats, lock): b for b in batches}
+        for fut in as_completed(futures):
+            batch = futures[fut]
+            try:
+                n = fut.result()
+            except Exception as e:
+                with lock:
+                    stats["failed_batches"] += 1
+                print(f"  blocco fallito ({len(batch)} righe): {e}")
+                continue
+            checkpoint.mark(q["content_hash"] for q in batch)
+            with lock:
+                stats["sent"] += n
+                sent = stats["sent"]
+            print(f"  {sent}/{len(todo)}")
+    elapsed = max(time.perf_counter() - t0, 1e-9)
+
+    print(
+        f"Importate {stats['sent']} righe in {elapsed:.1f}s "
+        f"({stats['sent'] / elapsed:.0f} righe/s, {len(batches)} blocchi, "
+        f"{stats['retries']} retry, {stats['failed_batches']} blocchi falliti)"
+    )
+    if stats["failed_batches"]:
+        print("Rilancia lo script: il checkpoint salta le righe già importate.")
+        return 1
+    print("✅ Import completato con successo")
+    return 0
 
-    supabase.table("questions").insert(payload).execute()
 
-print("✅ Import completato con successo")
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main())
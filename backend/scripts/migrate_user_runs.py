@@ -0,0 +1,43 @@
+"""Migrazione una tantum di data/user_runs.json nello store SQLite delle run (runs_store).
+
+Idempotente: le run già nello store (stesso id o stessa email+session_id) restano
+come sono, si può rilanciare.
+Il file JSON non viene toccato (resta come backup).
+
+Esempi:
+    python scripts/migrate_user_runs.py
+    python scripts/migrate_user_runs.py --file /backup/user_runs.json
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(BACKEND_DIR))
+load_dotenv(BACKEND_DIR / ".env")
+
+import runs_store  # noqa: E402
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Migra user_runs.json -> SQLite")
+    ap.add_argument("--file", type=Path, default=runs_store.LEGACY_FILE)
+    args = ap.parse_args(argv)
+
+    if not args.file.exists():
+        print(f"File non trovato: {args.file}")
+        return 1
+
+    t0 = time.perf_counter()
+    n = runs_store.migrate_from_json(args.file)
+    elapsed = time.perf_counter() - t0
+    print(f"Importate {n} run nuove in {elapsed:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,31 @@
+"""Ricalcola da zero gli aggregati per utente (runs_store.user_stats) dallo storico run.
+
+Da usare dopo modifiche manuali al database o se l'aggregato sembra sfasato:
+/finish lo aggiorna già in modo incrementale.
+
+Esempio:
+    python scripts/rebuild_user_stats.py
+"""
+
+import sys
+import time
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(BACKEND_DIR))
+load_dotenv(BACKEND_DIR / ".env")
+
+import runs_store  # noqa: E402
+
+
+def main():
+    t0 = time.perf_counter()
+    n = runs_store.rebuild_user_stats()
+    print(f"Aggregati ricostruiti per {n} utenti in {time.perf_counter() - t0:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -119,6 +119,31 @@ if reports is not None:
 if bot_api is not None:
     app.include_router(bot_api.router)
 
+# =========================
+# Background jobs
+# =========================
+@app.on_event("startup")
+def _start_background_jobs():
+    # run vecchie con details in chiaro -> details_gz (RUNS_COMPACT_ON_START=0 per saltare)
+    if os.getenv("RUNS_COMPACT_ON_START", "1").strip() != "0":
+        try:
+            import runs_store
+            runs_store.compact_runs_background()
+        except Exception as e:
+            logger.error("Compattazione run non avviata: %s", e)
+    # segnalazioni: vista in memoria + compattazione periodica del log
+    try:
+        import reports_store
+        reports_store.start_compactor()
+    except Exception as e:
+        logger.error("Compattazione segnalazioni non avviata: %s", e)
+    # sessioni /api/sim: rimozione periodica delle sessioni scadute
+    try:
+        import session_store
+        session_store.start_sweeper()
+    except Exception as e:
+        logger.error("Sweeper sessioni non avviato: %s", e)
+
 # =========================
 # Static files: uploads
 # =========================
@@ -140,8 +165,27 @@ def health():
 
 @app.get("/__debug_questions")
 def __debug_questions():
-    from supabase_db import fetch_all_questions
-    bank = fetch_all_questions()
+    from question_bank import get_bank
+    bank = get_bank()
     out = {"total": len(bank), "sample": bank[0] if bank else None}
     return out
 
+
+@app.get("/__debug_stats")
+def __debug_stats():
+    from supabase_db import pool_stats, last_fetch_stats, projection_stats
+    from question_bank import bank_stats
+    from runs_store import storage_stats
+    from reports_store import reports_stats
+    from session_store import session_stats
+    from session_tokens import token_stats
+    return {
+        "supabase_pool": pool_stats(),
+        "question_bank": bank_stats(),
+        "questions_fetch": last_fetch_stats(),
+        "projection_bytes": projection_stats(),
+        "user_runs": storage_stats(),
+        "reports": reports_stats(),
+        "sessions": session_stats(),
+        "session_tokens": token_stats(),
+    }
@@ -0,0 +1,955 @@
+"""Store delle sessioni di simulazione attive (/api/sim, /api/simulazioni).
+
+Prima le sessioni (con `questions_full`, cioè con le soluzioni) restavano in un
+dict di modulo per sempre: la memoria cresceva ad ogni /start.
+
+Ogni sessione ha una scadenza:
+    duration_min * 60 + SESSION_GRACE_S   (default grace 900s)
+    SESSION_UNTIMED_TTL_S                 se il timer è spento (default 6h)
+Alla scadenza la sessione non è più restituita e viene rimossa dallo sweeper
+(thread `session-sweeper`, ogni SESSION_SWEEP_S secondi) o al primo accesso.
+
+Sopra SESSION_STORE_MAX_MB (stima in byte del JSON della sessione, default 64MB
+per store) si eliminano le sessioni usate meno di recente (LRU).
+
+Backend (SESSION_BACKEND):
+- memory  dict di processo. Va bene solo con un worker: /finish deve arrivare
+          al processo che ha servito /start.
+- sqlite  tabella `sessions` nel database WAL di storage.py, condivisa da tutti
+          i worker dello stesso host. Default se WEB_CONCURRENCY > 1.
+- redis   qualsiasi server compatibile Redis (REDIS_URL), per più host. TTL
+          nativo (SET EX); il limite di memoria è quello del server
+          (maxmemory-policy volatile-lru). REDIS_URL=local:// usa LocalRedis,
+          sostituto in-process per sviluppo e test.
+
+get() di sqlite/redis restituisce una copia: dopo una modifica serve put().
+
+Checkpoint delle risposte (PATCH /api/sim/{id}/answers): `checkpoint()` unisce
+il delta {qid: risposta} alle risposte salvate prima di rispondere, con costo
+proporzionale al delta (sqlite: righe in `session_answers`, redis: HSET,
+memory: dict). Il raggruppamento lo fa il client (un PATCH ogni 10s con le sole
+risposte cambiate). /finish legge le risposte con get_answers() da qualunque worker.
+
+Scadenze: la `deadline_at` della sessione è salvata nello store (sqlite:
+colonna indicizzata `due_at`, redis: sorted set `dinomed:due:<store>`,
+memory: heap (deadline_at, id) con invalidazione pigra). Il thread
+`session-deadlines` chiede agli store le sessioni scadute (`due()`) e chiama
+l'handler registrato con on_deadline() (routes/sessioni.py: correzione
+automatica). Gli store memory lo svegliano alla prima scadenza in heap; sqlite
+e redis sono interrogati ogni SESSION_DEADLINE_SCAN_S secondi (default 5s,
+query su indice), perché le sessioni possono arrivare da altri worker. Per
+sqlite/redis nulla vive solo in memoria: dopo un riavvio le scadenze si
+ritrovano, e qualunque worker può servirle. `claim_finish()` è il
+compare-and-set che garantisce una sola correzione per sessione anche se
+scanner di più worker e /finish arrivano insieme.
+
+`session_stats()` espone sessioni vive, byte stimati, evizioni, scadenze e
+latenza di put/get (media e massimo in ms) per store.
+"""
+
+from __future__ import annotations
+
+import heapq
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger("dinomed.sessions")
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return max(0.0, float(os.getenv(name) or default))
+    except Exception:
+        return default
+
+
+def _grace_s() -> float:
+    return _env_float("SESSION_GRACE_S", 900.0)
+
+
+def _untimed_ttl_s() -> float:
+    return _env_float("SESSION_UNTIMED_TTL_S", 6 * 3600.0)
+
+
+def _max_bytes() -> int:
+    return int(_env_float("SESSION_STORE_MAX_MB", 64.0) * 1024 * 1024)
+
+
+def _sweep_s() -> float:
+    return _env_float("SESSION_SWEEP_S", 60.0) or 60.0
+
+
+def _backend_name() -> str:
+    name = (os.getenv("SESSION_BACKEND") or "").strip().lower()
+    if name:
+        return name
+    # più worker = più processi: serve uno store condiviso
+    return "sqlite" if _env_float("WEB_CONCURRENCY", 1.0) > 1 else "memory"
+
+
+def session_ttl_s(session: Dict[str, Any]) -> float:
+    """Lifetime of a session: its timer plus grace, or the untimed TTL."""
+    try:
+        minutes = int(session.get("duration_min") or 0)
+    except Exception:
+        minutes = 0
+    if minutes <= 0:
+        return _untimed_ttl_s()
+    return minutes * 60.0 + _grace_s()
+
+
+def _dumps(session: Dict[str, Any]) -> str:
+    return json.dumps(session, ensure_ascii=False, default=str)
+
+
+def _due_at(session: Dict[str, Any]) -> Optional[float]:
+    # sessioni da correggere alla scadenza: con deadline e non ancora consegnate
+    dl = session.get("deadline_at")
+    return float(dl) if dl and not session.get("finished") else None
+
+
+def _approx_bytes(session: Dict[str, Any]) -> int:
+    try:
+        return len(_dumps(session))
+    except Exception:
+        return 0
+
+
+class SessionStore:
+    """In-memory sessions with per-session TTL and LRU eviction under a byte cap.
+
+    Base dei backend condivisi (SqliteSessionStore, RedisSessionStore), che
+    ridefiniscono put/get/delete/sweep/stats.
+
+    get() restituisce l'oggetto salvato: chi lo modifica deve richiamare put()
+    per aggiornarne la dimensione stimata.
+    """
+
+    polled = False  # scadenze dall'heap locale, senza polling
+
+    def __init__(self, name: str, max_bytes: Optional[int] = None):
+        self.name = name
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # session_id -> (expires_at, bytes, session), dal meno al più usato di recente
+        self._items: "OrderedDict[str, tuple]" = OrderedDict()
+        self._bytes = 0
+        self._claimed: set = set()  # sessioni già corrette (claim_finish)
+        # heap (due_at, id); una voce vale solo se coincide con _due_of[id]
+        self._due_heap: List[Tuple[float, str]] = []
+        self._due_of: Dict[str, float] = {}
+        self._stats = {"puts": 0, "hits": 0, "misses": 0, "expired": 0, "evicted_lru": 0}
+        self._lat: Dict[str, List[float]] = {"put": [0, 0.0, 0.0], "get": [0, 0.0, 0.0]}  # n, somma ms, max ms
+
+    def _observe(self, op: str, t0: float) -> None:
+        ms = (time.perf_counter() - t0) * 1000.0
+        with self._lock:
+            lat = self._lat[op]
+            lat[0] += 1
+            lat[1] += ms
+            lat[2] = max(lat[2], ms)
+
+    def _latency(self) -> Dict[str, float]:
+        out: Dict[str, float] = {}
+        for op, (n, total, peak) in self._lat.items():
+            out[f"{op}_ms_avg"] = round(total / n, 3) if n else 0.0
+            out[f"{op}_ms_max"] = round(peak, 3)
+        return out
+
+    def _cap(self) -> int:
+        return self.max_bytes if self.max_bytes is not None else _max_bytes()
+
+    def _drop(self, session_id: str, forget: bool = True) -> None:
+        item = self._items.pop(session_id, None)
+        if item is not None:
+            self._bytes -= item[1]
+        if forget:
+            # solo cancellazione/scadenza/LRU: put() che sostituisce mantiene il claim
+            self._claimed.discard(session_id)
+            self._due_of.pop(session_id, None)
+
+    def _arm(self, session_id: str, due_at: Optional[float]) -> None:
+        if due_at is None or session_id in self._claimed:
+            self._due_of.pop(session_id, None)
+            return
+        if self._due_of.get(session_id) == due_at:
+            return
+        self._due_of[session_id] = due_at
+        heapq.heappush(self._due_heap, (due_at, session_id))
+        if self._due_heap[0][1] == session_id:
+            _DL_WAKE.set()  # nuova prima scadenza: il thread ricalcola l'attesa
+
+    def put(self, session_id: str, session: Dict[str, Any], ttl_s: Optional[float] = None) -> None:
+        """Store/replace a session. Senza ttl_s una sessione già presente
+        mantiene la sua scadenza (aggiornare le risposte non la allunga)."""
+        t0 = time.perf_counter()
+        size = _approx_bytes(session)
+        with self._lock:
+            prev = self._items.get(session_id)
+            if ttl_s is not None:
+                expires_at = time.time() + float(ttl_s)
+            elif prev is not None:
+                expires_at = prev[0]
+            else:
+                expires_at = time.time() + session_ttl_s(session)
+            self._drop(session_id, forget=False)
+            self._items[session_id] = (expires_at, size, session)
+            self._bytes += size
+            self._arm(session_id, _due_at(session))
+            self._stats["puts"] += 1
+            cap = self._cap()
+            # LRU: via le meno usate finché si rientra nel limite (mai quella appena scritta)
+            while cap and self._bytes > cap and len(self._items) > 1:
+                old_id = next(iter(self._items))
+                self._drop(old_id)
+                self._stats["evicted_lru"] += 1
+                logger.info("session %s evicted (store=%s, LRU)", old_id, self.name)
+        self._observe("put", t0)
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        t0 = time.perf_counter()
+        with self._lock:
+            item = self._items.get(session_id)
+            if item is not None and item[0] <= time.time():
+                self._drop(session_id)
+                self._stats["expired"] += 1
+                item = None
+            if item is None:
+                self._stats["misses"] += 1
+            else:
+                self._items.move_to_end(session_id)
+                self._stats["hits"] += 1
+        self._observe("get", t0)
+        return item[2] if item is not None else None
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            found = session_id in self._items
+            self._drop(session_id)
+            return found
+
+    def put_answers(self, session_id: str, delta: Dict[str, Any]) -> bool:
+        """Merge answers into a live session in O(delta); False if it is gone."""
+        added = _approx_bytes(delta)
+        with self._lock:
+            item = self._items.get(session_id)
+            if item is None or item[0] <= time.time():
+                return False
+            item[2].setdefault("answers", {}).update(delta)
+            self._items[session_id] = (item[0], item[1] + added, item[2])
+            self._bytes += added
+        return True
+
+    def get_answers(self, session_id: str) -> Dict[str, Any]:
+        with self._lock:
+            item = self._items.get(session_id)
+            return dict((item[2].get("answers") or {}) if item is not None else {})
+
+    def claim_finish(self, session_id: str) -> bool:
+        """Mark a live session as graded; True only for the first caller."""
+        with self._lock:
+            item = self._items.get(session_id)
+            if item is None or item[0] <= time.time() or session_id in self._claimed:
+                return False
+            self._claimed.add(session_id)
+            self._due_of.pop(session_id, None)
+            return True
+
+    def _pop_stale(self) -> None:
+        heap = self._due_heap
+        while heap and self._due_of.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+
+    def next_due(self) -> Optional[float]:
+        """Earliest pending deadline_at, or None."""
+        with self._lock:
+            self._pop_stale()
+            return self._due_heap[0][0] if self._due_heap else None
+
+    def due(self, before: float, limit: int = 100) -> List[str]:
+        """Live, not yet graded sessions whose deadline_at is <= before.
+
+        Ogni sessione restituita viene riarmata a `before + SESSION_DEADLINE_SCAN_S`:
+        se l'handler fallisce si ritenta dopo, se la corregge claim_finish()
+        invalida la voce.
+        """
+        now = time.time()
+        out: List[str] = []
+        retry = before + _deadline_scan_s()
+        with self._lock:
+            heap = self._due_heap
+            while len(out) < limit:
+                self._pop_stale()
+                if not heap or heap[0][0] > before:
+                    break
+                _, sid = heapq.heappop(heap)
+                item = self._items.get(sid)
+                if item is None or item[0] <= now or item[2].get("finished"):
+                    self._due_of.pop(sid, None)
+                    continue
+                out.append(sid)
+            for sid in out:
+                self._due_of[sid] = retry
+                heapq.heappush(heap, (retry, sid))
+        return out
+
+    def sweep(self) -> int:
+        """Remove expired sessions; returns how many were removed."""
+        now = time.time()
+        with self._lock:
+            dead = [sid for sid, item in self._items.items() if item[0] <= now]
+            for sid in dead:
+                self._drop(sid)
+            self._stats["expired"] += len(dead)
+        return len(dead)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._items)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            out = dict(self._stats)
+            out["live"] = len(self._items)
+            out["approx_bytes"] = self._bytes
+            out["max_bytes"] = self._cap()
+            out.update(self._latency())
+        out["backend"] = "memory"
+        return out
+
+
+# =========================
+# SQLite (WAL, condiviso tra i worker dello stesso host)
+# =========================
+_SQLITE_READY = False
+_SQLITE_READY_LOCK = threading.Lock()
+
+# last_access si riscrive al massimo ogni N secondi (get frequenti = poche scritture)
+_TOUCH_EVERY_S = 5.0
+
+
+def _sqlite_conn() -> sqlite3.Connection:
+    global _SQLITE_READY
+    from storage import sqlite_connection
+    conn = sqlite_connection()
+    if not _SQLITE_READY:
+        with _SQLITE_READY_LOCK:
+            if not _SQLITE_READY:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS sessions ("
+                    " store TEXT NOT NULL, id TEXT NOT NULL,"
+                    " expires_at REAL NOT NULL, last_access REAL NOT NULL,"
+                    " bytes INTEGER NOT NULL, data TEXT NOT NULL,"
+                    " PRIMARY KEY (store, id))"
+                )
+                have = {r[1] for r in conn.execute("PRAGMA table_info(sessions)")}
+                if "due_at" not in have:
+                    # scadenza dell'esame (deadline_at) finché la sessione non è corretta
+                    conn.execute("ALTER TABLE sessions ADD COLUMN due_at REAL")
+                if "done" not in have:
+                    conn.execute("ALTER TABLE sessions ADD COLUMN done INTEGER NOT NULL DEFAULT 0")
+                conn.execute("CREATE INDEX IF NOT EXISTS sessions_due ON sessions (store, due_at)")
+                conn.execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (store, expires_at)")
+                conn.execute("CREATE INDEX IF NOT EXISTS sessions_lru ON sessions (store, last_access)")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS session_answers ("
+                    " store TEXT NOT NULL, id TEXT NOT NULL, qid TEXT NOT NULL, answer TEXT,"
+                    " PRIMARY KEY (store, id, qid)) WITHOUT ROWID"
+                )
+                _SQLITE_READY = True
+    return conn
+
+
+class SqliteSessionStore(SessionStore):
+    """Sessions in the shared WAL database: any worker can serve any request.
+
+    I contatori di stats() sono per processo; live/approx_bytes vengono dalla tabella.
+    """
+
+    polled = True
+
+    def put(self, session_id: str, session: Dict[str, Any], ttl_s: Optional[float] = None) -> None:
+        t0 = time.perf_counter()
+        data = _dumps(session)
+        now = time.time()
+        conn = _sqlite_conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if ttl_s is not None:
+                expires_at = now + float(ttl_s)
+            else:
+                row = conn.execute(
+                    "SELECT expires_at FROM sessions WHERE store = ? AND id = ?", (self.name, session_id)
+                ).fetchone()
+                expires_at = row[0] if row else now + session_ttl_s(session)
+            conn.execute(
+                "INSERT INTO sessions (store, id, expires_at, last_access, bytes, data, due_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (store, id) DO UPDATE SET expires_at = excluded.expires_at, "
+                "last_access = excluded.last_access, bytes = excluded.bytes, data = excluded.data, "
+                "due_at = CASE WHEN sessions.done THEN NULL ELSE excluded.due_at END",
+                (self.name, session_id, expires_at, now, len(data), data, _due_at(session)),
+            )
+            evicted = self._evict(conn, session_id)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        with self._lock:
+            self._stats["puts"] += 1
+            self._stats["evicted_lru"] += len(evicted)
+        for old_id in evicted:
+            logger.info("session %s evicted (store=%s, LRU)", old_id, self.name)
+        self._observe("put", t0)
+
+    def _evict(self, conn: sqlite3.Connection, keep_id: str) -> List[str]:
+        cap = self._cap()
+        if not cap:
+            return []
+        total = conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM sessions WHERE store = ?", (self.name,)).fetchone()[0]
+        if total <= cap:
+            return []
+        dead: List[str] = []
+        for sid, size in conn.execute(
+            "SELECT id, bytes FROM sessions WHERE store = ? AND id != ? ORDER BY last_access", (self.name, keep_id)
+        ).fetchall():
+            if total <= cap:
+                break
+            dead.append(sid)
+            total -= size
+        keys = [(self.name, sid) for sid in dead]
+        conn.executemany("DELETE FROM sessions WHERE store = ? AND id = ?", keys)
+        conn.executemany("DELETE FROM session_answers WHERE store = ? AND id = ?", keys)
+        return dead
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        t0 = time.perf_counter()
+        conn = _sqlite_conn()
+        row = conn.execute(
+            "SELECT expires_at, last_access, data FROM sessions WHERE store = ? AND id = ?", (self.name, session_id)
+        ).fetchone()
+        now = time.time()
+        if row is None or row[0] <= now:
+            if row is not None:
+                conn.execute("DELETE FROM sessions WHERE store = ? AND id = ? AND expires_at <= ?", (self.name, session_id, now))
+                conn.execute("DELETE FROM session_answers WHERE store = ? AND id = ?", (self.name, session_id))
+            with self._lock:
+                self._stats["misses"] += 1
+                self._stats["expired"] += int(row is not None)
+            self._observe("get", t0)
+            return None
+        if now - row[1] >= _TOUCH_EVERY_S:
+            conn.execute("UPDATE sessions SET last_access = ? WHERE store = ? AND id = ?", (now, self.name, session_id))
+        with self._lock:
+            self._stats["hits"] += 1
+        out = json.loads(row[2])
+        self._observe("get", t0)
+        return out
+
+    def delete(self, session_id: str) -> bool:
+        conn = _sqlite_conn()
+        conn.execute("DELETE FROM session_answers WHERE store = ? AND id = ?", (self.name, session_id))
+        cur = conn.execute("DELETE FROM sessions WHERE store = ? AND id = ?", (self.name, session_id))
+        return cur.rowcount > 0
+
+    def put_answers(self, session_id: str, delta: Dict[str, Any]) -> bool:
+        conn = _sqlite_conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT expires_at FROM sessions WHERE store = ? AND id = ?", (self.name, session_id)
+            ).fetchone()
+            ok = row is not None and row[0] > time.time()
+            if ok:
+                conn.executemany(
+                    "INSERT INTO session_answers (store, id, qid, answer) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (store, id, qid) DO UPDATE SET answer = excluded.answer",
+                    [(self.name, session_id, str(q), json.dumps(a, ensure_ascii=False)) for q, a in delta.items()],
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return ok
+
+    def claim_finish(self, session_id: str) -> bool:
+        cur = _sqlite_conn().execute(
+            "UPDATE sessions SET done = 1, due_at = NULL "
+            "WHERE store = ? AND id = ? AND done = 0 AND expires_at > ?",
+            (self.name, session_id, time.time()),
+        )
+        return cur.rowcount == 1
+
+    def due(self, before: float, limit: int = 100) -> List[str]:
+        rows = _sqlite_conn().execute(
+            "SELECT id FROM sessions WHERE store = ? AND due_at IS NOT NULL AND due_at <= ? "
+            "AND done = 0 AND expires_at > ? ORDER BY due_at LIMIT ?",
+            (self.name, before, time.time(), max(1, int(limit))),
+        ).fetchall()
+        return [r[0] for r in rows]
+
+    def get_answers(self, session_id: str) -> Dict[str, Any]:
+        rows = _sqlite_conn().execute(
+            "SELECT qid, answer FROM session_answers WHERE store = ? AND id = ?", (self.name, session_id)
+        ).fetchall()
+        return {qid: json.loads(a) if a is not None else None for qid, a in rows}
+
+    def sweep(self) -> int:
+        conn = _sqlite_conn()
+        now = time.time()
+        conn.execute(
+            "DELETE FROM session_answers WHERE store = ? AND id IN "
+            "(SELECT id FROM sessions WHERE store = ? AND expires_at <= ?)", (self.name, self.name, now)
+        )
+        cur = conn.execute("DELETE FROM sessions WHERE store = ? AND expires_at <= ?", (self.name, now))
+        n = max(0, cur.rowcount)
+        with self._lock:
+            self._stats["expired"] += n
+        return n
+
+    def __len__(self) -> int:
+        return int(_sqlite_conn().execute("SELECT COUNT(*) FROM sessions WHERE store = ?", (self.name,)).fetchone()[0])
+
+    def stats(self) -> Dict[str, Any]:
+        live, size = _sqlite_conn().execute(
+            "SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM sessions WHERE store = ?", (self.name,)
+        ).fetchone()
+        with self._lock:
+            out = dict(self._stats)
+            out.update(self._latency())
+        out.update({"live": int(live), "approx_bytes": int(size), "max_bytes": self._cap(), "backend": "sqlite"})
+        return out
+
+
+# =========================
+# Redis (o compatibile)
+# =========================
+class LocalRedis:
+    """In-process stand-in for the few Redis commands used here (dev/test only)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data: Dict[str, Tuple[bytes, Optional[float]]] = {}
+
+    def _live(self, name: str) -> Optional[Tuple[bytes, Optional[float]]]:
+        item = self._data.get(name)
+        if item is not None and item[1] is not None and item[1] <= time.time():
+            del self._data[name]
+            return None
+        return item
+
+    def get(self, name: str) -> Optional[bytes]:
+        with self._lock:
+            item = self._live(name)
+            return item[0] if item else None
+
+    def set(self, name: str, value: Any, ex: Optional[int] = None, px: Optional[int] = None,
+            nx: bool = False, xx: bool = False, keepttl: bool = False):
+        if isinstance(value, (str, int)):
+            raw = str(value).encode("utf-8")
+        else:
+            raw = bytes(value)
+        with self._lock:
+            prev = self._live(name)
+            if (xx and prev is None) or (nx and prev is not None):
+                return None
+            if px is not None:
+                expires_at = time.time() + int(px) / 1000.0
+            elif ex is not None:
+                expires_at = time.time() + int(ex)
+            elif keepttl and prev is not None:
+                expires_at = prev[1]
+            else:
+                expires_at = None
+            self._data[name] = (raw, expires_at)
+            return True
+
+    def delete(self, *names: str) -> int:
+        with self._lock:
+            return sum(1 for n in names if self._live(n) is not None and self._data.pop(n, None) is not None)
+
+    def pttl(self, name: str) -> int:
+        with self._lock:
+            item = self._live(name)
+            if item is None:
+                return -2
+            return -1 if item[1] is None else int((item[1] - time.time()) * 1000)
+
+    def pexpire(self, name: str, ms: int) -> bool:
+        with self._lock:
+            item = self._live(name)
+            if item is None:
+                return False
+            self._data[name] = (item[0], time.time() + ms / 1000.0)
+            return True
+
+    def hset(self, name: str, mapping: Dict[str, Any]) -> int:
+        with self._lock:
+            item = self._live(name)
+            h = dict(item[0]) if item is not None else {}
+            h.update({k: (v.encode("utf-8") if isinstance(v, str) else v) for k, v in mapping.items()})
+            self._data[name] = (h, item[1] if item is not None else None)  # type: ignore[assignment]
+            return len(mapping)
+
+    def hgetall(self, name: str) -> Dict[bytes, bytes]:
+        with self._lock:
+            item = self._live(name)
+            return {k.encode("utf-8"): v for k, v in (item[0] if item is not None else {}).items()}  # type: ignore[union-attr]
+
+    def zadd(self, name: str, mapping: Dict[str, float]) -> int:
+        with self._lock:
+            item = self._live(name)
+            z = dict(item[0]) if item is not None else {}
+            added = sum(1 for m in mapping if m not in z)
+            z.update({m: float(v) for m, v in mapping.items()})
+            self._data[name] = (z, None)  # type: ignore[assignment]
+            return added
+
+    def zrem(self, name: str, *members: str) -> int:
+        with self._lock:
+            item = self._live(name)
+            if item is None:
+                return 0
+            z = dict(item[0])
+            n = sum(1 for m in members if z.pop(m, None) is not None)
+            self._data[name] = (z, None)  # type: ignore[assignment]
+            return n
+
+    def zrangebyscore(self, name: str, min: Any, max: Any, start: Optional[int] = None, num: Optional[int] = None):
+        lo = float("-inf") if min == "-inf" else float(min)
+        hi = float("inf") if max == "+inf" else float(max)
+        with self._lock:
+            item = self._live(name)
+            z = item[0] if item is not None else {}
+            out = sorted((v, m) for m, v in z.items() if lo <= v <= hi)  # type: ignore[union-attr]
+        members = [m.encode("utf-8") for _, m in out]
+        if start is not None and num is not None:
+            members = members[start:start + num]
+        return members
+
+    def scan_iter(self, match: Optional[str] = None):
+        import fnmatch
+        with self._lock:
+            keys = [k for k in list(self._data) if self._live(k) is not None]
+        return iter([k.encode("utf-8") for k in keys if match is None or fnmatch.fnmatchcase(k, match)])
+
+
+_REDIS_CLIENT: Any = None
+_REDIS_LOCK = threading.Lock()
+
+
+def _redis_client() -> Any:
+    global _REDIS_CLIENT
+    if _REDIS_CLIENT is None:
+        with _REDIS_LOCK:
+            if _REDIS_CLIENT is None:
+                url = (os.getenv("REDIS_URL") or "").strip()
+                if not url or url.startswith("local://"):
+                    _REDIS_CLIENT = LocalRedis()
+                else:
+                    import redis  # opzionale: serve solo con SESSION_BACKEND=redis
+                    _REDIS_CLIENT = redis.Redis.from_url(url)
+    return _REDIS_CLIENT
+
+
+class RedisSessionStore(SessionStore):
+    """Sessions as `dinomed:sess:<store>:<id>` keys with native expiry (SET EX)."""
+
+    polled = True
+
+    def __init__(self, name: str, max_bytes: Optional[int] = None, client: Any = None):
+        super().__init__(name, max_bytes=max_bytes)
+        self._client = client
+
+    @property
+    def client(self) -> Any:
+        return self._client if self._client is not None else _redis_client()
+
+    def _key(self, session_id: str) -> str:
+        return f"dinomed:sess:{self.name}:{session_id}"
+
+    @property
+    def _due_key(self) -> str:
+        return f"dinomed:due:{self.name}"
+
+    def put(self, session_id: str, session: Dict[str, Any], ttl_s: Optional[float] = None) -> None:
+        t0 = time.perf_counter()
+        data = _dumps(session)
+        key = self._key(session_id)
+        # aggiornamento senza ttl: mantiene la scadenza (SET XX KEEPTTL), altrimenti nuova
+        if ttl_s is not None or not self.client.set(key, data, xx=True, keepttl=True):
+            ttl = session_ttl_s(session) if ttl_s is None else float(ttl_s)
+            self.client.set(key, data, ex=max(1, int(ttl)))
+        due = _due_at(session)
+        if due is not None and self.client.get(key + ":done") is None:
+            self.client.zadd(self._due_key, {session_id: due})
+        else:
+            self.client.zrem(self._due_key, session_id)
+        with self._lock:
+            self._stats["puts"] += 1
+        self._observe("put", t0)
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        t0 = time.perf_counter()
+        raw = self.client.get(self._key(session_id))
+        with self._lock:
+            self._stats["hits" if raw is not None else "misses"] += 1
+        out = json.loads(raw) if raw is not None else None
+        self._observe("get", t0)
+        return out
+
+    def delete(self, session_id: str) -> bool:
+        key = self._key(session_id)
+        self.client.zrem(self._due_key, session_id)
+        return bool(self.client.delete(key, key + ":answers", key + ":done"))
+
+    def claim_finish(self, session_id: str) -> bool:
+        key = self._key(session_id)
+        ttl_ms = self.client.pttl(key)
+        if ttl_ms is None or ttl_ms <= 0:
+            return False
+        # SET NX: il primo che arriva corregge; il marker scade con la sessione
+        won = bool(self.client.set(key + ":done", 1, px=int(ttl_ms), nx=True))
+        if won:
+            self.client.zrem(self._due_key, session_id)
+        return won
+
+    def due(self, before: float, limit: int = 100) -> List[str]:
+        out: List[str] = []
+        for m in self.client.zrangebyscore(self._due_key, "-inf", before, start=0, num=max(1, int(limit))):
+            sid = m.decode("utf-8") if isinstance(m, bytes) else str(m)
+            key = self._key(sid)
+            if self.client.pttl(key) <= 0 or self.client.get(key + ":done") is not None:
+                self.client.zrem(self._due_key, sid)  # scaduta o già corretta
+                continue
+            out.append(sid)
+        return out
+
+    def put_answers(self, session_id: str, delta: Dict[str, Any]) -> bool:
+        key = self._key(session_id)
+        ttl_ms = self.client.pttl(key)
+        if ttl_ms is None or ttl_ms <= 0:
+            return False
+        akey = key + ":answers"
+        self.client.hset(akey, mapping={str(q): json.dumps(a, ensure_ascii=False) for q, a in delta.items()})
+        self.client.pexpire(akey, ttl_ms)  # le risposte scadono con la sessione
+        return True
+
+    def get_answers(self, session_id: str) -> Dict[str, Any]:
+        raw = self.client.hgetall(self._key(session_id) + ":answers") or {}
+        return {
+            (k.decode("utf-8") if isinstance(k, bytes) else k): json.loads(v)
+            for k, v in raw.items()
+        }
+
+    def sweep(self) -> int:
+        return 0  # scadenza gestita dal server
+
+    def __len__(self) -> int:
+        return sum(
+            1 for k in self.client.scan_iter(match=self._key("*"))
+            if not k.endswith(b":answers") and not k.endswith(b":done")
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            out = dict(self._stats)
+            out.update(self._latency())
+        out.update({"live": len(self), "backend": "redis"})
+        return out
+
+
+_BACKENDS = {"memory": SessionStore, "sqlite": SqliteSessionStore, "redis": RedisSessionStore}
+
+
+# =========================
+# Registry + sweeper
+# =========================
+_STORES: Dict[str, SessionStore] = {}
+_STORES_LOCK = threading.Lock()
+_SWEEPER: Optional[threading.Thread] = None
+
+
+def get_store(name: str, persistent: bool = False) -> SessionStore:
+    """Session store for `name` on the configured backend (cached per process).
+
+    persistent=True: le sessioni devono sopravvivere a un riavvio, quindi il
+    backend memory viene sostituito da sqlite.
+    """
+    with _STORES_LOCK:
+        st = _STORES.get(name)
+        if st is None:
+            backend = _backend_name()
+            if persistent and backend == "memory":
+                backend = "sqlite"
+            cls = _BACKENDS.get(backend)
+            if cls is None:
+                logger.error("SESSION_BACKEND=%s sconosciuto, uso memory", backend)
+                cls = SessionStore
+            st = _STORES[name] = cls(name)
+        return st
+
+
+def sweep_all() -> int:
+    with _STORES_LOCK:
+        stores = list(_STORES.values())
+    removed = 0
+    for st in stores:
+        try:
+            removed += st.sweep()
+        except Exception as e:
+            logger.error("session sweep failed (store=%s): %s", st.name, e)
+    return removed
+
+
+def _sweeper_loop() -> None:
+    while True:
+        time.sleep(_sweep_s())
+        n = sweep_all()
+        if n:
+            logger.info("session sweep: %d expired", n)
+
+
+def start_sweeper() -> threading.Thread:
+    """Start the expiry sweeper and deadline threads (once per process)."""
+    global _SWEEPER, _DL_THREAD
+    if _SWEEPER is None or not _SWEEPER.is_alive():
+        _SWEEPER = threading.Thread(target=_sweeper_loop, name="session-sweeper", daemon=True)
+        _SWEEPER.start()
+    if _DL_THREAD is None or not _DL_THREAD.is_alive():
+        _DL_THREAD = threading.Thread(target=_deadline_loop, name="session-deadlines", daemon=True)
+        _DL_THREAD.start()
+    return _SWEEPER
+
+
+# =========================
+# Checkpoint delle risposte (write-through)
+# =========================
+_CP_LOCK = threading.Lock()
+_CP_STATS: Dict[str, Any] = {
+    "checkpoints": 0, "answers_in": 0, "answers_written": 0, "dropped": 0, "errors": 0,
+}
+
+
+def checkpoint(store: SessionStore, session_id: str, delta: Dict[str, Any]) -> bool:
+    """Merge an answers delta into the session before acknowledging it.
+
+    False se la sessione non esiste più; gli errori dello store si propagano
+    (il client ritenta il delta). Niente coda di processo: con più worker
+    /finish può arrivare a un processo diverso da quello che ha ricevuto il
+    PATCH, quindi il delta deve essere già nello store condiviso.
+    """
+    if not delta:
+        return True
+    with _CP_LOCK:
+        _CP_STATS["checkpoints"] += 1
+        _CP_STATS["answers_in"] += len(delta)
+    try:
+        ok = store.put_answers(session_id, delta)
+    except Exception:
+        with _CP_LOCK:
+            _CP_STATS["errors"] += 1
+        raise
+    with _CP_LOCK:
+        _CP_STATS["answers_written" if ok else "dropped"] += len(delta)
+    return ok
+
+
+# =========================
+# Scadenze (dalla deadline_at salvata nello store)
+# =========================
+_DL_HANDLER: Optional[Callable[[str, str], None]] = None
+_DL_DELAY_S = 0.0
+_DL_THREAD: Optional[threading.Thread] = None
+_DL_LOCK = threading.Lock()
+_DL_WAKE = threading.Event()  # put() con una scadenza più vicina di quelle in heap
+_DL_STATS: Dict[str, Any] = {"scans": 0, "polls": 0, "fired": 0, "errors": 0, "last_scan_ms": 0.0}
+
+
+def _deadline_scan_s() -> float:
+    return max(0.5, _env_float("SESSION_DEADLINE_SCAN_S", 5.0))
+
+
+def on_deadline(handler: Callable[[str, str], None], delay_s: float = 0.0) -> None:
+    """Register handler(store_name, session_id), called once `deadline_at + delay_s` has passed."""
+    global _DL_HANDLER, _DL_DELAY_S
+    _DL_HANDLER = handler
+    _DL_DELAY_S = max(0.0, float(delay_s))
+
+
+def run_deadlines(limit: int = 100, poll: bool = True) -> int:
+    """Call the deadline handler for every due session; returns how many.
+
+    poll=False guarda solo gli store memory (heap locale), senza interrogare
+    sqlite/redis.
+    """
+    handler = _DL_HANDLER
+    if handler is None:
+        return 0
+    t0 = time.perf_counter()
+    before = time.time() - _DL_DELAY_S
+    with _STORES_LOCK:
+        stores = [st for st in _STORES.values() if poll or not st.polled]
+    fired = errors = 0
+    for st in stores:
+        try:
+            due = st.due(before, limit=limit)
+        except Exception as e:
+            logger.error("deadline scan failed (store=%s): %s", st.name, e)
+            errors += 1
+            continue
+        for session_id in due:
+            try:
+                handler(st.name, session_id)
+                fired += 1
+            except Exception as e:
+                logger.error("deadline handler failed (store=%s): %s", st.name, e)
+                errors += 1
+    with _DL_LOCK:
+        _DL_STATS["scans"] += 1
+        _DL_STATS["polls"] += int(poll)
+        _DL_STATS["fired"] += fired
+        _DL_STATS["errors"] += errors
+        _DL_STATS["last_scan_ms"] = round((time.perf_counter() - t0) * 1000.0, 1)
+    return fired
+
+
+def _next_local_due() -> Optional[float]:
+    with _STORES_LOCK:
+        stores = [st for st in _STORES.values() if not st.polled]
+    dues = [d for d in (st.next_due() for st in stores) if d is not None]
+    return min(dues) if dues else None
+
+
+def _deadline_loop() -> None:
+    next_poll = time.monotonic() + _deadline_scan_s()
+    while True:
+        wait = next_poll - time.monotonic()
+        due = _next_local_due()
+        if due is not None:
+            wait = min(wait, due + _DL_DELAY_S - time.time())
+        _DL_WAKE.wait(max(0.0, wait))
+        _DL_WAKE.clear()
+        poll = time.monotonic() >= next_poll
+        if poll:
+            next_poll = time.monotonic() + _deadline_scan_s()
+        try:
+            run_deadlines(poll=poll)
+        except Exception as e:
+            logger.error("deadline loop failed: %s", e)
+
+
+def session_stats() -> Dict[str, Any]:
+    with _STORES_LOCK:
+        stores = dict(_STORES)
+    with _CP_LOCK:
+        cp = dict(_CP_STATS)
+    with _DL_LOCK:
+        dl = dict(_DL_STATS)
+    return {"stores": {name: st.stats() for name, st in stores.items()}, "checkpoints": cp, "deadlines": dl}
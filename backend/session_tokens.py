@@ -0,0 +1,158 @@
+"""Token di sessione firmati per /api/sim (sessioni stateless).
+
+Con SIM_STATELESS=1 /api/sim/start non scrive nello store: restituisce come
+`session_id` un token firmato con HMAC-SHA256 che contiene id delle domande (e
+versioni), configurazione, email dell'utente, inizio e scadenze (anche per
+materia). GET /api/sim/session/{id} e /finish lo verificano e risolvono le domande dalla banca in cache
+(question_bank.resolve): qualsiasi worker, su qualsiasi istanza, serve qualsiasi
+richiesta senza I/O sullo store delle sessioni.
+
+Formato: "st1." + base64url(zlib(JSON)) + "." + base64url(HMAC). Chiave:
+SIM_TOKEN_SECRET, altrimenti JWT_SECRET. Il token scade a inizio + durata +
+SESSION_GRACE_S (come le sessioni nello store). Senza chiave issue() solleva
+(errore di configurazione all'avvio della prova), verify() restituisce None:
+un id "st1." arrivato a un'istanza non configurata è una sessione non trovata.
+
+Il token non ha stato lato server: /finish con lo stesso token si può ripetere
+(il salvataggio della run è un upsert su email + session_id, quindi idempotente).
+"""
+
+from __future__ import annotations
+
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+import session_store
+
+logger = logging.getLogger("dinomed.sessions")
+
+PREFIX = "st1."
+
+_LOCK = threading.Lock()
+_STATS: Dict[str, int] = {
+    "issued": 0, "verified": 0, "bad_signature": 0, "expired": 0, "malformed": 0, "unconfigured": 0,
+}
+
+
+def enabled() -> bool:
+    return (os.getenv("SIM_STATELESS") or "").strip().lower() in ("1", "true", "yes")
+
+
+def _key() -> bytes:
+    return (os.getenv("SIM_TOKEN_SECRET") or os.getenv("JWT_SECRET") or "").encode("utf-8")
+
+
+def _secret() -> bytes:
+    key = _key()
+    if not key:
+        raise RuntimeError("SIM_STATELESS richiede SIM_TOKEN_SECRET o JWT_SECRET")
+    return key
+
+
+def _b64(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _unb64(s: str) -> bytes:
+    return base64.urlsafe_b64decode(s + "=" * (-len(s) % 4))
+
+
+def _sign(body: str, key: bytes) -> str:
+    return _b64(hmac.new(key, (PREFIX + body).encode("ascii"), hashlib.sha256).digest())
+
+
+def _count(key: str) -> None:
+    with _LOCK:
+        _STATS[key] += 1
+
+
+def is_token(session_id: Optional[str]) -> bool:
+    return bool(session_id) and str(session_id).startswith(PREFIX)
+
+
+def issue(session: Dict[str, Any]) -> str:
+    """Signed token for a compact session (id, qids, qrev, seed, timer config)."""
+    now = int(time.time())
+    minutes = int(session.get("duration_min") or 0)
+    claims = {
+        "sid": session["id"],
+        "iat": now,
+        "exp": now + int(session_store.session_ttl_s(session)),
+        "dl": session.get("deadline_at"),
+        "sd": session.get("subject_deadlines"),
+        "em": session.get("email"),
+        "q": session.get("qids") or [],
+        "r": session.get("qrev"),
+        "seed": session.get("seed"),
+        "cfg": {
+            "duration_min": minutes,
+            "timer_mode": session.get("timer_mode"),
+            "durations_by_subject": session.get("durations_by_subject"),
+            "order": session.get("order"),
+        },
+    }
+    raw = json.dumps(claims, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    body = _b64(zlib.compress(raw, 9))
+    sig = _sign(body, _secret())
+    _count("issued")
+    return PREFIX + body + "." + sig
+
+
+def verify(token: str) -> Optional[Dict[str, Any]]:
+    """Session dict (same shape as the store's) from a valid token, else None."""
+    key = _key()
+    if not key:
+        _count("unconfigured")
+        return None
+    try:
+        body, sig = str(token)[len(PREFIX):].split(".", 1)
+    except ValueError:
+        _count("malformed")
+        return None
+    if not hmac.compare_digest(sig, _sign(body, key)):
+        _count("bad_signature")
+        return None
+    try:
+        claims = json.loads(zlib.decompress(_unb64(body)).decode("utf-8"))
+    except Exception:
+        _count("malformed")
+        return None
+    if int(claims.get("exp") or 0) <= time.time():
+        _count("expired")
+        return None
+    _count("verified")
+    cfg = claims.get("cfg") or {}
+    return {
+        "id": claims.get("sid"),
+        "created_at": datetime.utcfromtimestamp(int(claims.get("iat") or 0)).isoformat(),
+        "deadline_at": claims.get("dl"),
+        "subject_deadlines": claims.get("sd"),
+        "email": claims.get("em"),
+        "expires_at": int(claims.get("exp") or 0),
+        "duration_min": int(cfg.get("duration_min") or 0),
+        "timer_mode": cfg.get("timer_mode") or "single",
+        "durations_by_subject": cfg.get("durations_by_subject"),
+        "order": cfg.get("order") or [],
+        "seed": claims.get("seed"),
+        "qids": claims.get("q") or [],
+        "qrev": claims.get("r"),
+        "answers": {},
+        "finished": False,
+        "stateless": True,
+    }
+
+
+def token_stats() -> Dict[str, Any]:
+    with _LOCK:
+        out: Dict[str, Any] = dict(_STATS)
+    out["enabled"] = enabled()
+    return out
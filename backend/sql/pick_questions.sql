@@ -0,0 +1,77 @@
+-- Run once in Supabase SQL editor (dopo dinomed_core_tables.sql)
+-- Picker lato server: filtri materia/tipo/tag/difficolta + campionamento
+-- casuale direttamente in Postgres, così via PostgREST arrivano solo le N
+-- righe richieste (e solo le colonne chieste con ?select=).
+-- Usato da supabase_db.pick_questions / count_questions quando
+-- QUESTION_PICK_MODE=db.
+--
+-- Nota: assume `questions.tag` di tipo text[].
+
+create or replace function pick_questions(
+  p_materia text,
+  p_tipo text,
+  p_limit int,
+  p_tags text[] default null,
+  p_difficolta text default null
+)
+returns setof questions
+language sql
+stable
+as $$
+  select q.*
+  from questions q
+  where lower(trim(q.materia)) = lower(trim(p_materia))
+    and lower(trim(q.tipo)) = lower(trim(p_tipo))
+    -- le domande senza difficoltà valgono per qualsiasi difficoltà richiesta
+    and (
+      coalesce(trim(p_difficolta), '') = ''
+      or coalesce(trim(q.difficolta), '') = ''
+      or lower(trim(q.difficolta)) = lower(trim(p_difficolta))
+    )
+    and (
+      coalesce(cardinality(p_tags), 0) = 0
+      or exists (
+        select 1
+        from unnest(q.tag) as t(v)
+        where lower(trim(t.v)) in (select lower(trim(x)) from unnest(p_tags) as x)
+      )
+    )
+  order by random()
+  limit greatest(coalesce(p_limit, 0), 0);
+$$;
+
+create or replace function count_questions(
+  p_materia text,
+  p_tipo text,
+  p_tags text[] default null,
+  p_difficolta text default null
+)
+returns bigint
+language sql
+stable
+as $$
+  select count(*)
+  from questions q
+  where lower(trim(q.materia)) = lower(trim(p_materia))
+    and lower(trim(q.tipo)) = lower(trim(p_tipo))
+    and (
+      coalesce(trim(p_difficolta), '') = ''
+      or coalesce(trim(q.difficolta), '') = ''
+      or lower(trim(q.difficolta)) = lower(trim(p_difficolta))
+    )
+    and (
+      coalesce(cardinality(p_tags), 0) = 0
+      or exists (
+        select 1
+        from unnest(q.tag) as t(v)
+        where lower(trim(t.v)) in (select lower(trim(x)) from unnest(p_tags) as x)
+      )
+    );
+$$;
+
+-- filtro principale del picker
+create index if not exists questions_materia_tipo_idx
+  on questions (lower(trim(materia)), lower(trim(tipo)));
+
+grant execute on function pick_questions(text, text, int, text[], text) to anon, authenticated, service_role;
+grant execute on function count_questions(text, text, text[], text) to anon, authenticated, service_role;
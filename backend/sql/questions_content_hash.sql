@@ -0,0 +1,8 @@
+-- Run once in Supabase SQL editor
+-- Chiave di deduplica per l'import massivo (scripts/import_domande_supabase.py):
+-- sha256 del contenuto normalizzato della domanda. Reimportare lo stesso file
+-- aggiorna le righe esistenti invece di creare duplicati.
+
+alter table questions add column if not exists content_hash text;
+
+create unique index if not exists questions_content_hash_key on questions (content_hash);
@@ -0,0 +1,65 @@
+-- Run once in Supabase SQL editor
+-- Delta sync della banca domande (question_bank.py, QUESTION_BANK_SYNC=delta):
+--   * questions.updated_at aggiornato da trigger ad ogni insert/update
+--   * question_tombstones: una riga per ogni domanda cancellata
+-- Senza la tabella tombstone il backend rileva le cancellazioni con un diff
+-- periodico degli id (QUESTION_BANK_ID_DIFF_S).
+
+alter table questions add column if not exists updated_at timestamptz not null default now();
+
+create index if not exists questions_updated_at_idx on questions (updated_at);
+
+create or replace function questions_touch_updated_at()
+returns trigger
+language plpgsql
+as $$
+begin
+  new.updated_at := now();
+  return new;
+end;
+$$;
+
+drop trigger if exists questions_touch_updated_at on questions;
+create trigger questions_touch_updated_at
+  before insert or update on questions
+  for each row execute function questions_touch_updated_at();
+
+create table if not exists question_tombstones (
+  id text primary key,
+  deleted_at timestamptz not null default now()
+);
+
+create index if not exists question_tombstones_deleted_at_idx on question_tombstones (deleted_at);
+
+create or replace function questions_record_tombstone()
+returns trigger
+language plpgsql
+as $$
+begin
+  insert into question_tombstones (id, deleted_at)
+  values (old.id::text, now())
+  on conflict (id) do update set deleted_at = excluded.deleted_at;
+  return old;
+end;
+$$;
+
+drop trigger if exists questions_record_tombstone on questions;
+create trigger questions_record_tombstone
+  after delete on questions
+  for each row execute function questions_record_tombstone();
+
+-- una domanda ricreata con lo stesso id non è più cancellata
+create or replace function questions_clear_tombstone()
+returns trigger
+language plpgsql
+as $$
+begin
+  delete from question_tombstones where id = new.id::text;
+  return new;
+end;
+$$;
+
+drop trigger if exists questions_clear_tombstone on questions;
+create trigger questions_clear_tombstone
+  after insert on questions
+  for each row execute function questions_clear_tombstone();
@@ -0,0 +1,545 @@
+"""Storage engine for the backend's local data (backend/data).
+
+Una *collection* è un insieme di record dict con chiave primaria (default `id`)
+e qualche campo indicizzato. API unica per tutte le route:
+
+    col = storage.dispense()
+    col.get(key) / col.put(record) / col.append(record) / col.update(key, fields)
+    col.delete(key) / col.query(where={...}, order_by=..., desc=..., limit=..., offset=...)
+    col.count(where={...})
+
+Backend (STORAGE_BACKEND):
+- "json" (default, compatibile): stesso file JSON di prima come snapshot, tenuto
+  in memoria con indici. Ogni put/delete appende una riga a `<file>.log`
+  (O(1) per scrittura); ogni STORAGE_JSON_COMPACT_EVERY righe lo snapshot viene
+  riscritto (tmp + replace) e il log azzerato. Gli altri processi rileggono
+  solo la coda del log; le scritture passano da un lock su file (file_lock).
+- "sqlite" (produzione): data/dinomed.sqlite3 in WAL (STORAGE_SQLITE_PATH), una
+  tabella per collection con il record in JSON e una colonna indicizzata per ogni
+  campo in `indexes`. Al primo avvio importa il file JSON legacy.
+
+Qui stanno le collection piccole delle route (dispense, simulazioni, bot). Run,
+sessioni e segnalazioni hanno moduli propri (runs_store, session_store,
+reports_store) perché servono query e scadenze che l'API key/value non copre;
+usano però lo stesso database WAL (sqlite_connection) o lo stesso file_lock.
+
+I record restituiti sono copie: modificarli non tocca lo store finché non si fa put().
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: basta il lock di processo (un solo worker)
+    fcntl = None
+
+logger = logging.getLogger("dinomed.storage")
+
+BASE_DIR = Path(__file__).resolve().parent
+DATA_DIR = BASE_DIR / "data"
+
+
+def _backend_name() -> str:
+    return (os.getenv("STORAGE_BACKEND") or "json").strip().lower()
+
+
+@contextmanager
+def file_lock(path: Path):
+    """Exclusive lock shared by all processes on this host (flock on `path`)."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name) or default)
+    except Exception:
+        return default
+
+
+def _sort_key(v: Any) -> Tuple[int, str]:
+    # None in fondo, tutto il resto confrontato come stringa (ISO date ok)
+    return (0, "") if v is None else (1, str(v))
+
+
+def _matches(rec: Dict[str, Any], where: Optional[Dict[str, Any]]) -> bool:
+    if not where:
+        return True
+    return all(rec.get(f) == v for f, v in where.items())
+
+
+class Collection:
+    """Common interface; see JsonCollection / SqliteCollection."""
+
+    def __init__(self, name: str, key: str = "id", indexes: Sequence[str] = (),
+                 legacy_file: Optional[str] = None, layout: str = "list",
+                 newest_first: bool = True):
+        self.name = name
+        self.key = key
+        self.indexes = tuple(indexes)
+        self.legacy_path = (DATA_DIR / legacy_file) if legacy_file else None
+        self.layout = layout              # "list" ([{...}]) | "dict" ({key: {...}})
+        self.newest_first = newest_first  # ordine "naturale" dei file legacy a lista
+
+    def _key_of(self, record: Dict[str, Any]) -> str:
+        k = record.get(self.key)
+        if k is None or str(k) == "":
+            raise ValueError(f"{self.name}: record senza chiave '{self.key}'")
+        return str(k)
+
+    # --- API ---
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def put(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def delete(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def query(self, where: Optional[Dict[str, Any]] = None, order_by: Optional[str] = None,
+              desc: bool = False, limit: Optional[int] = None, offset: int = 0) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def count(self, where: Optional[Dict[str, Any]] = None) -> int:
+        return len(self.query(where))
+
+    def append(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        """Insert a new record, generating the key if missing."""
+        rec = dict(record)
+        if rec.get(self.key) in (None, ""):
+            rec[self.key] = uuid.uuid4().hex
+        return self.put(rec)
+
+    def update(self, key: str, fields: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        cur = self.get(key)
+        if cur is None:
+            return None
+        cur.update(fields)
+        return self.put(cur)
+
+    def all(self) -> List[Dict[str, Any]]:
+        return self.query()
+
+
+# =========================
+# JSON backend
+# =========================
+class JsonCollection(Collection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.path = self.legacy_path or (DATA_DIR / f"{self.name}.json")
+        self._lock = threading.RLock()
+        self._items: Dict[str, Dict[str, Any]] = {}   # ordine: dal più vecchio al più nuovo
+        self._idx: Dict[str, Dict[Any, Dict[str, None]]] = {}
+        self._loaded = False
+        self._stamp: Optional[Tuple[int, int]] = None
+        # log delle scritture successive allo snapshot: inode, byte letti, righe
+        self._jino: Optional[int] = None
+        self._jpos = 0
+        self._jlines = 0
+
+    @property
+    def journal_path(self) -> Path:
+        return self.path.with_name(self.path.name + ".log")
+
+    @property
+    def lock_path(self) -> Path:
+        return self.path.with_name(self.path.name + ".lock")
+
+    def _disk_stamp(self) -> Optional[Tuple[int, int]]:
+        try:
+            st = self.path.stat()
+            return (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            return None
+
+    def _journal_stat(self) -> Optional[Tuple[int, int]]:
+        try:
+            st = self.journal_path.stat()
+            return (st.st_ino, st.st_size)
+        except FileNotFoundError:
+            return None
+
+    def _load(self) -> None:
+        stamp = self._disk_stamp()
+        j = self._journal_stat()
+        if self._loaded and stamp == self._stamp:
+            if j is None and self._jino is None:
+                return
+            if j is not None and j[0] == self._jino and j[1] >= self._jpos:
+                if j[1] > self._jpos:
+                    self._replay_journal()  # scritture di altri processi
+                return
+        # primo accesso, snapshot riscritto o log compattato altrove: rilettura completa
+        items: Dict[str, Dict[str, Any]] = {}
+        if stamp is not None:
+            try:
+                data = json.loads(self.path.read_text(encoding="utf-8") or ("{}" if self.layout == "dict" else "[]"))
+            except Exception as e:
+                logger.error("storage %s: file illeggibile (%s), lo tratto come vuoto", self.path, e)
+                data = None
+            if self.layout == "dict" and isinstance(data, dict):
+                for k, v in data.items():
+                    if isinstance(v, dict):
+                        rec = dict(v)
+                        rec.setdefault(self.key, k)
+                        items[str(k)] = rec
+            elif isinstance(data, list):
+                seq = reversed(data) if self.newest_first else data
+                for v in seq:
+                    if isinstance(v, dict) and v.get(self.key) not in (None, ""):
+                        items[str(v.get(self.key))] = v
+        self._items = items
+        self._reindex()
+        self._stamp = stamp
+        self._loaded = True
+        self._jino, self._jpos, self._jlines = None, 0, 0
+        if j is not None:
+            self._jino = j[0]
+            self._replay_journal()
+
+    def _replay_journal(self) -> None:
+        try:
+            with open(self.journal_path, "rb") as f:
+                f.seek(self._jpos)
+                chunk = f.read()
+        except FileNotFoundError:
+            return
+        # solo righe complete: un append in corso si legge al giro dopo
+        end = chunk.rfind(b"\n") + 1
+        for line in chunk[:end].splitlines():
+            if not line.strip():
+                continue
+            try:
+                self._apply(json.loads(line))
+            except Exception:
+                logger.warning("storage %s: riga di log non valida, saltata", self.journal_path)
+                continue
+            self._jlines += 1
+        self._jpos += end
+
+    def _apply(self, ev: Dict[str, Any]) -> None:
+        if ev.get("op") == "put":
+            rec = ev.get("rec") or {}
+            k = self._key_of(rec)
+            old = self._items.get(k)
+            if old is not None:
+                self._index_remove(k, old)
+            self._items[k] = rec
+            self._index_add(k, rec)
+        elif ev.get("op") == "del":
+            k = str(ev.get("k"))
+            old = self._items.pop(k, None)
+            if old is not None:
+                self._index_remove(k, old)
+
+    def _reindex(self) -> None:
+        self._idx = {f: {} for f in self.indexes}
+        for k, rec in self._items.items():
+            self._index_add(k, rec)
+
+    def _index_add(self, k: str, rec: Dict[str, Any]) -> None:
+        for f in self.indexes:
+            self._idx[f].setdefault(rec.get(f), {})[k] = None
+
+    def _index_remove(self, k: str, rec: Dict[str, Any]) -> None:
+        for f in self.indexes:
+            bucket = self._idx[f].get(rec.get(f))
+            if bucket is not None:
+                bucket.pop(k, None)
+                if not bucket:
+                    self._idx[f].pop(rec.get(f), None)
+
+    def _write(self, ev: Dict[str, Any]) -> None:
+        """Append one event to the log (caller holds file_lock and has run _load)."""
+        DATA_DIR.mkdir(parents=True, exist_ok=True)
+        line = (json.dumps(ev, ensure_ascii=False) + "\n").encode("utf-8")
+        with open(self.journal_path, "ab") as f:
+            f.write(line)
+            f.flush()
+            st = os.fstat(f.fileno())
+        self._apply(ev)
+        self._jino, self._jpos = st.st_ino, st.st_size
+        self._jlines += 1
+        if self._jlines >= max(1, _env_int("STORAGE_JSON_COMPACT_EVERY", 200)):
+            self._compact()
+
+    def _compact(self) -> None:
+        # snapshot prima, log dopo: un crash nel mezzo rigioca il log (idempotente)
+        DATA_DIR.mkdir(parents=True, exist_ok=True)
+        if self.layout == "dict":
+            data: Any = dict(self._items)
+        else:
+            data = list(self._items.values())
+            if self.newest_first:
+                data.reverse()
+        tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+        tmp.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+        tmp.replace(self.path)
+        self._stamp = self._disk_stamp()
+        try:
+            self.journal_path.unlink()
+        except FileNotFoundError:
+            pass
+        self._jino, self._jpos, self._jlines = None, 0, 0
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            self._load()
+            rec = self._items.get(str(key))
+            return dict(rec) if rec is not None else None
+
+    def put(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        rec = dict(record)
+        self._key_of(rec)
+        with self._lock, file_lock(self.lock_path):
+            self._load()
+            self._write({"op": "put", "rec": rec})
+        return dict(rec)
+
+    def delete(self, key: str) -> bool:
+        k = str(key)
+        with self._lock, file_lock(self.lock_path):
+            self._load()
+            if k not in self._items:
+                return False
+            self._write({"op": "del", "k": k})
+            return True
+
+    def _candidates(self, where: Optional[Dict[str, Any]]) -> Iterable[Dict[str, Any]]:
+        for f in self.indexes:
+            if where and f in where:
+                keys = self._idx[f].get(where[f]) or {}
+                return [self._items[k] for k in keys]
+        return self._items.values()
+
+    def query(self, where: Optional[Dict[str, Any]] = None, order_by: Optional[str] = None,
+              desc: bool = False, limit: Optional[int] = None, offset: int = 0) -> List[Dict[str, Any]]:
+        with self._lock:
+            self._load()
+            rows = [r for r in self._candidates(where) if _matches(r, where)]
+        if order_by:
+            rows.sort(key=lambda r: _sort_key(r.get(order_by)), reverse=desc)
+        elif self.newest_first:
+            rows.reverse()
+        end = None if limit is None else offset + max(0, limit)
+        return [dict(r) for r in rows[offset:end]]
+
+    def count(self, where: Optional[Dict[str, Any]] = None) -> int:
+        with self._lock:
+            self._load()
+            return sum(1 for r in self._candidates(where) if _matches(r, where))
+
+
+# =========================
+# SQLite backend (WAL)
+# =========================
+_SQLITE_LOCAL = threading.local()
+
+
+def _sqlite_path() -> Path:
+    return Path(os.getenv("STORAGE_SQLITE_PATH") or (DATA_DIR / "dinomed.sqlite3"))
+
+
+def sqlite_connection() -> sqlite3.Connection:
+    """One connection per thread to the shared WAL database."""
+    conn = getattr(_SQLITE_LOCAL, "conn", None)
+    if conn is None:
+        path = _sqlite_path()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(path), timeout=30, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        _SQLITE_LOCAL.conn = conn
+    return conn
+
+
+def _ix_value(v: Any) -> Any:
+    if v is None or isinstance(v, (int, float, str)):
+        return int(v) if isinstance(v, bool) else v
+    return json.dumps(v, ensure_ascii=False, sort_keys=True)
+
+
+class SqliteCollection(Collection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.table = f"c_{self.name}"
+        self._cols = {f: f"ix_{f}" for f in self.indexes}
+        self._ready = False
+        self._ready_lock = threading.Lock()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = sqlite_connection()
+        if not self._ready:
+            with self._ready_lock:
+                if not self._ready:
+                    self._create(conn)
+                    self._ready = True
+        return conn
+
+    def _create(self, conn: sqlite3.Connection) -> None:
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (self.table,)
+        ).fetchone()
+        cols = "".join(f", {c}" for c in self._cols.values())
+        conn.execute(f'CREATE TABLE IF NOT EXISTS "{self.table}" (k TEXT PRIMARY KEY, data TEXT NOT NULL{cols})')
+        have = {r[1] for r in conn.execute(f'PRAGMA table_info("{self.table}")')}
+        for c in self._cols.values():
+            if c not in have:
+                conn.execute(f'ALTER TABLE "{self.table}" ADD COLUMN {c}')
+            conn.execute(f'CREATE INDEX IF NOT EXISTS "{self.table}_{c}" ON "{self.table}" ({c})')
+        if not exists:
+            self._import_legacy(conn)
+
+    def _import_legacy(self, conn: sqlite3.Connection) -> None:
+        if not self.legacy_path or not self.legacy_path.exists():
+            return
+        legacy = JsonCollection(self.name, key=self.key, indexes=(), layout=self.layout,
+                                newest_first=self.newest_first)
+        legacy.path = self.legacy_path
+        with legacy._lock:
+            legacy._load()
+            records = list(legacy._items.values())   # dal più vecchio al più nuovo
+        conn.execute("BEGIN")
+        try:
+            for rec in records:
+                self._upsert(conn, rec)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        logger.info("storage %s: importati %d record da %s", self.name, len(records), self.legacy_path)
+
+    def _upsert(self, conn: sqlite3.Connection, rec: Dict[str, Any]) -> None:
+        k = self._key_of(rec)
+        cols = ["k", "data"] + list(self._cols.values())
+        vals = [k, json.dumps(rec, ensure_ascii=False)] + [_ix_value(rec.get(f)) for f in self._cols]
+        sets = ", ".join(f"{c}=excluded.{c}" for c in cols[1:])
+        conn.execute(
+            f'INSERT INTO "{self.table}" ({", ".join(cols)}) VALUES ({", ".join("?" * len(cols))}) '
+            f"ON CONFLICT(k) DO UPDATE SET {sets}",
+            vals,
+        )
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute(f'SELECT data FROM "{self.table}" WHERE k=?', (str(key),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        rec = dict(record)
+        self._upsert(self._conn(), rec)
+        return rec
+
+    def delete(self, key: str) -> bool:
+        cur = self._conn().execute(f'DELETE FROM "{self.table}" WHERE k=?', (str(key),))
+        return cur.rowcount > 0
+
+    def _where_sql(self, where: Optional[Dict[str, Any]]):
+        clauses, params, rest = [], [], {}
+        for f, v in (where or {}).items():
+            if f in self._cols:
+                if v is None:
+                    clauses.append(f"{self._cols[f]} IS NULL")
+                else:
+                    clauses.append(f"{self._cols[f]} = ?")
+                    params.append(_ix_value(v))
+            elif f == self.key:
+                clauses.append("k = ?")
+                params.append(str(v))
+            else:
+                rest[f] = v
+        sql = (" WHERE " + " AND ".join(clauses)) if clauses else ""
+        return sql, params, rest
+
+    def query(self, where: Optional[Dict[str, Any]] = None, order_by: Optional[str] = None,
+              desc: bool = False, limit: Optional[int] = None, offset: int = 0) -> List[Dict[str, Any]]:
+        sql_where, params, rest = self._where_sql(where)
+        direction = "DESC" if desc else "ASC"
+        if order_by in self._cols:
+            order = f" ORDER BY {self._cols[order_by]} {direction}, rowid {direction}"
+        else:
+            order = f" ORDER BY rowid {'DESC' if self.newest_first else 'ASC'}"
+        paged = not rest and (order_by is None or order_by in self._cols)
+        page = ""
+        if paged and (limit is not None or offset):
+            page = " LIMIT ? OFFSET ?"
+            params = params + [-1 if limit is None else max(0, limit), max(0, offset)]
+        cur = self._conn().execute(f'SELECT data FROM "{self.table}"{sql_where}{order}{page}', params)
+        rows = [json.loads(r[0]) for r in cur]
+        if paged:
+            return rows
+        # filtri/ordinamento su campi non indicizzati: in Python
+        rows = [r for r in rows if _matches(r, rest)]
+        if order_by and order_by not in self._cols:
+            rows.sort(key=lambda r: _sort_key(r.get(order_by)), reverse=desc)
+        end = None if limit is None else offset + max(0, limit)
+        return rows[offset:end]
+
+    def count(self, where: Optional[Dict[str, Any]] = None) -> int:
+        sql_where, params, rest = self._where_sql(where)
+        if rest:
+            return len(self.query(where))
+        row = self._conn().execute(f'SELECT COUNT(*) FROM "{self.table}"{sql_where}', params).fetchone()
+        return int(row[0]) if row else 0
+
+
+# =========================
+# Registry
+# =========================
+_REGISTRY: Dict[str, Collection] = {}
+_REGISTRY_LOCK = threading.Lock()
+
+
+def get_collection(name: str, **kwargs) -> Collection:
+    """Return the (cached) collection `name` on the configured backend."""
+    col = _REGISTRY.get(name)
+    if col is not None:
+        return col
+    with _REGISTRY_LOCK:
+        col = _REGISTRY.get(name)
+        if col is None:
+            backend = _backend_name()
+            cls = SqliteCollection if backend == "sqlite" else JsonCollection
+            col = cls(name, **kwargs)
+            _REGISTRY[name] = col
+        return col
+
+
+# =========================
+# Collections del backend
+# =========================
+def dispense() -> Collection:
+    return get_collection("dispense", indexes=("pubblicata",), legacy_file="dispense.json")
+
+
+def simulazioni() -> Collection:
+    return get_collection("simulazioni", indexes=("pubblicata",), legacy_file="simulazioni.json")
+
+
+def bot_invites() -> Collection:
+    return get_collection("bot_invites", key="token", legacy_file="bot_invites.json",
+                          layout="dict", newest_first=False)
+
+
+def bot_links() -> Collection:
+    return get_collection("bot_links", key="telegram_id", legacy_file="bot_links.json",
+                          layout="dict", newest_first=False)
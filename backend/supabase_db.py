@@ -1,56 +1,567 @@
 from __future__ import annotations
 
+import json
+import logging
 import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Dict, List, Optional
 
 from supabase import create_client
 
+logger = logging.getLogger("dinomed.supabase")
+
 
 def _get_env(name: str) -> Optional[str]:
     v = os.getenv(name)
     return v if v and str(v).strip() else None
 
 
-def get_supabase_client():
-    """Create a Supabase client.
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(_get_env(name) or default)
+    except Exception:
+        return default
 
-    Prefers SUPABASE_SERVICE_KEY if present, otherwise SUPABASE_KEY.
-    """
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(_get_env(name) or default)
+    except Exception:
+        return default
+
+
+# =========================
+# Pooled client (one per process)
+# =========================
+# Tuning via env:
+#   SUPABASE_POOL_SIZE        max connessioni aperte (default 20)
+#   SUPABASE_POOL_KEEPALIVE   connessioni keep-alive tenute nel pool (default = pool size)
+#   SUPABASE_KEEPALIVE_S      secondi prima di chiudere una connessione inattiva (default 30)
+#   SUPABASE_TIMEOUT_S        timeout lettura/scrittura (default 15)
+#   SUPABASE_CONNECT_TIMEOUT_S timeout connessione TCP/TLS (default 5)
+_CLIENT = None
+_CLIENT_LOCK = threading.Lock()
+
+_POOL_STATS: Dict[str, int] = {
+    "clients_created": 0,
+    "requests": 0,
+    "connections_created": 0,
+}
+_POOL_STATS_LOCK = threading.Lock()
+
+
+def _pool_count(key: str, n: int = 1) -> None:
+    with _POOL_STATS_LOCK:
+        _POOL_STATS[key] = _POOL_STATS.get(key, 0) + n
+
+
+def _pool_trace(event_name: str, info: Dict[str, Any]) -> None:
+    # httpcore emette "connection.connect_tcp.complete" solo quando apre
+    # una connessione nuova: ogni altra richiesta riusa il keep-alive.
+    if event_name == "connection.connect_tcp.complete":
+        _pool_count("connections_created")
+
+
+def _http_pool_config():
+    """(limits, timeout) shared by the sync and async clients."""
+    import httpx
+
+    pool_size = max(1, _env_int("SUPABASE_POOL_SIZE", 20))
+    limits = httpx.Limits(
+        max_connections=pool_size,
+        max_keepalive_connections=max(1, _env_int("SUPABASE_POOL_KEEPALIVE", pool_size)),
+        keepalive_expiry=_env_float("SUPABASE_KEEPALIVE_S", 30.0),
+    )
+    timeout = httpx.Timeout(
+        _env_float("SUPABASE_TIMEOUT_S", 15.0),
+        connect=_env_float("SUPABASE_CONNECT_TIMEOUT_S", 5.0),
+    )
+    return limits, timeout
+
+
+def _build_http_client():
+    import httpx
+
+    limits, timeout = _http_pool_config()
+
+    class _CountingTransport(httpx.HTTPTransport):
+        def handle_request(self, request):
+            _pool_count("requests")
+            request.extensions["trace"] = _pool_trace
+            return super().handle_request(request)
+
+    return httpx.Client(
+        transport=_CountingTransport(limits=limits),
+        timeout=timeout,
+    )
+
+
+def _credentials():
     url = _get_env("SUPABASE_URL")
     key = _get_env("SUPABASE_SERVICE_KEY") or _get_env("SUPABASE_KEY") or _get_env("SUPABASE_ANON_KEY")
     if not url or not key:
         raise RuntimeError("Supabase env mancanti: SUPABASE_URL e SUPABASE_KEY (o SUPABASE_SERVICE_KEY).")
-    return create_client(url, key)
+    return url, key
 
 
-def fetch_all_questions() -> List[Dict[str, Any]]:
-    """Fetch all questions with pagination (PostgREST default limit can be 1000)."""
-    sb = get_supabase_client()
+def _create_client():
+    url, key = _credentials()
+
+    timeout_s = _env_float("SUPABASE_TIMEOUT_S", 15.0)
+    try:
+        from supabase.lib.client_options import SyncClientOptions
+
+        options = SyncClientOptions(
+            httpx_client=_build_http_client(),
+            postgrest_client_timeout=timeout_s,
+        )
+    except (ImportError, TypeError):
+        # supabase-py senza httpx_client: ogni sotto-client mantiene comunque
+        # la propria sessione keep-alive, basta non ricreare il client.
+        from supabase.lib.client_options import ClientOptions
+
+        options = ClientOptions(postgrest_client_timeout=timeout_s)
+    return create_client(url, key, options=options)
+
+
+def get_supabase_client():
+    """Return the process-wide Supabase client (created lazily, thread-safe).
+
+    Prefers SUPABASE_SERVICE_KEY if present, otherwise SUPABASE_KEY.
+    """
+    global _CLIENT
+    if _CLIENT is not None:
+        return _CLIENT
+    with _CLIENT_LOCK:
+        if _CLIENT is None:
+            _CLIENT = _create_client()
+            _pool_count("clients_created")
+    return _CLIENT
+
+
+def reset_supabase_client() -> None:
+    """Drop the shared client (e.g. after rotating keys); the next call recreates it."""
+    global _CLIENT
+    with _CLIENT_LOCK:
+        _CLIENT = None
+
+
+def pool_stats() -> Dict[str, int]:
+    """Counters for the shared HTTP pool: connections created vs reused."""
+    with _POOL_STATS_LOCK:
+        out = dict(_POOL_STATS)
+    out["connections_reused"] = max(0, out["requests"] - out["connections_created"])
+    return out
+
+
+# =========================
+# Projection profiles (colonne per caso d'uso)
+# =========================
+# Evita select("*") quando servono solo id/filtri o chiavi di risposta:
+#   picker  -> id + campi di filtro (materia/tipo/tag/difficolta)
+#   public  -> quanto vede lo studente durante la prova (senza soluzioni), con
+#              updated_at per la versione salvata nella sessione. Basta al
+#              picker lato server di /start: la correzione risolve le domande
+#              complete dalla banca (question_bank.resolve).
+#   grading -> domanda completa per correzione, review e lista admin, con
+#              updated_at (versione: question_rev / pinning delle sessioni
+#              compatte) e created_at (ordinamento della lista admin).
+#              Default della banca in cache (QUESTION_BANK_PROFILE).
+#   admin   -> tutte le colonne (QUESTION_BANK_PROFILE=admin; base di confronto
+#              in projection_stats)
+#   ids     -> solo id (diff periodico per trovare le cancellazioni)
+#
+# updated_at esiste solo dopo sql/questions_sync.sql e created_at non è
+# garantito: se PostgREST risponde "colonna inesistente" (42703) la colonna
+# viene tolta dai profili per il resto del processo e la query ripetuta.
+QUESTION_PROFILES: Dict[str, str] = {
+    "picker": "id,materia,tipo,tag,difficolta",
+    "public": "id,materia,tipo,testo,opzioni,tag,difficolta,updated_at",
+    "grading": ("id,materia,tipo,testo,opzioni,corretta,corretta_index,risposte,spiegazione,tag,difficolta,"
+                "created_at,updated_at"),
+    "admin": "*",
+    "ids": "id",
+}
+
+_OPTIONAL_COLUMNS = ("created_at", "updated_at")
+_MISSING_COLUMNS: set = set()
+_MISSING_COLUMN_RE = re.compile(r'column\s+(?:"?\w+"?\.)?"?(\w+)"?\s+does not exist')
+
+_PROFILE_STATS: Dict[str, Dict[str, int]] = {}
+_PROFILE_STATS_LOCK = threading.Lock()
+
+
+def profile_columns(profile: str) -> str:
+    try:
+        columns = QUESTION_PROFILES[profile]
+    except KeyError:
+        raise ValueError(f"Profilo colonne sconosciuto: {profile!r} (validi: {', '.join(QUESTION_PROFILES)})")
+    if _MISSING_COLUMNS and columns != "*":
+        columns = ",".join(c for c in columns.split(",") if c not in _MISSING_COLUMNS)
+    return columns
+
+
+def _is_missing_column(e: Exception) -> bool:
+    return getattr(e, "code", None) == "42703" or "42703" in str(e) or bool(_MISSING_COLUMN_RE.search(str(e)))
+
+
+def _drop_missing_columns(profile: str, e: Exception) -> bool:
+    """True if `e` is an undefined optional column of `profile`: drop it so a retry can succeed."""
+    if not _is_missing_column(e):
+        return False
+    selected = set(profile_columns(profile).split(","))
+    m = _MISSING_COLUMN_RE.search(str(e))
+    # colonna non indicata nel messaggio: via tutte le opzionali
+    drop = {m.group(1)} if m else set(_OPTIONAL_COLUMNS)
+    drop &= selected & set(_OPTIONAL_COLUMNS)
+    if not drop:
+        return False
+    _MISSING_COLUMNS.update(drop)
+    logger.warning("questions: colonne assenti %s (sql/questions_sync.sql non applicato?), "
+                   "tolte dai profili: %s", ",".join(sorted(drop)), e)
+    return True
+
+
+def _without_missing_columns(profile: str, fn, *args, **kwargs):
+    # al più una ripetuta per colonna opzionale
+    for _ in range(len(_OPTIONAL_COLUMNS)):
+        try:
+            return fn(*args, **kwargs)
+        except _fetch_errors() as e:
+            if not _drop_missing_columns(profile, e):
+                raise
+    return fn(*args, **kwargs)
+
+
+_PAYLOAD_SAMPLE_ROWS = 16
+
+
+def _record_payload(profile: str, data: List[Dict[str, Any]]) -> None:
+    if not data:
+        return
+    # stima dei byte ricevuti: serializzazione compatta (come PostgREST) di un
+    # campione di righe equidistanti, estesa alla pagina. Costo costante: gira
+    # anche sull'event loop (supabase_db_async)
+    step = max(1, len(data) // _PAYLOAD_SAMPLE_ROWS)
+    sample = data[::step][:_PAYLOAD_SAMPLE_ROWS]
+    sampled = len(json.dumps(sample, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+    size = int(sampled * len(data) / len(sample))
+    with _PROFILE_STATS_LOCK:
+        st = _PROFILE_STATS.setdefault(profile, {"requests": 0, "rows": 0, "bytes": 0})
+        st["requests"] += 1
+        st["rows"] += len(data)
+        st["bytes"] += size
+
+
+def projection_stats() -> Dict[str, Any]:
+    """Bytes received per profile, with the per-row reduction versus "admin"."""
+    with _PROFILE_STATS_LOCK:
+        stats = {k: dict(v) for k, v in _PROFILE_STATS.items()}
+    for st in stats.values():
+        st["bytes_per_row"] = round(st["bytes"] / st["rows"], 1) if st["rows"] else 0.0
+    full = (stats.get("admin") or {}).get("bytes_per_row") or 0.0
+    for name, st in stats.items():
+        if full and name != "admin":
+            st["reduction_pct"] = round((1.0 - st["bytes_per_row"] / full) * 100.0, 1)
+    return stats
+
+
+# =========================
+# Full fetch: keyset pagination (+ shard concorrenti)
+# =========================
+#   SUPABASE_PAGE_SIZE          righe per pagina (default 1000, limite tipico PostgREST)
+#   SUPABASE_FETCH_CONCURRENCY  shard scaricati in parallelo (default 1 = sequenziale)
+#
+# Keyset su `id` (order by id, id > ultimo visto) invece di OFFSET: ogni pagina
+# costa uguale indipendentemente da quanto si è avanti nella tabella.
+# Con concorrenza > 1 lo spazio degli id è diviso in 16 intervalli contigui
+# (prima cifra esadecimale dell'uuid) scaricati in parallelo.
+_ID_SHARD_BOUNDS = [f"{h}0000000-0000-0000-0000-000000000000" for h in "123456789abcdef"]
+
+_LAST_FETCH: Dict[str, Any] = {}
+_LAST_FETCH_LOCK = threading.Lock()
+
+
+def _fetch_errors() -> tuple:
+    """Errors that justify the sequential retry (PostgREST/network), not programming errors."""
+    errs: List[type] = [RuntimeError]  # _fetch_id_range: risposta con errore
+    try:
+        import httpx
+
+        errs.append(httpx.HTTPError)
+    except ImportError:
+        pass
+    try:
+        from postgrest.exceptions import APIError
+
+        errs.append(APIError)
+    except ImportError:
+        pass
+    return tuple(errs)
+
+
+def _fetch_id_range(sb,
+                    profile: str,
+                    lower: Optional[str],
+                    upper: Optional[str],
+                    page: int,
+                    shard: int,
+                    timings: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    columns = profile_columns(profile)
     out: List[Dict[str, Any]] = []
-    offset = 0
-    page = 1000
+    last_id: Optional[str] = None
+    page_no = 0
     while True:
-        resp = sb.table("questions").select("*").range(offset, offset + page - 1).execute()
+        q = sb.table("questions").select(columns).order("id")
+        if last_id is not None:
+            q = q.gt("id", last_id)
+        elif lower is not None:
+            q = q.gte("id", lower)
+        if upper is not None:
+            q = q.lt("id", upper)
+        t0 = time.perf_counter()
+        resp = q.limit(page).execute()
+        ms = (time.perf_counter() - t0) * 1000.0
         err = getattr(resp, "error", None)
         data = getattr(resp, "data", None) or []
         if err and not data:
             raise RuntimeError(f"Supabase error fetching questions: {err}")
+        _record_payload(profile, data)
+        timings.append({"shard": shard, "page": page_no, "rows": len(data), "ms": round(ms, 1)})
+        page_no += 1
         if not data:
             break
         out.extend(data)
+        if len(data) < page:
+            break
+        last_id = str(data[-1].get("id"))
+    return out
+
+
+def fetch_all_questions(concurrency: Optional[int] = None,
+                        profile: str = "grading") -> List[Dict[str, Any]]:
+    """Fetch all questions with keyset pagination (PostgREST default limit can be 1000).
+
+    `profile` picks the columns (see QUESTION_PROFILES).
+    """
+    profile_columns(profile)
+    return _without_missing_columns(profile, _fetch_all, concurrency, profile)
+
+
+def _fetch_all(concurrency: Optional[int], profile: str) -> List[Dict[str, Any]]:
+    sb = get_supabase_client()
+    page = max(1, _env_int("SUPABASE_PAGE_SIZE", 1000))
+    workers = concurrency if concurrency is not None else _env_int("SUPABASE_FETCH_CONCURRENCY", 1)
+    timings: List[Dict[str, Any]] = []
+    t0 = time.perf_counter()
+
+    out: List[Dict[str, Any]] = []
+    if workers <= 1:
+        out = _fetch_id_range(sb, profile, None, None, page, 0, timings)
+    else:
+        bounds: List[Optional[str]] = [None] + list(_ID_SHARD_BOUNDS) + [None]
+        ranges = list(zip(bounds[:-1], bounds[1:]))
+        try:
+            with ThreadPoolExecutor(max_workers=min(workers, len(ranges))) as pool:
+                futures = [
+                    pool.submit(_fetch_id_range, sb, profile, lo, hi, page, i, timings)
+                    for i, (lo, hi) in enumerate(ranges)
+                ]
+                # concatena nell'ordine degli shard: il risultato resta ordinato per id
+                for f in futures:
+                    out.extend(f.result())
+        except _fetch_errors() as e:
+            if _is_missing_column(e):
+                raise
+            # id non confrontabili con i limiti uuid (es. colonna intera): scan sequenziale
+            logger.warning("sharded question fetch failed, retrying sequentially: %s", e)
+            timings = []
+            workers = 1
+            out = _fetch_id_range(sb, profile, None, None, page, 0, timings)
+
+    total_ms = (time.perf_counter() - t0) * 1000.0
+    with _LAST_FETCH_LOCK:
+        _LAST_FETCH.clear()
+        _LAST_FETCH.update({
+            "rows": len(out),
+            "ms": round(total_ms, 1),
+            "concurrency": max(1, workers),
+            "page_size": page,
+            "pages": sorted(timings, key=lambda t: (t["shard"], t["page"])),
+        })
+    logger.debug("fetched %d questions in %.1f ms (%d pages, concurrency %d)",
+                 len(out), total_ms, len(timings), max(1, workers))
+    return out
+
+
+def last_fetch_stats() -> Dict[str, Any]:
+    """Per-page timings of the last full `fetch_all_questions()`."""
+    with _LAST_FETCH_LOCK:
+        return dict(_LAST_FETCH)
+
+
+# =========================
+# Delta sync (sql/questions_sync.sql)
+# =========================
+def fetch_questions_watermark() -> Optional[str]:
+    """Latest `updated_at` in questions (None if the table is empty)."""
+    sb = get_supabase_client()
+    resp = sb.table("questions").select("updated_at").order("updated_at", desc=True).limit(1).execute()
+    data = getattr(resp, "data", None) or []
+    return data[0].get("updated_at") if data else None
+
+
+def fetch_questions_changed_since(since: str, profile: str = "grading") -> List[Dict[str, Any]]:
+    """Rows with updated_at >= since (boundary rows are re-read: the merge is idempotent)."""
+    sb = get_supabase_client()
+    columns = profile_columns(profile)
+    page = max(1, _env_int("SUPABASE_PAGE_SIZE", 1000))
+    out: List[Dict[str, Any]] = []
+    offset = 0
+    while True:
+        # il delta è piccolo: OFFSET va bene qui
+        resp = (
+            sb.table("questions").select(columns)
+            .gte("updated_at", since)
+            .order("updated_at").order("id")
+            .range(offset, offset + page - 1)
+            .execute()
+        )
+        err = getattr(resp, "error", None)
+        data = getattr(resp, "data", None) or []
+        if err and not data:
+            raise RuntimeError(f"Supabase error fetching changed questions: {err}")
+        _record_payload(profile, data)
+        out.extend(data)
         if len(data) < page:
             break
         offset += page
     return out
 
 
-def fetch_question_by_id(qid: str) -> Optional[Dict[str, Any]]:
+def fetch_tombstones_watermark() -> Optional[str]:
+    """Latest `deleted_at` in question_tombstones (raises if the table does not exist)."""
+    sb = get_supabase_client()
+    resp = sb.table("question_tombstones").select("deleted_at").order("deleted_at", desc=True).limit(1).execute()
+    data = getattr(resp, "data", None) or []
+    return data[0].get("deleted_at") if data else None
+
+
+def fetch_question_tombstones_since(since: Optional[str]) -> List[str]:
+    """Ids of questions deleted at or after `since` (all tombstones if None)."""
     sb = get_supabase_client()
-    resp = sb.table("questions").select("*").eq("id", qid).limit(1).execute()
+    q = sb.table("question_tombstones").select("id")
+    if since:
+        q = q.gte("deleted_at", since)
+    resp = q.execute()
     data = getattr(resp, "data", None) or []
+    return [str(x.get("id")) for x in data if x.get("id") is not None]
+
+
+def fetch_question_ids() -> List[str]:
+    """All live question ids (id-only keyset scan)."""
+    return [str(q.get("id")) for q in fetch_all_questions(profile="ids") if q.get("id") is not None]
+
+
+# =========================
+# Picker lato server (sql/pick_questions.sql)
+# =========================
+def _picker_params(materia: str, tipo: str, tags: Optional[List[str]], difficolta: Optional[str]) -> Dict[str, Any]:
+    clean_tags = [str(t).strip() for t in (tags or []) if str(t).strip()]
+    return {
+        "p_materia": materia,
+        "p_tipo": tipo,
+        "p_tags": clean_tags or None,
+        "p_difficolta": (str(difficolta).strip() or None) if difficolta else None,
+    }
+
+
+def pick_questions(materia: str,
+                   tipo: str,
+                   n: int,
+                   tags: Optional[List[str]] = None,
+                   difficolta: Optional[str] = None,
+                   profile: str = "grading") -> List[Dict[str, Any]]:
+    """Random sample of up to n matching questions, filtered and sampled in Postgres.
+
+    Default profile "grading": la sessione deve poter correggere e mostrare la review.
+    """
+    if n <= 0:
+        return []
+    profile_columns(profile)
+    return _without_missing_columns(profile, _pick, materia, tipo, n, tags, difficolta, profile)
+
+
+def _pick(materia: str, tipo: str, n: int, tags: Optional[List[str]], difficolta: Optional[str],
+          profile: str) -> List[Dict[str, Any]]:
+    columns = profile_columns(profile)
+    sb = get_supabase_client()
+    params = _picker_params(materia, tipo, tags, difficolta)
+    params["p_limit"] = int(n)
+    query = sb.rpc("pick_questions", params)
+    select = getattr(query, "select", None)
+    if columns and columns != "*" and callable(select):
+        query = select(columns)
+    resp = query.execute()
+    err = getattr(resp, "error", None)
+    data = getattr(resp, "data", None)
+    if err and not data:
+        raise RuntimeError(f"Supabase error picking questions: {err}")
+    data = data if isinstance(data, list) else []
+    _record_payload(profile, data)
+    return data
+
+
+def count_questions(materia: str,
+                    tipo: str,
+                    tags: Optional[List[str]] = None,
+                    difficolta: Optional[str] = None) -> int:
+    sb = get_supabase_client()
+    resp = sb.rpc("count_questions", _picker_params(materia, tipo, tags, difficolta)).execute()
+    data = getattr(resp, "data", None)
+    try:
+        return int(data or 0)
+    except Exception:
+        return 0
+
+
+def fetch_question_by_id(qid: str, profile: str = "grading") -> Optional[Dict[str, Any]]:
+    return _without_missing_columns(profile, _fetch_by_id, qid, profile)
+
+
+def _fetch_by_id(qid: str, profile: str) -> Optional[Dict[str, Any]]:
+    sb = get_supabase_client()
+    resp = sb.table("questions").select(profile_columns(profile)).eq("id", qid).limit(1).execute()
+    data = getattr(resp, "data", None) or []
+    _record_payload(profile, data)
     return data[0] if data else None
 
 
+def fetch_questions_by_ids(ids: List[str], profile: str = "grading") -> List[Dict[str, Any]]:
+    """Rows for the given ids (missing ids are simply absent)."""
+    ids = [str(x) for x in ids if x is not None]
+    if not ids:
+        return []
+    return _without_missing_columns(profile, _fetch_by_ids, ids, profile)
+
+
+def _fetch_by_ids(ids: List[str], profile: str) -> List[Dict[str, Any]]:
+    sb = get_supabase_client()
+    columns = profile_columns(profile)
+    # id=in.(...) finisce nella query string: blocchi piccoli per non superare i limiti dell'URL
+    page = 200
+    out: List[Dict[str, Any]] = []
+    for i in range(0, len(ids), page):
+        resp = sb.table("questions").select(columns).in_("id", ids[i:i + page]).execute()
+        data = getattr(resp, "data", None) or []
+        _record_payload(profile, data)
+        out.extend(data)
+    return out
+
+
 def insert_question(payload: Dict[str, Any]) -> Dict[str, Any]:
     sb = get_supabase_client()
     resp = sb.table("questions").insert(payload).execute()
@@ -58,6 +569,30 @@ def insert_question(payload: Dict[str, Any]) -> Dict[str, Any]:
     return data[0] if data else payload
 
 
+def upsert_questions(payloads: List[Dict[str, Any]], on_conflict: str = "content_hash") -> int:
+    """Bulk upsert in a single request; returns the number of rows sent.
+
+    default_to_null=False: con righe dalle chiavi diverse PostgREST manderebbe
+    NULL per le colonne assenti (columns = unione delle chiavi), sovrascrivendo
+    i valori esistenti a ogni re-import. returning=minimal: niente eco delle righe.
+    """
+    if not payloads:
+        return 0
+    from postgrest.types import ReturnMethod
+
+    sb = get_supabase_client()
+    resp = sb.table("questions").upsert(
+        payloads,
+        on_conflict=on_conflict,
+        returning=ReturnMethod.minimal,
+        default_to_null=False,
+    ).execute()
+    err = getattr(resp, "error", None)
+    if err:
+        raise RuntimeError(f"Supabase error upserting questions: {err}")
+    return len(payloads)
+
+
 def update_question(qid: str, payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
     sb = get_supabase_client()
     resp = sb.table("questions").update(payload).eq("id", qid).execute()
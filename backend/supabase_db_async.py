@@ -0,0 +1,252 @@
+"""Async variant of supabase_db for the hot FastAPI routes.
+
+Stesse query di supabase_db (profili colonne, keyset, picker RPC) ma su un
+AsyncClient condiviso con pool httpx keep-alive: migliaia di attese in
+parallelo costano coroutine, non thread del threadpool di Starlette.
+
+Config pool/timeout: stesse variabili SUPABASE_* di supabase_db.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Any, Dict, List, Optional
+
+from supabase_db import (
+    _ID_SHARD_BOUNDS,
+    _LAST_FETCH,
+    _LAST_FETCH_LOCK,
+    _OPTIONAL_COLUMNS,
+    _credentials,
+    _drop_missing_columns,
+    _env_float,
+    _env_int,
+    _fetch_errors,
+    _http_pool_config,
+    _is_missing_column,
+    _picker_params,
+    _pool_count,
+    _record_payload,
+    logger,
+    profile_columns,
+)
+
+_CLIENT = None
+_CLIENT_LOCK: Optional[asyncio.Lock] = None
+
+
+async def _apool_trace(event_name: str, info: Dict[str, Any]) -> None:
+    # come supabase_db._pool_trace, ma httpcore async si aspetta una coroutine
+    if event_name == "connection.connect_tcp.complete":
+        _pool_count("connections_created")
+
+
+def _build_async_http_client():
+    import httpx
+
+    limits, timeout = _http_pool_config()
+
+    class _CountingTransport(httpx.AsyncHTTPTransport):
+        async def handle_async_request(self, request):
+            _pool_count("requests")
+            request.extensions["trace"] = _apool_trace
+            return await super().handle_async_request(request)
+
+    return httpx.AsyncClient(
+        transport=_CountingTransport(limits=limits),
+        timeout=timeout,
+    )
+
+
+async def _create_client():
+    from supabase import acreate_client
+
+    url, key = _credentials()
+    timeout_s = _env_float("SUPABASE_TIMEOUT_S", 15.0)
+    try:
+        from supabase.lib.client_options import AsyncClientOptions
+
+        options = AsyncClientOptions(
+            httpx_client=_build_async_http_client(),
+            postgrest_client_timeout=timeout_s,
+        )
+    except (ImportError, TypeError):
+        from supabase.lib.client_options import ClientOptions
+
+        options = ClientOptions(postgrest_client_timeout=timeout_s)
+    return await acreate_client(url, key, options=options)
+
+
+async def get_async_client():
+    """Return the process-wide async Supabase client (created lazily)."""
+    global _CLIENT, _CLIENT_LOCK
+    if _CLIENT is not None:
+        return _CLIENT
+    if _CLIENT_LOCK is None:
+        _CLIENT_LOCK = asyncio.Lock()
+    async with _CLIENT_LOCK:
+        if _CLIENT is None:
+            _CLIENT = await _create_client()
+            _pool_count("clients_created")
+    return _CLIENT
+
+
+# =========================
+# Questions
+# =========================
+async def _without_missing_columns(profile: str, fn, *args):
+    # come supabase_db._without_missing_columns
+    for _ in range(len(_OPTIONAL_COLUMNS)):
+        try:
+            return await fn(*args)
+        except _fetch_errors() as e:
+            if not _drop_missing_columns(profile, e):
+                raise
+    return await fn(*args)
+
+
+async def _fetch_id_range(sb,
+                          profile: str,
+                          lower: Optional[str],
+                          upper: Optional[str],
+                          page: int,
+                          shard: int,
+                          timings: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    columns = profile_columns(profile)
+    out: List[Dict[str, Any]] = []
+    last_id: Optional[str] = None
+    page_no = 0
+    while True:
+        q = sb.table("questions").select(columns).order("id")
+        if last_id is not None:
+            q = q.gt("id", last_id)
+        elif lower is not None:
+            q = q.gte("id", lower)
+        if upper is not None:
+            q = q.lt("id", upper)
+        t0 = time.perf_counter()
+        resp = await q.limit(page).execute()
+        ms = (time.perf_counter() - t0) * 1000.0
+        err = getattr(resp, "error", None)
+        data = getattr(resp, "data", None) or []
+        if err and not data:
+            raise RuntimeError(f"Supabase error fetching questions: {err}")
+        _record_payload(profile, data)
+        timings.append({"shard": shard, "page": page_no, "rows": len(data), "ms": round(ms, 1)})
+        page_no += 1
+        if not data:
+            break
+        out.extend(data)
+        if len(data) < page:
+            break
+        last_id = str(data[-1].get("id"))
+    return out
+
+
+async def fetch_all_questions(concurrency: Optional[int] = None,
+                              profile: str = "grading") -> List[Dict[str, Any]]:
+    """Async twin of supabase_db.fetch_all_questions (keyset, shards via gather)."""
+    profile_columns(profile)
+    return await _without_missing_columns(profile, _fetch_all, concurrency, profile)
+
+
+async def _fetch_all(concurrency: Optional[int], profile: str) -> List[Dict[str, Any]]:
+    sb = await get_async_client()
+    page = max(1, _env_int("SUPABASE_PAGE_SIZE", 1000))
+    workers = concurrency if concurrency is not None else _env_int("SUPABASE_FETCH_CONCURRENCY", 1)
+    timings: List[Dict[str, Any]] = []
+    t0 = time.perf_counter()
+
+    out: List[Dict[str, Any]] = []
+    if workers <= 1:
+        out = await _fetch_id_range(sb, profile, None, None, page, 0, timings)
+    else:
+        bounds: List[Optional[str]] = [None] + list(_ID_SHARD_BOUNDS) + [None]
+        ranges = list(zip(bounds[:-1], bounds[1:]))
+        sem = asyncio.Semaphore(workers)
+
+        async def _shard(i: int, lo: Optional[str], hi: Optional[str]):
+            async with sem:
+                return await _fetch_id_range(sb, profile, lo, hi, page, i, timings)
+
+        try:
+            parts = await asyncio.gather(*[_shard(i, lo, hi) for i, (lo, hi) in enumerate(ranges)])
+            for part in parts:
+                out.extend(part)
+        except _fetch_errors() as e:
+            if _is_missing_column(e):
+                raise
+            logger.warning("sharded question fetch failed, retrying sequentially: %s", e)
+            timings = []
+            workers = 1
+            out = await _fetch_id_range(sb, profile, None, None, page, 0, timings)
+
+    total_ms = (time.perf_counter() - t0) * 1000.0
+    with _LAST_FETCH_LOCK:
+        _LAST_FETCH.clear()
+        _LAST_FETCH.update({
+            "rows": len(out),
+            "ms": round(total_ms, 1),
+            "concurrency": max(1, workers),
+            "page_size": page,
+            "pages": sorted(timings, key=lambda t: (t["shard"], t["page"])),
+        })
+    return out
+
+
+async def fetch_question_by_id(qid: str, profile: str = "grading") -> Optional[Dict[str, Any]]:
+    return await _without_missing_columns(profile, _fetch_by_id, qid, profile)
+
+
+async def _fetch_by_id(qid: str, profile: str) -> Optional[Dict[str, Any]]:
+    sb = await get_async_client()
+    resp = await sb.table("questions").select(profile_columns(profile)).eq("id", qid).limit(1).execute()
+    data = getattr(resp, "data", None) or []
+    _record_payload(profile, data)
+    return data[0] if data else None
+
+
+async def pick_questions(materia: str,
+                         tipo: str,
+                         n: int,
+                         tags: Optional[List[str]] = None,
+                         difficolta: Optional[str] = None,
+                         profile: str = "grading") -> List[Dict[str, Any]]:
+    if n <= 0:
+        return []
+    profile_columns(profile)
+    return await _without_missing_columns(profile, _pick, materia, tipo, n, tags, difficolta, profile)
+
+
+async def _pick(materia: str, tipo: str, n: int, tags: Optional[List[str]], difficolta: Optional[str],
+                profile: str) -> List[Dict[str, Any]]:
+    columns = profile_columns(profile)
+    sb = await get_async_client()
+    params = _picker_params(materia, tipo, tags, difficolta)
+    params["p_limit"] = int(n)
+    query = sb.rpc("pick_questions", params)
+    select = getattr(query, "select", None)
+    if columns and columns != "*" and callable(select):
+        query = select(columns)
+    resp = await query.execute()
+    err = getattr(resp, "error", None)
+    data = getattr(resp, "data", None)
+    if err and not data:
+        raise RuntimeError(f"Supabase error picking questions: {err}")
+    data = data if isinstance(data, list) else []
+    _record_payload(profile, data)
+    return data
+
+
+async def count_questions(materia: str,
+                          tipo: str,
+                          tags: Optional[List[str]] = None,
+                          difficolta: Optional[str] = None) -> int:
+    sb = await get_async_client()
+    resp = await sb.rpc("count_questions", _picker_params(materia, tipo, tags, difficolta)).execute()
+    data = getattr(resp, "data", None)
+    try:
+        return int(data or 0)
+    except Exception:
+        return 0
@@ -0,0 +1,89 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage  # noqa: E402
+import session_store  # noqa: E402
+
+
+@pytest.fixture
+def sqlite_db(tmp_path, monkeypatch):
+    monkeypatch.setenv("STORAGE_SQLITE_PATH", str(tmp_path / "test.sqlite3"))
+    monkeypatch.setattr(storage._SQLITE_LOCAL, "conn", None, raising=False)
+    monkeypatch.setattr(session_store, "_SQLITE_READY", False)
+    yield
+    conn = getattr(storage._SQLITE_LOCAL, "conn", None)
+    if conn is not None:
+        conn.close()
+
+
+def _session(sid):
+    return {"id": sid, "deadline_at": 1.0, "finished": False, "answers": {}}
+
+
+def _double_finish(store):
+    store.put("s1", _session("s1"), ttl_s=60)
+    assert store.claim_finish("s1") is True
+    # /finish salva la sessione chiusa: il claim deve restare
+    store.put("s1", dict(_session("s1"), finished=True))
+    assert store.claim_finish("s1") is False
+    assert store.due(before=10.0) == []
+
+
+def test_double_finish_memory():
+    _double_finish(session_store.SessionStore("test-mem"))
+
+
+def test_double_finish_sqlite(sqlite_db):
+    _double_finish(session_store.SqliteSessionStore("test-sql"))
+
+
+def test_claim_cleared_on_delete():
+    store = session_store.SessionStore("test-del")
+    store.put("s1", _session("s1"), ttl_s=60)
+    assert store.claim_finish("s1") is True
+    store.delete("s1")
+    store.put("s1", _session("s1"), ttl_s=60)
+    assert store.claim_finish("s1") is True
+
+
+def test_memory_due_heap():
+    store = session_store.SessionStore("test-heap")
+    store.put("a", dict(_session("a"), deadline_at=5.0), ttl_s=60)
+    store.put("b", dict(_session("b"), deadline_at=3.0), ttl_s=60)
+    store.put("c", dict(_session("c"), deadline_at=50.0), ttl_s=60)
+    # la scadenza spostata invalida la voce vecchia
+    store.put("b", dict(_session("b"), deadline_at=40.0))
+    assert store.next_due() == 5.0
+    assert store.due(before=10.0) == ["a"]
+    # non corretta: resta in heap e viene riproposta dopo
+    assert store.next_due() > 10.0
+    assert store.claim_finish("a") is True
+    assert store.due(before=1000.0) == ["b", "c"]
+    store.delete("b")
+    store.delete("c")
+    assert store.next_due() is None
+
+
+def test_run_deadlines_memory_only(sqlite_db, monkeypatch):
+    mem = session_store.SessionStore("test-run-mem")
+    sql = session_store.SqliteSessionStore("test-run-sql")
+    monkeypatch.setattr(session_store, "_STORES", {mem.name: mem, sql.name: sql})
+    fired = []
+
+    def handler(name, sid):
+        fired.append((name, sid))
+        session_store._STORES[name].claim_finish(sid)
+
+    monkeypatch.setattr(session_store, "_DL_HANDLER", handler)
+    monkeypatch.setattr(session_store, "_DL_DELAY_S", 0.0)
+    mem.put("m1", _session("m1"), ttl_s=60)
+    sql.put("s1", _session("s1"), ttl_s=60)
+    assert session_store.run_deadlines(poll=False) == 1
+    assert fired == [(mem.name, "m1")]
+    assert session_store.run_deadlines() == 1
+    assert fired[-1] == (sql.name, "s1")
+    assert session_store.run_deadlines() == 0
@@ -20,6 +20,10 @@ export default function AdminSegnalazioni() {
   const [items, setItems] = useState([]);
   const [loading, setLoading] = useState(true);
   const [err, setErr] = useState("");
+  // paginazione (cursor dal backend) + conteggi per stato
+  const [nextCursor, setNextCursor] = useState(null);
+  const [counts, setCounts] = useState({});
+  const [loadingMore, setLoadingMore] = useState(false);
 
   // Filtri
   const [status, setStatus] = useState("");
@@ -43,14 +47,33 @@ export default function AdminSegnalazioni() {
     try {
       const data = await api.listReports(query);
       setItems(Array.isArray(data?.items) ? data.items : []);
+      setNextCursor(data?.next_cursor || null);
+      setCounts(data?.counts && typeof data.counts === "object" ? data.counts : {});
     } catch (e) {
       setItems([]);
+      setNextCursor(null);
       setErr(String(e?.message || "Impossibile caricare segnalazioni"));
     } finally {
       setLoading(false);
     }
   }
 
+  async function loadMore() {
+    if (!nextCursor) return;
+    setLoadingMore(true);
+    try {
+      const data = await api.listReports({ ...query, cursor: nextCursor });
+      const more = Array.isArray(data?.items) ? data.items : [];
+      setItems((prev) => [...prev, ...more]);
+      setNextCursor(data?.next_cursor || null);
+      if (data?.counts && typeof data.counts === "object") setCounts(data.counts);
+    } catch (e) {
+      setErr(String(e?.message || "Impossibile caricare segnalazioni"));
+    } finally {
+      setLoadingMore(false);
+    }
+  }
+
   useEffect(() => {
     load();
     // eslint-disable-next-line react-hooks/exhaustive-deps
@@ -79,7 +102,12 @@ export default function AdminSegnalazioni() {
         <div>
           <h2 style={{ margin: 0 }}>Segnalazioni</h2>
           <div style={{ color: "rgba(15,23,42,0.65)", fontWeight: 800 }}>
-            {loading ? "Caricamento…" : `${items.length} elementi`}
+            {loading ? "Caricamento…" : `${items.length}${nextCursor ? "+" : ""} elementi`}
+            {!loading && Object.keys(counts).length ? (
+              <span style={{ marginLeft: 8, fontWeight: 750 }}>
+                ({Object.entries(counts).map(([k, v]) => `${k}: ${v}`).join(" • ")})
+              </span>
+            ) : null}
           </div>
         </div>
         <button
@@ -315,6 +343,26 @@ export default function AdminSegnalazioni() {
         </div>
       )}
 
+      {!loading && nextCursor ? (
+        <div style={{ display: "flex", justifyContent: "center", marginTop: 12 }}>
+          <button
+            type="button"
+            onClick={loadMore}
+            disabled={loadingMore}
+            style={{
+              padding: "10px 12px",
+              borderRadius: 12,
+              border: "1px solid rgba(15,23,42,0.15)",
+              background: "white",
+              fontWeight: 950,
+              cursor: loadingMore ? "default" : "pointer",
+            }}
+          >
+            {loadingMore ? "Caricamento…" : "Carica altre"}
+          </button>
+        </div>
+      ) : null}
+
       <div style={{ height: 24 }} />
     </section>
   );
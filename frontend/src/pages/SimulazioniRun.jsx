@@ -227,6 +227,48 @@ export default function SimulazioniRun() {
     } catch {}
   }, [answers, idx, storageKey]);
 
+  // Checkpoint sul server (PATCH /api/sim/{id}/answers): ogni 10s solo le risposte cambiate
+  const answersRef = useRef(answers);
+  const sentAnswersRef = useRef({});
+  useEffect(() => {
+    answersRef.current = answers;
+  }, [answers]);
+
+  useEffect(() => {
+    if (reviewMode || !sessionId || !session) return;
+    let sending = false;
+
+    const t = setInterval(async () => {
+      if (sending) return;
+      const current = answersRef.current || {};
+      const sent = sentAnswersRef.current;
+      const delta = {};
+      for (const [k, v] of Object.entries(current)) {
+        if (sent[k] !== v) delta[k] = v;
+      }
+      for (const k of Object.keys(sent)) {
+        if (!(k in current)) delta[k] = ""; // risposta tolta
+      }
+      if (!Object.keys(delta).length) return;
+
+      sending = true;
+      try {
+        const res = await fetch(`${API_BASE}/api/sim/${encodeURIComponent(sessionId)}/answers`, {
+          method: "PATCH",
+          headers: { "Content-Type": "application/json", Accept: "application/json" },
+          body: JSON.stringify({ answers: delta }),
+        });
+        if (res.ok) sentAnswersRef.current = { ...current };
+      } catch {
+        // offline: riprova al giro successivo (le risposte restano in localStorage)
+      } finally {
+        sending = false;
+      }
+    }, 10000);
+
+    return () => clearInterval(t);
+  }, [sessionId, session, reviewMode]);
+
   // Fetch session
   useEffect(() => {
     if (reviewMode) return;